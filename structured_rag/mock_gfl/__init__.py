@@ -1,4 +1,36 @@
-from .dspy_program import *
-from .dspy_signatures import *
-from .fstring_program import *
-from .fstring_prompts import *
\ No newline at end of file
+# Submodules are imported on first attribute access (PEP 562), so importing e.g.
+# `structured_rag.mock_gfl.fstring_prompts` does not pull in dspy or any provider SDK.
+import importlib
+from typing import Any, Dict, List
+
+_LAZY_EXPORTS: Dict[str, List[str]] = {
+    "dspy_program": ["dspy_Program"],
+    "dspy_signatures": ["GenerateResponse", "OPRO_JSON"],
+    "fstring_program": ["fstring_Program"],
+    "fstring_prompts": ["get_prompt", "PromptTemplate"],
+    "rate_limiter": ["PROVIDER_RATE_LIMITS", "RETRYABLE_STATUS_CODES", "RETRYABLE_ERROR_NAMES", "TransportError",
+                     "TokenBucket", "estimate_tokens", "is_retryable_error", "parse_retry_after", "RateLimiter",
+                     "configure_rate_limiter", "get_rate_limiter"],
+    "response_cache": ["DEFAULT_CACHE_PATH", "CacheMiss", "ResponseCache"],
+    "instrumentation": ["RequestTrace", "current_trace", "trace_request", "record_usage", "record_retry", "record_cache_hit"],
+    "streaming": ["IncrementalJSONValidator"],
+    "clients": ["POOL_SIZES", "PROVIDER_CLIENTS", "get_provider_client", "pooled_httpx_client", "get_openai_client",
+                "get_anthropic_client", "get_ollama_client", "get_gemini_model", "get_http_session"],
+    "health_check": ["DEFAULT_HEALTH_CHECK_PATH", "HEALTH_CHECK_TTL", "HealthCheckError", "HealthChecker", "say_hello"],
+}
+
+_attribute_to_module = {name: module for module, names in _LAZY_EXPORTS.items() for name in names}
+
+__all__ = list(_attribute_to_module)
+
+def __getattr__(name: str) -> Any:
+    module = _attribute_to_module.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    # Cache on the package so later lookups skip `__getattr__`
+    globals()[name] = value
+    return value
+
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,111 @@
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Connections kept open per provider host, keep these at or above the `MAX_CONCURRENCY` used for the provider
+POOL_SIZES = {
+    "openai": 64,
+    "anthropic": 32,
+    "ollama": 16,
+    "modal": 16,
+}
+KEEPALIVE_EXPIRY = 120.0 # seconds an idle connection is kept for reuse
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT = 600.0
+
+_clients: Dict[Tuple[Any, ...], Any] = {}
+_clients_lock = threading.Lock()
+
+def _get_or_create(key: Tuple[Any, ...], create: Callable[[], Any]) -> Any:
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = create()
+        return _clients[key]
+
+def _http2_available() -> bool:
+    # HTTP/2 in httpx needs the optional `h2` package (`pip install httpx[http2]`)
+    try:
+        import h2
+    except ImportError:
+        return False
+    return True
+
+def pooled_httpx_client(model_provider: str):
+    """An `httpx.Client` with keep-alive connections sized for `model_provider`, using HTTP/2 when available."""
+    import httpx
+
+    pool_size = POOL_SIZES[model_provider]
+    return httpx.Client(
+        http2=_http2_available(),
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=KEEPALIVE_EXPIRY),
+        timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+    )
+
+def get_openai_client(api_key: Optional[str]):
+    """The `openai.OpenAI` client shared by every program using `api_key`."""
+    import openai
+
+    return _get_or_create(("openai", api_key), lambda: openai.OpenAI(api_key=api_key, http_client=pooled_httpx_client("openai")))
+
+def get_anthropic_client(api_key: Optional[str]):
+    """The `anthropic.Anthropic` client shared by every program using `api_key`."""
+    import anthropic
+
+    return _get_or_create(("anthropic", api_key), lambda: anthropic.Anthropic(api_key=api_key, http_client=pooled_httpx_client("anthropic")))
+
+def get_ollama_client(host: Optional[str] = None):
+    """The `ollama.Client` shared by every program talking to `host` (defaults to `OLLAMA_HOST`)."""
+    import httpx
+    import ollama
+
+    # Ollama is served over plain HTTP/1.1 locally, so only the keep-alive pool is tuned
+    pool_size = POOL_SIZES["ollama"]
+    limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=KEEPALIVE_EXPIRY)
+    return _get_or_create(("ollama", host), lambda: ollama.Client(host=host, limits=limits))
+
+def get_gemini_model(model_name: str, api_key: Optional[str]):
+    """The `genai.GenerativeModel` shared by every program using `model_name`.
+
+    The Gemini SDK keeps one multiplexed gRPC channel per configured client, so reusing the
+    model (instead of re-running `genai.configure`) keeps that channel warm. `genai.configure`
+    sets the API key for the whole process, so Gemini clients can't be isolated per key: the
+    first `api_key` is configured once and asking for a different one raises a `ValueError`.
+    """
+    import google.generativeai as genai
+
+    with _clients_lock:
+        if ("google", "api_key") not in _clients:
+            genai.configure(api_key=api_key)
+            _clients[("google", "api_key")] = api_key
+        elif _clients[("google", "api_key")] != api_key:
+            raise ValueError("Gemini is already configured with a different API key, the SDK only supports one key per process")
+
+    return _get_or_create(("google", model_name), lambda: genai.GenerativeModel(model_name))
+
+def get_http_session(name: str = "modal"):
+    """A `requests.Session` with a connection pool sized by `POOL_SIZES[name]`, e.g. for the Modal endpoints."""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    def create():
+        session = requests.Session()
+        # Retries are left to the callers, so a failed batch is reported instead of silently re-sent
+        adapter = HTTPAdapter(pool_connections=POOL_SIZES[name], pool_maxsize=POOL_SIZES[name], max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    return _get_or_create(("session", name), create)
+
+# Provider -> shared client factory, each provider's SDK is only imported when its factory first runs
+PROVIDER_CLIENTS: Dict[str, Callable[[str, Optional[str]], Any]] = {
+    "openai": lambda model_name, api_key: get_openai_client(api_key),
+    "anthropic": lambda model_name, api_key: get_anthropic_client(api_key),
+    "google": get_gemini_model,
+    "ollama": lambda model_name, api_key: get_ollama_client(),
+}
+
+def get_provider_client(model_provider: str, model_name: str, api_key: Optional[str] = None) -> Any:
+    """The shared client (or Gemini model) that `fstring_Program` calls for `model_provider`."""
+    if model_provider not in PROVIDER_CLIENTS:
+        raise ValueError(f"Unsupported model provider: {model_provider}")
+    return PROVIDER_CLIENTS[model_provider](model_name, api_key)
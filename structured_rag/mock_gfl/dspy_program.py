@@ -1,18 +1,24 @@
 import dspy
 from typing import Optional, Any, Dict
 from structured_rag.mock_gfl.dspy_signatures import GenerateResponse, OPRO_JSON
+from structured_rag.mock_gfl.rate_limiter import get_rate_limiter, estimate_tokens
+from structured_rag.mock_gfl.response_cache import ResponseCache
 from pydantic import BaseModel
 
 class dspy_Program(dspy.Module):
     def __init__(self, 
                  test_params: Dict[str, str],
                  model_name: str, model_provider: str, api_key: Optional[str] = None,
-                 use_OPRO_JSON: bool = False) -> None:
+                 use_OPRO_JSON: bool = False, response_cache: Optional[ResponseCache] = None) -> None:
         super().__init__()
         self.test_params = test_params
         self.model_name = model_name
         self.model_provider = model_provider
         self.use_OPRO_JSON = use_OPRO_JSON
+        # DSPy only describes the response format in the prompt
+        self.constrained_outputs = False
+        self.rate_limiter = get_rate_limiter(self.model_provider)
+        self.response_cache = response_cache
         self.configure_llm(api_key)
         # ToDo, Interface `TypedPredictor` here
         if self.use_OPRO_JSON:
@@ -26,10 +32,7 @@ class dspy_Program(dspy.Module):
         elif self.model_provider == "google":
             llm = dspy.Google(model=self.model_name, api_key=api_key)
         elif self.model_provider == "openai":
-            import openai
-
-            openai.api_key = api_key
-            llm = dspy.OpenAI(model=self.model_name)
+            llm = dspy.OpenAI(model=self.model_name, api_key=api_key)
         elif self.model_provider == "anthropic":
             import anthropic
             llm = dspy.Claude(model=self.model_name, api_key=api_key)
@@ -37,18 +40,28 @@ class dspy_Program(dspy.Module):
         else:
             raise ValueError(f"Unsupported model provider: {self.model_provider}")
 
-        print("Running LLM connection test (say hello)...")
-        print(llm("say hello"))
+        # Connectivity is checked once per sweep by `HealthChecker`, not per program
         dspy.settings.configure(lm=llm)
 
     # Note, this needs to be cleaned up with the abstraction around DSPy / LLM APIs
     def forward(self, output_model: Optional[BaseModel], test: str, question: str, context: Optional[str] = "", answer: Optional[str] = "") -> Any:
         references = {"context": context, "question": question, "answer": answer}
         references = "".join(f"{k}: {v}" for k, v in references.items())
-        response = self.generate_response(
-            task_instructions=self.test_params['task_instructions'],
-            response_format=self.test_params['response_format'],
-            references=references
-        ).response
+        def call_llm() -> str:
+            return self.rate_limiter.call(
+                lambda: self.generate_response(
+                    task_instructions=self.test_params['task_instructions'],
+                    response_format=self.test_params['response_format'],
+                    references=references
+                ).response,
+                estimated_tokens=estimate_tokens(references)
+            )
 
-        return response
\ No newline at end of file
+        if self.response_cache is None:
+            return call_llm()
+        # DSPy renders the final prompt itself, so key on everything that goes into it
+        signature = OPRO_JSON if self.use_OPRO_JSON else GenerateResponse
+        prompt = "\n".join([signature.__name__, signature.__doc__, self.test_params['task_instructions'], self.test_params['response_format'], references])
+        temperature = dspy.settings.lm.kwargs.get("temperature")
+        cache_key = ResponseCache.make_key(self.model_provider, self.model_name, prompt, temperature=temperature)
+        return self.response_cache.get_or_call(cache_key, call_llm)
\ No newline at end of file
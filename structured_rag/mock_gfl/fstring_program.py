@@ -1,60 +1,30 @@
-from typing import Optional, Dict
-import ollama
-import google.generativeai as genai
-import openai
+import time
+from typing import Optional, Dict, Iterator
+from structured_rag.mock_gfl.clients import get_provider_client
 from structured_rag.mock_gfl.fstring_prompts import get_prompt
+from structured_rag.mock_gfl.rate_limiter import get_rate_limiter, estimate_tokens
+from structured_rag.mock_gfl.response_cache import ResponseCache
+from structured_rag.mock_gfl.instrumentation import current_trace, record_usage
+from structured_rag.mock_gfl.streaming import IncrementalJSONValidator
 from pydantic import BaseModel
-import json
 
 class fstring_Program():
     def __init__(self,
                  test_params: Dict[str, str], structured_outputs: bool,
-                 model_name: str, model_provider: str, api_key: Optional[str]) -> None:
+                 model_name: str, model_provider: str, api_key: Optional[str],
+                 response_cache: Optional[ResponseCache] = None, stream: bool = False) -> None:
         self.test_params = test_params
         self.model_name = model_name
         self.model_provider = model_provider
         self.structured_outputs = structured_outputs
-        if self.model_provider == "google":
-            genai.configure(api_key=api_key)
-            self.model = genai.GenerativeModel(self.model_name)
-        elif self.model_provider == "openai":
-            import openai
-            self.model = openai.OpenAI(api_key=api_key)
-        elif self.model_provider == "anthropic":
-            import anthropic
-            self.model = anthropic.Anthropic(api_key=api_key)
-        print("Running LLM connection test (say hello)...")
-        print(self.test_connection())
-
-    def test_connection(self) -> str:
-        # For now this tests without structured outputs, could be an idea to add this
-        connection_prompt = "say hello"
-        print(f"Saying hello to {self.model_provider}'s {self.model_name}...\n")
-        if self.model_provider == "google":
-            # how to add a BaseModel to this?
-            response = self.model.generate_content(connection_prompt)
-            return response.text
-        elif self.model_provider == "ollama":
-            response = ollama.chat(model=self.model_name, messages=[{"role": "user", "content": connection_prompt}])
-            return response['message']['content']
-        elif self.model_provider == "openai":
-            response = self.model.chat.completions.create(
-                model=self.model_name,
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {"role": "user", "content": connection_prompt}
-                ]
-            )
-            return response.choices[0].message.content
-        elif self.model_provider == "anthropic":
-            response = self.model.messages.create(
-                model=self.model_name,
-                max_tokens=2048,
-                messages=[
-                    {"role": "user", "content": connection_prompt}
-                ]
-            )
-            return response.content[0].text
+        # Only Google and OpenAI constrain the response to `output_model`, so only their responses have its shape
+        self.constrained_outputs = self.structured_outputs and self.model_provider in ["google", "openai"]
+        # OpenAI structured outputs are parsed from the full response, so they are never streamed
+        self.stream = stream and not (self.structured_outputs and self.model_provider == "openai")
+        self.rate_limiter = get_rate_limiter(self.model_provider)
+        self.response_cache = response_cache
+        # Clients are shared across programs, so pooled connections stay warm between tests
+        self.model = get_provider_client(self.model_provider, self.model_name, api_key)
 
     def forward(self, output_model: Optional[BaseModel], test: str, 
                 context: str = "", question: str = "", answer: str = "", 
@@ -69,12 +39,30 @@ class fstring_Program():
 
         prompt = get_prompt(test, references, self.test_params)
 
+        # 429s and other transport errors are retried here so they are never scored as format failures
+        def call_llm() -> str:
+            return self.rate_limiter.call(lambda: self.generate(prompt, output_model), estimated_tokens=estimate_tokens(prompt))
+
+        if self.response_cache is None:
+            return call_llm()
+        # The output model only changes the response when it is sent as a structured output schema
+        schema = output_model.schema() if self.structured_outputs and output_model is not None else None
+        # Streamed responses may be cut short, so they must not be replayed for complete runs
+        variant = "stream" if self.stream else None
+        cache_key = ResponseCache.make_key(self.model_provider, self.model_name, prompt, temperature=None, schema=schema, variant=variant)
+        return self.response_cache.get_or_call(cache_key, call_llm)
+
+    def generate(self, prompt: str, output_model: Optional[BaseModel]) -> str:
+        if self.stream:
+            return self.generate_streaming(prompt, output_model)
         if self.model_provider == "ollama":
             # ToDo, add structured outputs to Ollama
-            response = ollama.chat(model=self.model_name, messages=[{"role": "user", "content": prompt}])
+            response = self.model.chat(model=self.model_name, messages=[{"role": "user", "content": prompt}])
+            self.record_response_usage(response)
             return response['message']['content']
         elif self.model_provider == "google":
             if self.structured_outputs:
+                import google.generativeai as genai
                 response = self.model.generate_content(
                     prompt,
                     generation_config=genai.GenerationConfig(
@@ -83,6 +71,7 @@ class fstring_Program():
                 )
             else:
                 response = self.model.generate_content(prompt)
+            self.record_response_usage(response)
             return response.text
         elif self.model_provider == "openai":
             if self.structured_outputs:
@@ -98,9 +87,10 @@ class fstring_Program():
                     ],
                     response_format=output_model
                 )
+                self.record_response_usage(response)
                 parsed_response = response.choices[0].message.parsed
-                # Convert the parsed response to JSON for the parsing later on
-                json_response = json.dumps({key: value for key, value in parsed_response.__dict__.items()})
+                # Convert the parsed response to JSON for the parsing later on, using the keys the task asks for
+                json_response = parsed_response.json(by_alias=True)
                 print(f"\n JSON RESPONSE: \n {json_response}\n")
                 return json_response
             else:
@@ -111,6 +101,7 @@ class fstring_Program():
                         {"role": "user", "content": prompt}
                     ]
                 )
+                self.record_response_usage(response)
                 return response.choices[0].message.content
         elif self.model_provider == "anthropic":
             response = self.model.messages.create(
@@ -120,4 +111,100 @@ class fstring_Program():
                     {"role": "user", "content": prompt}
                 ]
             )
-            return response.content[0].text
\ No newline at end of file
+            self.record_response_usage(response)
+            return response.content[0].text
+
+    def record_response_usage(self, response) -> None:
+        """Record input / output token counts from the provider's usage metadata on the current request."""
+        if self.model_provider == "ollama":
+            record_usage(response.get('prompt_eval_count'), response.get('eval_count'))
+        elif self.model_provider == "google":
+            usage = getattr(response, "usage_metadata", None)
+            if usage:
+                record_usage(usage.prompt_token_count, usage.candidates_token_count)
+        elif self.model_provider == "openai":
+            usage = getattr(response, "usage", None)
+            if usage:
+                record_usage(usage.prompt_tokens, usage.completion_tokens)
+        elif self.model_provider == "anthropic":
+            record_usage(response.usage.input_tokens, response.usage.output_tokens)
+
+    def stream_chunks(self, prompt: str, output_model: Optional[BaseModel]) -> Iterator[str]:
+        """Yield the response text as the provider streams it. Closing the generator cancels the request."""
+        if self.model_provider == "ollama":
+            for chunk in self.model.chat(model=self.model_name, messages=[{"role": "user", "content": prompt}], stream=True):
+                if chunk.get('done'):
+                    self.record_response_usage(chunk)
+                yield chunk['message']['content']
+        elif self.model_provider == "google":
+            if self.structured_outputs:
+                import google.generativeai as genai
+                response = self.model.generate_content(
+                    prompt,
+                    generation_config=genai.GenerationConfig(
+                        response_mime_type="application/json", response_schema=output_model
+                    ),
+                    stream=True
+                )
+            else:
+                response = self.model.generate_content(prompt, stream=True)
+            for chunk in response:
+                self.record_response_usage(chunk)
+                yield chunk.text
+        elif self.model_provider == "openai":
+            stream = self.model.chat.completions.create(
+                model=self.model_name,
+                messages=[
+                    {"role": "system", "content": "You are a helpful assistant."},
+                    {"role": "user", "content": prompt}
+                ],
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            try:
+                for chunk in stream:
+                    if chunk.usage:
+                        self.record_response_usage(chunk)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            finally:
+                stream.close()
+        elif self.model_provider == "anthropic":
+            with self.model.messages.stream(
+                model=self.model_name,
+                max_tokens=2048,
+                messages=[
+                    {"role": "user", "content": prompt}
+                ]
+            ) as stream:
+                yield from stream.text_stream
+                self.record_response_usage(stream.get_final_message())
+
+    def generate_streaming(self, prompt: str, output_model: Optional[BaseModel]) -> str:
+        """Stream the response through an incremental JSON check and stop as soon as it provably fails.
+
+        The truncated text is returned, so the response is still scored as a failure downstream.
+        """
+        trace = current_trace.get()
+        # A constrained response has the shape of `output_model`, which is always an object
+        expect_array = not self.constrained_outputs and self.test_params['response_format'].lstrip().startswith("[")
+        validator = IncrementalJSONValidator(expect_array=expect_array)
+        request_start = time.perf_counter()
+        response = ""
+        chunks = self.stream_chunks(prompt, output_model)
+        try:
+            for chunk in chunks:
+                if trace is not None and trace.time_to_first_token is None:
+                    trace.time_to_first_token = time.perf_counter() - request_start
+                response += chunk
+                if not validator.feed(chunk):
+                    print(f"Aborting stream early: {validator.error}")
+                    if trace is not None:
+                        trace.aborted_early = True
+                        trace.abort_reason = validator.error
+                    break
+                if trace is not None and trace.time_to_first_valid_token is None and validator.started:
+                    trace.time_to_first_valid_token = time.perf_counter() - request_start
+        finally:
+            chunks.close()
+        return response
@@ -1,9 +1,48 @@
-from typing import Dict
+import hashlib
+from typing import Dict, Iterable, List, Optional
 
-def get_prompt(test: str, references: Dict[str, str], test_params: Dict[str, str]) -> str:
-    references_str = ' | '.join(f"{k}: {v}" for k, v in references.items())
+def _references_str(references: Dict[str, str]) -> str:
+    return ' | '.join(f"{k}: {v}" for k, v in references.items())
+
+class PromptTemplate:
+    """`get_prompt` compiled for one test, for rendering prompts in bulk.
 
-    return f"""Instructions: {test_params['task_instructions']}
-    References: {references_str}
+    Everything ahead of the per-item references is rendered once into `prefix`: the optional
+    `chat_prefix` (e.g. a chat template preface), the instructions and the `shared_references`
+    every item of a batch has in common (e.g. SuperBEIR's class descriptions), which come first
+    so they are part of the prefix. `render` only formats the per-item suffix, and
+    `prefix + render(references)` equals
+    `chat_prefix + get_prompt(test, {**shared_references, **references}, test_params) + chat_suffix`.
+    """
+    def __init__(self, test: str, test_params: Dict[str, str], shared_references: Optional[Dict[str, str]] = None,
+                 chat_prefix: str = "", chat_suffix: str = "") -> None:
+        self.test = test
+        shared_references_str = f"{_references_str(shared_references)} | " if shared_references else ""
+        self.prefix = f"""{chat_prefix}Instructions: {test_params['task_instructions']}
+    References: {shared_references_str}"""
+        self.suffix_tail = f"""
     Output the result as a JSON string with the following format: {test_params['response_format']}
-    IMPORTANT!! Do not start the JSON with ```json or end it with ```."""
\ No newline at end of file
+    IMPORTANT!! Do not start the JSON with ```json or end it with ```.{chat_suffix}"""
+        self._prefix_id = None
+
+    @property
+    def prefix_id(self) -> str:
+        """Content hash of `prefix`, so equal prefixes of different templates or batches share one id."""
+        if self._prefix_id is None:
+            self._prefix_id = hashlib.sha256(self.prefix.encode("utf-8")).hexdigest()[:16]
+        return self._prefix_id
+
+    def render(self, references: Dict[str, str]) -> str:
+        """The prompt for `references` without `prefix`."""
+        return _references_str(references) + self.suffix_tail
+
+    def render_prompt(self, references: Dict[str, str]) -> str:
+        return self.prefix + self.render(references)
+
+    def render_all(self, items: Iterable[Dict[str, str]]) -> List[str]:
+        """The suffixes of every item's prompt, the prefix is sent once as `{prefix_id: prefix}`."""
+        suffix_tail = self.suffix_tail
+        return [_references_str(references) + suffix_tail for references in items]
+
+def get_prompt(test: str, references: Dict[str, str], test_params: Dict[str, str]) -> str:
+    return PromptTemplate(test, test_params).render_prompt(references)
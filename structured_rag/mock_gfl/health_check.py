@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, Tuple
+
+from structured_rag.mock_gfl.clients import get_provider_client
+from structured_rag.mock_gfl.rate_limiter import get_rate_limiter
+from structured_rag.mock_gfl.response_cache import DEFAULT_CACHE_PATH
+
+DEFAULT_HEALTH_CHECK_PATH = os.path.join(os.path.dirname(DEFAULT_CACHE_PATH), "health_checks.json")
+HEALTH_CHECK_TTL = 30 * 60 # seconds a successful check is trusted for
+
+class HealthCheckError(Exception):
+    """Raised when one or more (provider, model) pairs fail their health check."""
+
+def say_hello(model_provider: str, model_name: str, api_key: Optional[str] = None) -> str:
+    """Send a minimal "say hello" completion through the shared client for `model_provider`."""
+    client = get_provider_client(model_provider, model_name, api_key)
+    connection_prompt = "say hello"
+    if model_provider == "google":
+        return client.generate_content(connection_prompt).text
+    elif model_provider == "ollama":
+        response = client.chat(model=model_name, messages=[{"role": "user", "content": connection_prompt}])
+        return response['message']['content']
+    elif model_provider == "openai":
+        response = client.chat.completions.create(
+            model=model_name,
+            messages=[{"role": "user", "content": connection_prompt}]
+        )
+        return response.choices[0].message.content
+    elif model_provider == "anthropic":
+        response = client.messages.create(
+            model=model_name,
+            max_tokens=16,
+            messages=[{"role": "user", "content": connection_prompt}]
+        )
+        return response.content[0].text
+    raise ValueError(f"Unsupported model provider: {model_provider}")
+
+class HealthChecker:
+    """Concurrent provider health checks, with successes cached on disk per (provider, model, API key) for `ttl` seconds.
+
+    Programs no longer say hello on construction, a sweep calls `check_all` once up front instead.
+    """
+    def __init__(self, path: str = DEFAULT_HEALTH_CHECK_PATH, ttl: float = HEALTH_CHECK_TTL) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.checked_at: Dict[str, float] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self.checked_at = json.load(f)
+            except (OSError, ValueError):
+                self.checked_at = {}
+
+    @staticmethod
+    def make_key(model_provider: str, model_name: str, api_key: Optional[str] = None) -> str:
+        # A check only vouches for the credential it was made with, which is stored as a hash, never in plain text
+        key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16] if api_key else "default"
+        return f"{model_provider}/{model_name}/{key_hash}"
+
+    def is_fresh(self, model_provider: str, model_name: str, api_key: Optional[str] = None) -> bool:
+        with self.lock:
+            checked_at = self.checked_at.get(self.make_key(model_provider, model_name, api_key))
+        return checked_at is not None and time.time() - checked_at < self.ttl
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.checked_at, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def check(self, model_provider: str, model_name: str, api_key: Optional[str] = None) -> None:
+        """Raise `HealthCheckError` unless (provider, model, API key) passed a check within the TTL or passes one now."""
+        if self.is_fresh(model_provider, model_name, api_key):
+            print(f"Health check for {model_provider}'s {model_name} cached, skipping")
+            return
+        print(f"Saying hello to {model_provider}'s {model_name}...")
+        try:
+            response = get_rate_limiter(model_provider).call(lambda: say_hello(model_provider, model_name, api_key))
+        except Exception as e:
+            raise HealthCheckError(f"{model_provider}'s {model_name} failed its health check: {e}") from e
+        print(f"{model_provider}'s {model_name} says: {response}")
+        with self.lock:
+            self.checked_at[self.make_key(model_provider, model_name, api_key)] = time.time()
+            self._save()
+
+    def check_all(self, targets: Iterable[Tuple[str, str, Optional[str]]], max_workers: int = 8) -> None:
+        """Check every `(model_provider, model_name, api_key)` concurrently, raising once with all failures."""
+        unique_targets = set(targets)
+        if not unique_targets:
+            return
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(unique_targets))) as executor:
+            futures = [executor.submit(self.check, model_provider, model_name, api_key)
+                       for model_provider, model_name, api_key in unique_targets]
+        errors = [str(future.exception()) for future in futures if future.exception() is not None]
+        if errors:
+            raise HealthCheckError("\n".join(errors))
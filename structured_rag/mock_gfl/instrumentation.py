@@ -0,0 +1,50 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Iterator, Optional
+
+@dataclass
+class RequestTrace:
+    """Measurements for a single `forward` call, filled in by the programs as the request runs."""
+    start_time: float = field(default_factory=time.perf_counter)
+    latency: Optional[float] = None
+    time_to_first_token: Optional[float] = None
+    time_to_first_valid_token: Optional[float] = None
+    aborted_early: bool = False
+    abort_reason: Optional[str] = None
+    input_tokens: Optional[int] = None
+    output_tokens: Optional[int] = None
+    num_retries: int = 0
+    # Served from the response cache, so its latency is not the provider's
+    cached: bool = False
+
+# The trace for the request running in the current thread / task, if any
+current_trace: ContextVar[Optional[RequestTrace]] = ContextVar("current_trace", default=None)
+
+@contextmanager
+def trace_request() -> Iterator[RequestTrace]:
+    trace = RequestTrace()
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        trace.latency = time.perf_counter() - trace.start_time
+        current_trace.reset(token)
+
+def record_usage(input_tokens: Optional[int], output_tokens: Optional[int]) -> None:
+    """Record token counts from the provider's usage metadata on the current request, if it is traced."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.input_tokens = input_tokens
+        trace.output_tokens = output_tokens
+
+def record_retry() -> None:
+    trace = current_trace.get()
+    if trace is not None:
+        trace.num_retries += 1
+
+def record_cache_hit() -> None:
+    trace = current_trace.get()
+    if trace is not None:
+        trace.cached = True
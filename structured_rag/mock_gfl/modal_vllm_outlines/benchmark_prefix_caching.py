@@ -0,0 +1,87 @@
+# Measures prefill throughput and end-to-end batch time of the SuperBEIR classification prompts with
+# and without prefix reuse, each configuration on a fresh engine on the same GPU type.
+#
+#   modal run benchmark_prefix_caching.py --samples 340 --repeats 3
+import time
+
+from vllm_outlines_setup import (
+    GPU_CONFIG, MAX_OUTPUT_LEN, MINUTES, MODELS_DIR, app, build_engine_args, engine_config, structured_rag_mount, volume
+)
+
+# Name -> (engine config overrides, prefill the shared prefix once before each batch)
+BENCHMARK_CONFIGS = {
+    "no_prefix_reuse": ({"enable_prefix_caching": False}, False),
+    "prefix_caching": ({"enable_prefix_caching": True}, False),
+    "prefix_caching+prefill": ({"enable_prefix_caching": True}, True),
+}
+
+@app.function(gpu=GPU_CONFIG, timeout=30 * MINUTES, volumes={MODELS_DIR: volume}, mounts=[structured_rag_mount])
+def benchmark_engine(config: dict, prefill_prefix: bool, prefix: str, suffixes: list[str], repeats: int,
+                     output_model: dict = None) -> list[dict]:
+    """Run the batch `prefix + suffix` for every suffix `repeats` times on a new engine, returning the metrics of each run."""
+    from vllm import LLMEngine, SamplingParams
+    from outlines.integrations.vllm import JSONLogitsProcessor
+
+    volume.reload()
+    engine = LLMEngine.from_engine_args(build_engine_args(config))
+    logits_processor = JSONLogitsProcessor(schema=output_model, llm=engine) if output_model else None
+
+    runs = []
+    for repeat in range(repeats):
+        if logits_processor is not None and hasattr(logits_processor, "_fsm_state"):
+            logits_processor._fsm_state.clear()
+        start_time = time.time()
+        if prefill_prefix:
+            engine.add_request(f"prefix-{repeat}", prefix, SamplingParams(max_tokens=1, temperature=0))
+            while engine.has_unfinished_requests():
+                engine.step()
+        for index, suffix in enumerate(suffixes):
+            sampling_params = SamplingParams(
+                max_tokens=MAX_OUTPUT_LEN,
+                temperature=0,
+                logits_processors=[logits_processor] if logits_processor is not None else []
+            )
+            engine.add_request(f"{repeat}-{index}", prefix + suffix, sampling_params)
+
+        outputs = []
+        while engine.has_unfinished_requests():
+            outputs.extend(output for output in engine.step() if output.finished)
+        batch_time = time.time() - start_time
+
+        # Prefill ends when the last request of the batch has its first token
+        prefill_time = max(output.metrics.first_token_time for output in outputs) - start_time
+        prompt_tokens = sum(len(output.prompt_token_ids) for output in outputs)
+        runs.append({
+            "batch_time": batch_time,
+            "prefill_time": prefill_time,
+            "prompt_tokens": prompt_tokens,
+            "prefill_tokens_per_second": prompt_tokens / prefill_time,
+            "output_tokens": sum(len(output.outputs[0].token_ids) for output in outputs),
+        })
+        print(f"Run {repeat}: {runs[-1]}")
+    return runs
+
+@app.local_entrypoint()
+def main(samples: int = 340, repeats: int = 3, with_outlines: bool = True):
+    from structured_rag.run_test.run_scripts.run_batch_test import build_batch_prompts, get_batch_response_model, load_batch_dataset
+
+    test_type = "ClassifyDocument"
+    dataset, categories, formatted_categories = load_batch_dataset("SuperBEIR")
+    template, suffixes = build_batch_prompts(test_type, dataset.head(samples), formatted_categories)
+    output_model = get_batch_response_model(test_type, categories).schema() if with_outlines else None
+    print(f"{len(suffixes)} prompts, shared prefix of {len(template.prefix)} characters")
+
+    results = {}
+    for name, (config, prefill_prefix) in BENCHMARK_CONFIGS.items():
+        print(f"Benchmarking {name}: {engine_config(**config)}, prefill prefix: {prefill_prefix}")
+        results[name] = benchmark_engine.remote(config, prefill_prefix, template.prefix, suffixes, repeats, output_model)
+
+    # Speedups are relative to the mean batch time without prefix reuse. With prefix caching, runs
+    # after the first also reuse the prefix cached by the previous run, like consecutive sweep batches.
+    baseline_runs = results["no_prefix_reuse"]
+    baseline = sum(run["batch_time"] for run in baseline_runs) / len(baseline_runs)
+    print(f"\n{'config':<24} {'run':>4} {'batch time (s)':>15} {'prefill time (s)':>17} {'prefill tok/s':>14} {'speedup':>8}")
+    for name, runs in results.items():
+        for repeat, run in enumerate(runs):
+            print(f"{name:<24} {repeat:>4} {run['batch_time']:>15.2f} {run['prefill_time']:>17.2f} "
+                  f"{run['prefill_tokens_per_second']:>14.0f} {baseline / run['batch_time']:>7.2f}x")
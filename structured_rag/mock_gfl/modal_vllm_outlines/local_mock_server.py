@@ -0,0 +1,141 @@
+# A CPU-only stand-in for the Modal vLLM server, speaking the same payload contract as `generate_web`
+# (`prompts`, `with_outlines`, `output_model`) so the client side of `run_batch_test` can be benchmarked
+# and regression tested without a GPU or network access.
+#
+# POST /        -> JSON list of {"id", "answer"} once the whole batch is done (like `generate_web`)
+# POST /stream  -> NDJSON, one {"id", "response"} per line as each request finishes (like `generate_web_stream`)
+#
+# Both also accept mixed-task batches, `{"requests": [{"id", "prompt", "output_model"}, ...]}`.
+
+import argparse
+import hashlib
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+class MockConfig:
+    def __init__(self, latency: float = 0.5, latency_jitter: float = 0.5, failure_rate: float = 0.0,
+                 invalid_rate: float = 0.0, replay_file: Optional[str] = None, seed: int = 0) -> None:
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.failure_rate = failure_rate
+        self.invalid_rate = invalid_rate
+        self.seed = seed
+        self.replayed_responses: List[str] = []
+        if replay_file:
+            # Replay the responses of a saved `Experiment`, by position in the batch
+            with open(replay_file, "r") as f:
+                self.replayed_responses = [r["response"] for r in json.load(f)["all_responses"]]
+
+def _resolve_ref(schema: Dict[str, Any], root: Dict[str, Any]) -> Dict[str, Any]:
+    while "$ref" in schema:
+        # Only local references, e.g. "#/$defs/GenerateAnswerWithConfidence"
+        path = schema["$ref"].lstrip("#/").split("/")
+        schema = root
+        for part in path:
+            schema = schema[part]
+    return schema
+
+def example_from_schema(schema: Dict[str, Any], rng: random.Random, root: Optional[Dict[str, Any]] = None) -> Any:
+    """Build a value that conforms to `schema`, chosen deterministically from `rng`."""
+    root = root or schema
+    schema = _resolve_ref(schema, root)
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    for key in ("anyOf", "oneOf", "allOf"):
+        if key in schema:
+            return example_from_schema(schema[key][0], rng, root)
+    schema_type = schema.get("type", "string")
+    if schema_type == "object":
+        return {name: example_from_schema(prop, rng, root) for name, prop in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        return [example_from_schema(schema.get("items", {}), rng, root) for _ in range(3)]
+    if schema_type == "integer":
+        return rng.randint(0, 5)
+    if schema_type == "number":
+        return float(rng.randint(0, 10)) / 2
+    if schema_type == "boolean":
+        return rng.random() < 0.5
+    if schema_type == "null":
+        return None
+    return f"mock response {rng.randint(0, 9999)}"
+
+def generate_response(config: MockConfig, index: int, prompt: str, output_model: Optional[Dict[str, Any]]) -> str:
+    # Seeded by the prompt, so the same prompt always gets the same response
+    prompt_seed = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8], 16)
+    rng = random.Random(config.seed + prompt_seed)
+    if config.replayed_responses:
+        return config.replayed_responses[index % len(config.replayed_responses)]
+    if rng.random() < config.invalid_rate:
+        return "```json\n" + json.dumps({"mock": "invalid"}) + "\n```"
+    if output_model is None:
+        return "Mock response without structured outputs."
+    return json.dumps(example_from_schema(output_model, rng))
+
+def plan_batch(config: MockConfig, data: Dict[str, Any]) -> List[Tuple[float, str, str]]:
+    """Return `(finish_time, id, response)` for each prompt, in the order the requests finish."""
+    if "requests" in data:
+        requests = data["requests"]
+    else:
+        output_model = data.get("output_model") if data.get("with_outlines") else None
+        requests = [{"id": str(index), "prompt": prompt, "output_model": output_model, "prefix_id": data.get("prefix_id")}
+                    for index, prompt in enumerate(data["prompts"])]
+    prefixes = data.get("prefixes") or {}
+    results = []
+    for index, request in enumerate(requests):
+        finish_time = config.latency * (1 + random.uniform(0, config.latency_jitter))
+        prompt = prefixes.get(request.get("prefix_id"), "") + request["prompt"]
+        response = generate_response(config, index, prompt, request.get("output_model"))
+        results.append((finish_time, str(request["id"]), response))
+    return sorted(results)
+
+def make_handler(config: MockConfig):
+    class MockHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if random.random() < config.failure_rate:
+                self.send_response(500)
+                self.end_headers()
+                self.wfile.write(b"Injected failure")
+                return
+
+            results = plan_batch(config, data)
+            start_time = time.perf_counter()
+            if self.path.rstrip("/") == "/stream":
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.end_headers()
+                for finish_time, request_id, response in results:
+                    time.sleep(max(0.0, finish_time - (time.perf_counter() - start_time)))
+                    self.wfile.write((json.dumps({"id": request_id, "response": response}) + "\n").encode("utf-8"))
+                    self.wfile.flush()
+            else:
+                if results:
+                    time.sleep(results[-1][0])
+                body = json.dumps([{"id": request_id, "answer": response} for _, request_id, response in results])
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body.encode("utf-8"))))
+                self.end_headers()
+                self.wfile.write(body.encode("utf-8"))
+
+    return MockHandler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local mock of the Modal vLLM batch endpoints")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.5, help="Base seconds until a request finishes")
+    parser.add_argument("--latency-jitter", type=float, default=0.5, help="Extra latency as a fraction of --latency")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Probability that a whole batch returns HTTP 500")
+    parser.add_argument("--invalid-rate", type=float, default=0.0, help="Probability that a response is fenced, invalid JSON")
+    parser.add_argument("--replay-file", type=str, default=None, help="Experiment JSON whose responses are replayed")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = MockConfig(latency=args.latency, latency_jitter=args.latency_jitter, failure_rate=args.failure_rate,
+                        invalid_rate=args.invalid_rate, replay_file=args.replay_file, seed=args.seed)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(config))
+    print(f"Mock vLLM server listening on http://127.0.0.1:{args.port} (streaming at /stream)")
+    server.serve_forever()
@@ -1,6 +1,9 @@
+import json
+
 import modal
 import modal.gpu
 from fastapi import Depends, HTTPException, status
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 
 from vllm_outlines_setup import Model, app
@@ -23,7 +26,35 @@ def generate_web(
     data: dict, token: HTTPAuthorizationCredentials = Depends(auth_scheme)
 ):
     import os
+    # Shared prompt prefixes are sent once as `prefixes` and referenced by `prefix_id`
+    prefixes = data.get("prefixes")
+    # Mixed-task batches send `requests` with a per-request `output_model` instead of `prompts`
+    if "requests" in data:
+        return Model.generate_mixed.remote(data["requests"], settings=None, prefixes=prefixes)
     if data["with_outlines"] == True:
-        return Model.generate_with_outlines.remote(data["prompts"], data["output_model"], settings=None)
+        return Model.generate_with_outlines.remote(data["prompts"], data["output_model"], settings=None,
+                                                   prefixes=prefixes, prefix_id=data.get("prefix_id"))
+    else:
+        return Model.generate.remote_gen(data["prompts"], settings=None, prefixes=prefixes, prefix_id=data.get("prefix_id"))
+
+
+@app.function(
+    image=web_image,
+    container_idle_timeout=MINUTE
+    * 20,  # keeps web container alive for 20 minutes (the max)
+)
+@modal.web_endpoint(method="POST")
+def generate_web_stream(
+    data: dict, token: HTTPAuthorizationCredentials = Depends(auth_scheme)
+):
+    """Same payload as `generate_web` (Outlines only), streams one `{"id", "response"}` JSON object per line as each request finishes."""
+    prefixes = data.get("prefixes")
+    if "requests" in data:
+        results = Model.generate_mixed_stream.remote_gen(data["requests"], settings=None, prefixes=prefixes)
     else:
-        return Model.generate.remote_gen(data["prompts"], settings=None)
\ No newline at end of file
+        results = Model.generate_with_outlines_stream.remote_gen(data["prompts"], data["output_model"], settings=None,
+                                                                 prefixes=prefixes, prefix_id=data.get("prefix_id"))
+    return StreamingResponse(
+        (json.dumps(result) + "\n" for result in results),
+        media_type="application/x-ndjson"
+    )
@@ -1,3 +1,7 @@
+import hashlib
+import json
+import time
+
 import modal
 
 vllm_image = modal.Image.debian_slim(python_version="3.10").pip_install(
@@ -28,43 +32,141 @@ DTYPE = "float16"
 MAX_INPUT_LEN = 2048
 MAX_OUTPUT_LEN = 512
 
+# vLLM engine configuration, see `build_engine_args` and `benchmark_prefix_caching.py`
+ENABLE_PREFIX_CACHING = True # requests sharing a prompt prefix (instructions, class descriptions) reuse its KV cache blocks
+ENABLE_CHUNKED_PREFILL = False # split long prefills into chunks scheduled together with decodes
+MAX_NUM_BATCHED_TOKENS = None # tokens per engine step, None for vLLM's default
+MAX_NUM_SEQS = 256 # sequences per engine step
+PREFILL_SHARED_PREFIXES = True # prefill each shared prefix once before adding a batch, only with prefix caching
+
 app = modal.App("example-vllm-outlines", image=vllm_image)
 
+# `structured_rag.models` is mounted so the task schemas can be compiled when the container starts
+structured_rag_mount = modal.Mount.from_local_python_packages("structured_rag")
+
+def engine_config(**overrides) -> dict:
+    """The configurable `EngineArgs` fields, with `overrides` applied to the defaults above."""
+    config = {
+        "enable_prefix_caching": ENABLE_PREFIX_CACHING,
+        "enable_chunked_prefill": ENABLE_CHUNKED_PREFILL,
+        "max_num_batched_tokens": MAX_NUM_BATCHED_TOKENS,
+        "max_num_seqs": MAX_NUM_SEQS,
+    }
+    unknown = set(overrides) - set(config)
+    if unknown:
+        raise ValueError(f"Unknown engine config fields: {sorted(unknown)}")
+    config.update(overrides)
+    return config
+
+def build_engine_args(config: dict = None):
+    from vllm import EngineArgs
+
+    return EngineArgs(
+        model=MODELS_DIR,
+        tensor_parallel_size=N_GPUS,
+        gpu_memory_utilization=0.9,
+        max_model_len=8096,
+        enforce_eager=False,
+        dtype=DTYPE,
+        **engine_config(**(config or {})),
+    )
+
+def schema_hash(schema) -> str:
+    """Hash of the canonical form of a JSON schema, so equal schemas share one compiled processor."""
+    if isinstance(schema, str):
+        schema = json.loads(schema)
+    elif not isinstance(schema, dict):
+        schema = schema.schema()
+    return hashlib.sha256(json.dumps(schema, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
 from pydantic import BaseModel
 class Answer(BaseModel):
     answer: str
     confidence_rating: float
 
 @app.cls(
-    gpu=GPU_CONFIG, container_idle_timeout=1 * MINUTES, volumes={MODELS_DIR: volume}
+    gpu=GPU_CONFIG, container_idle_timeout=1 * MINUTES, volumes={MODELS_DIR: volume}, mounts=[structured_rag_mount]
 )
 class Model:
     @modal.enter()
     def load(self):
         """Loads the VLLM engine and configures our tokenizer."""
 
-        from vllm import EngineArgs, LLMEngine, SamplingParams
+        from vllm import LLMEngine, SamplingParams
         from outlines.integrations.vllm import JSONLogitsProcessor
         import vllm
 
         volume.reload()
 
-        engine_args = EngineArgs(
-            model=MODELS_DIR,
-            tensor_parallel_size=N_GPUS,
-            gpu_memory_utilization=0.9,
-            max_model_len=8096,
-            enforce_eager=False,
-            dtype=DTYPE,
-        )
+        engine_args = build_engine_args()
+        print(f"Engine config: {engine_config()}")
 
         self.engine = LLMEngine.from_engine_args(engine_args)
 
+        # Compiled Outlines logits processors, keyed by `schema_hash`
+        self.logits_processors = {}
+        self.warm_logits_processors()
+
+    def warm_logits_processors(self):
+        """Compile the regex / FSM for every StructuredRAG task schema up front."""
+        from structured_rag.models import test_to_output_model
+
+        start_time = time.perf_counter()
+        for test_type, output_model in test_to_output_model.items():
+            try:
+                self.get_logits_processor(output_model.schema())
+            except Exception as e:
+                print(f"Could not compile logits processor for {test_type}: {e}")
+        print(f"Warmed {len(self.logits_processors)} logits processors in {time.perf_counter() - start_time:.2f}s")
+
+    def get_logits_processor(self, output_model):
+        """Return the compiled `JSONLogitsProcessor` for `output_model`, compiling it on first use."""
+        from outlines.integrations.vllm import JSONLogitsProcessor
+
+        key = schema_hash(output_model)
+        start_time = time.perf_counter()
+        logits_processor = self.logits_processors.get(key)
+        if logits_processor is None:
+            logits_processor = JSONLogitsProcessor(schema=output_model, llm=self.engine)
+            self.logits_processors[key] = logits_processor
+            print(f"Compiled logits processor for schema {key[:12]} in {time.perf_counter() - start_time:.3f}s")
+        else:
+            # The FSM states of the previous batch's sequences are no longer needed
+            if hasattr(logits_processor, "_fsm_state"):
+                logits_processor._fsm_state.clear()
+            print(f"Logits processor cache hit for schema {key[:12]} in {(time.perf_counter() - start_time) * 1000:.3f}ms")
+        return logits_processor
+
+    def prefill_prefixes(self, prefixes: dict):
+        """Run the prefill of every shared prompt prefix once, before the batch is added.
+
+        Requests added together are prefilled in the same step, before any of them has filled the
+        prefix cache, so without this every request of a batch would compute the shared prefix.
+        """
+        from vllm import SamplingParams
+
+        # Without prefix caching the prefill is not reused, the requests just compute it again
+        if not (ENABLE_PREFIX_CACHING and PREFILL_SHARED_PREFIXES):
+            return
+        start_time = time.perf_counter()
+        for prefix_id, prefix in prefixes.items():
+            self.engine.add_request(f"prefix-{prefix_id}", prefix, SamplingParams(max_tokens=1, temperature=0))
+        while self.engine.has_unfinished_requests():
+            self.engine.step()
+        print(f"Prefilled {len(prefixes)} shared prefixes in {time.perf_counter() - start_time:.2f}s")
+
     @modal.method(is_generator=True)
-    def generate(self, prompts: list[str], settings=None):
-        """Generate responses to a batch of prompts, optionally with custom inference settings."""
+    def generate(self, prompts: list[str], settings=None, prefixes: dict = None, prefix_id: str = None):
+        """Generate responses to a batch of prompts, optionally with custom inference settings.
+
+        With `prefixes`, every prompt is the suffix of `prefixes[prefix_id]` (no prefix without a `prefix_id`).
+        """
         from vllm import SamplingParams
 
+        if prefixes:
+            self.prefill_prefixes(prefixes)
+            prompts = [prefixes.get(prefix_id, "") + prompt for prompt in prompts]
+
         request_id = 0
 
         # Add all prompts to the engine
@@ -83,38 +185,78 @@ class Model:
                 if request_output.finished:
                     yield request_output.outputs[0].text
 
-    # TODO: Add the generator back in
-    @modal.method()
-    def generate_with_outlines(self, prompts: list[str], output_model: BaseModel, settings=None):
-        """Generate responses to a batch of prompts using Outlines structured outputs according to the provided Pydantic model."""
+    def _generate_results_with_outlines(self, prompts: list[str], output_model: BaseModel, prefixes: dict = None, prefix_id: str = None):
+        """Add all prompts to the engine and yield `(request_id, text)` as each request finishes."""
+        requests = [
+            {"id": str(request_id), "prompt": prompt, "output_model": output_model, "prefix_id": prefix_id}
+            for request_id, prompt in enumerate(prompts)
+        ]
+        yield from self._generate_results_mixed(requests, prefixes)
+
+    def _generate_results_mixed(self, requests: list[dict], prefixes: dict = None):
+        """Add requests with their own `output_model` to the engine and yield `(request_id, text)` as each request finishes.
 
+        Requests are grouped by schema, so every compiled logits processor is looked up once per batch
+        and tasks with different schemas share the same engine run instead of draining between batches.
+        A request with a `prefix_id` has `prefixes[prefix_id]` prepended to its prompt, every prefix is
+        prefilled once up front.
+        """
         from vllm import SamplingParams
-        from outlines.integrations.vllm import JSONLogitsProcessor
 
-        request_id = 0
-        results = []
+        if prefixes:
+            self.prefill_prefixes(prefixes)
 
-        logits_processor = JSONLogitsProcessor(schema=output_model, llm=self.engine)
+        requests_by_schema = {}
+        for request in requests:
+            key = schema_hash(request["output_model"]) if request.get("output_model") else None
+            requests_by_schema.setdefault(key, []).append(request)
 
         # Add all prompts to the engine
-        for prompt in prompts:
-            sampling_params = SamplingParams(
-                max_tokens=MAX_OUTPUT_LEN,
-                temperature=0,
-                logits_processors=[logits_processor]
-            )
-            self.engine.add_request(str(request_id), prompt, sampling_params)
-            request_id += 1
+        for key, schema_requests in requests_by_schema.items():
+            logits_processors = []
+            if key is not None:
+                logits_processors = [self.get_logits_processor(schema_requests[0]["output_model"])]
+            for request in schema_requests:
+                sampling_params = SamplingParams(
+                    max_tokens=MAX_OUTPUT_LEN,
+                    temperature=0,
+                    logits_processors=logits_processors
+                )
+                prompt = (prefixes or {}).get(request.get("prefix_id"), "") + request["prompt"]
+                self.engine.add_request(str(request["id"]), prompt, sampling_params)
 
-        # Process requests and collect results
+        # Process requests and yield results as they finish
         while self.engine.has_unfinished_requests():
             request_outputs = self.engine.step()
             for request_output in request_outputs:
                 if request_output.finished:
-                    # fix this, `answer` is a terribly confusing key -- `response` is better
-                    results.append({
-                        "id": request_output.request_id,
-                        "answer": request_output.outputs[0].text
-                    })
+                    yield request_output.request_id, request_output.outputs[0].text
 
-        return results
\ No newline at end of file
+    @modal.method()
+    def generate_with_outlines(self, prompts: list[str], output_model: BaseModel, settings=None, prefixes: dict = None, prefix_id: str = None):
+        """Generate responses to a batch of prompts using Outlines structured outputs according to the provided Pydantic model."""
+        # fix this, `answer` is a terribly confusing key -- `response` is better
+        return [
+            {"id": request_id, "answer": text}
+            for request_id, text in self._generate_results_with_outlines(prompts, output_model, prefixes, prefix_id)
+        ]
+
+    @modal.method(is_generator=True)
+    def generate_with_outlines_stream(self, prompts: list[str], output_model: BaseModel, settings=None, prefixes: dict = None, prefix_id: str = None):
+        """Like `generate_with_outlines`, but yields `{"id", "response"}` as soon as each request finishes."""
+        for request_id, text in self._generate_results_with_outlines(prompts, output_model, prefixes, prefix_id):
+            yield {"id": request_id, "response": text}
+
+    @modal.method()
+    def generate_mixed(self, requests: list[dict], settings=None, prefixes: dict = None):
+        """Generate responses to `{"id", "prompt", "output_model", "prefix_id"}` requests, each with its own (optional) output schema and shared prefix."""
+        return [
+            {"id": request_id, "answer": text}
+            for request_id, text in self._generate_results_mixed(requests, prefixes)
+        ]
+
+    @modal.method(is_generator=True)
+    def generate_mixed_stream(self, requests: list[dict], settings=None, prefixes: dict = None):
+        """Like `generate_mixed`, but yields `{"id", "response"}` as soon as each request finishes."""
+        for request_id, text in self._generate_results_mixed(requests, prefixes):
+            yield {"id": request_id, "response": text}
@@ -0,0 +1,147 @@
+import random
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from structured_rag.mock_gfl.instrumentation import record_retry
+
+# Default per-provider budgets, lower these to match your account tier
+PROVIDER_RATE_LIMITS = {
+    "openai": {"requests_per_minute": 5000, "tokens_per_minute": 800000},
+    "anthropic": {"requests_per_minute": 1000, "tokens_per_minute": 80000},
+    "google": {"requests_per_minute": 360, "tokens_per_minute": 4000000},
+    "ollama": {"requests_per_minute": 100000, "tokens_per_minute": 100000000},
+}
+
+# HTTP status codes that indicate a transport problem rather than a bad output
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504, 529}
+RETRYABLE_ERROR_NAMES = ("RateLimit", "ResourceExhausted", "ServiceUnavailable", "APIConnectionError",
+                         "APITimeoutError", "Timeout", "InternalServerError", "Overloaded", "DeadlineExceeded")
+
+class TransportError(Exception):
+    """Raised when a provider call still fails with a retryable error after all retries."""
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_per_second: float) -> None:
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_per_second)
+        self.last_refill = now
+
+    def acquire(self, amount: float = 1.0) -> None:
+        """Block until `amount` tokens are available, then take them."""
+        # A single request larger than the bucket would otherwise wait forever
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.refill_per_second
+            time.sleep(wait)
+
+def estimate_tokens(text: str) -> int:
+    # Roughly 4 characters per token for English text
+    return max(1, len(text) // 4)
+
+def _status_code(error: Exception) -> Optional[int]:
+    for attribute in ("status_code", "code", "status"):
+        value = getattr(error, attribute, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+def is_retryable_error(error: Exception) -> bool:
+    if _status_code(error) in RETRYABLE_STATUS_CODES:
+        return True
+    return any(name in type(error).__name__ for name in RETRYABLE_ERROR_NAMES)
+
+def parse_retry_after(error: Exception) -> Optional[float]:
+    """Return the server-requested delay in seconds, if the error carries one."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    # e.g. OpenAI: "Please try again in 1.5s" / "Please try again in 300ms"
+    match = re.search(r"try again in (\d+(?:\.\d+)?)(ms|s)", str(error))
+    if match:
+        delay = float(match.group(1))
+        return delay / 1000 if match.group(2) == "ms" else delay
+    return None
+
+class RateLimiter:
+    """Requests/min and tokens/min buckets with jittered exponential backoff, shared per provider.
+
+    A retryable error from any caller pauses every caller of the same provider until the
+    backoff delay has passed, so concurrent programs back off together instead of hammering the API.
+    """
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float,
+                 max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 60.0) -> None:
+        self.request_bucket = TokenBucket(requests_per_minute, requests_per_minute / 60)
+        self.token_bucket = TokenBucket(tokens_per_minute, tokens_per_minute / 60)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def backoff_delay(self, attempt: int) -> float:
+        # "Full jitter" exponential backoff
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _wait_if_paused(self) -> None:
+        with self.lock:
+            wait = self.paused_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def _pause(self, delay: float) -> None:
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    def call(self, fn: Callable[[], Any], estimated_tokens: int = 0) -> Any:
+        for attempt in range(self.max_retries + 1):
+            self._wait_if_paused()
+            self.request_bucket.acquire(1)
+            self.token_bucket.acquire(estimated_tokens)
+            try:
+                return fn()
+            except Exception as e:
+                if not is_retryable_error(e):
+                    raise
+                if attempt == self.max_retries:
+                    raise TransportError(f"Giving up after {self.max_retries} retries: {e}") from e
+                delay = parse_retry_after(e) or self.backoff_delay(attempt)
+                print(f"Retryable error ({type(e).__name__}), retrying in {delay:.2f}s...")
+                record_retry()
+                self._pause(delay)
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+def configure_rate_limiter(model_provider: str, requests_per_minute: float, tokens_per_minute: float, **kwargs) -> RateLimiter:
+    """Replace the shared rate limiter for `model_provider`."""
+    with _rate_limiters_lock:
+        _rate_limiters[model_provider] = RateLimiter(requests_per_minute, tokens_per_minute, **kwargs)
+        return _rate_limiters[model_provider]
+
+def get_rate_limiter(model_provider: str) -> RateLimiter:
+    """Return the rate limiter shared by every program using `model_provider`."""
+    with _rate_limiters_lock:
+        if model_provider not in _rate_limiters:
+            limits = PROVIDER_RATE_LIMITS.get(model_provider, PROVIDER_RATE_LIMITS["ollama"])
+            _rate_limiters[model_provider] = RateLimiter(**limits)
+        return _rate_limiters[model_provider]
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from structured_rag.mock_gfl.instrumentation import record_cache_hit
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "structured-rag", "responses.sqlite")
+
+class CacheMiss(Exception):
+    """Raised in replay mode when a response is not in the cache."""
+
+class ResponseCache:
+    """Content-addressed SQLite cache of LLM responses.
+
+    Entries are keyed on (provider, model, rendered prompt, temperature, output schema), so
+    re-scoring a sweep after changing only metric code replays every response from disk.
+    With `replay=True` the cache is opened read-only and a miss raises `CacheMiss` instead
+    of calling the provider. Once `max_entries` is exceeded the least recently used entries are evicted.
+    """
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = 1_000_000, replay: bool = False) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.replay = replay
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if replay:
+            self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, last_accessed REAL NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_accessed ON responses (last_accessed)")
+            self.connection.commit()
+
+    @staticmethod
+    def make_key(model_provider: str, model_name: str, prompt: str,
+                 temperature: Optional[float] = None, schema: Optional[Dict[str, Any]] = None,
+                 variant: Optional[str] = None) -> str:
+        key_material = {
+            "model_provider": model_provider,
+            "model_name": model_name,
+            "prompt": prompt,
+            "temperature": temperature,
+            "schema": schema
+        }
+        # Only part of the key when set, so existing entries keep their keys
+        if variant is not None:
+            key_material["variant"] = variant
+        return hashlib.sha256(json.dumps(key_material, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and not self.replay:
+                self.connection.execute("UPDATE responses SET last_accessed = ? WHERE key = ?", (time.time(), key))
+                self.connection.commit()
+        return row[0] if row is not None else None
+
+    def put(self, key: str, response: str) -> None:
+        if self.replay:
+            return
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, last_accessed) VALUES (?, ?, ?, ?)",
+                (key, response, now, now)
+            )
+            num_entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if num_entries > self.max_entries:
+                self.connection.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_accessed LIMIT ?)",
+                    (num_entries - self.max_entries,)
+                )
+            self.connection.commit()
+
+    def get_or_call(self, key: str, fn: Callable[[], str]) -> str:
+        response = self.get(key)
+        if response is not None:
+            self.hits += 1
+            record_cache_hit()
+            return response
+        self.misses += 1
+        if self.replay:
+            raise CacheMiss(f"No cached response for key {key}")
+        response = fn()
+        self.put(key, response)
+        return response
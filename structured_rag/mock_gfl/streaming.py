@@ -0,0 +1,70 @@
+from typing import List, Optional
+
+# Characters that can appear in JSON outside of a string
+_JSON_LITERAL_CHARS = set("0123456789+-.eEtruefalsn")
+_WHITESPACE = set(" \t\n\r")
+_CLOSING = {"}": "{", "]": "["}
+
+class IncrementalJSONValidator:
+    """Checks a JSON response chunk by chunk and reports as soon as it can no longer be valid.
+
+    This only catches violations that are certain from a prefix: a response that does not open
+    with the expected `{` / `[` (e.g. a leading ```json fence or a prose preamble), characters that
+    cannot appear in JSON, mismatched brackets and text after the top-level value is closed.
+    Full validation against the output model still happens in `is_valid_json_output`.
+    """
+    def __init__(self, expect_array: bool = False) -> None:
+        self.expected_start = "[" if expect_array else "{"
+        self.stack: List[str] = []
+        self.in_string = False
+        self.escaped = False
+        self.started = False
+        self.complete = False
+        self.error: Optional[str] = None
+
+    @property
+    def is_valid(self) -> bool:
+        return self.error is None
+
+    def feed(self, chunk: str) -> bool:
+        """Consume the next chunk, returns False once the response provably violates the format."""
+        if self.error is not None:
+            return False
+        for char in chunk:
+            self.error = self._consume(char)
+            if self.error is not None:
+                return False
+        return True
+
+    def _consume(self, char: str) -> Optional[str]:
+        if self.in_string:
+            if self.escaped:
+                self.escaped = False
+            elif char == "\\":
+                self.escaped = True
+            elif char == '"':
+                self.in_string = False
+            return None
+        if char in _WHITESPACE:
+            return None
+        if self.complete:
+            return f"Trailing text after the JSON value: {char!r}"
+        if not self.started:
+            if char != self.expected_start:
+                return f"Response does not start with {self.expected_start!r}: {char!r}"
+            self.started = True
+            self.stack.append(char)
+            return None
+        if char in "{[":
+            self.stack.append(char)
+        elif char in _CLOSING:
+            if not self.stack or self.stack[-1] != _CLOSING[char]:
+                return f"Mismatched closing bracket: {char!r}"
+            self.stack.pop()
+            if not self.stack:
+                self.complete = True
+        elif char == '"':
+            self.in_string = True
+        elif char not in ":," and char not in _JSON_LITERAL_CHARS:
+            return f"Character cannot appear in JSON: {char!r}"
+        return None
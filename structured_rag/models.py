@@ -1,10 +1,25 @@
-from pydantic import BaseModel, create_model
+from pydantic import AfterValidator, BaseModel, BeforeValidator, Field, Strict, create_model
 from enum import Enum
-from typing import Type, List
+from typing import Annotated, Any, Dict, Optional, Type, List
 
 class PromptWithResponse(BaseModel):
     prompt: str
     response: str
+    # Per-request instrumentation, token counts come from the provider's usage metadata
+    latency: Optional[float] = None
+    input_tokens: Optional[int] = None
+    output_tokens: Optional[int] = None
+    num_retries: int = 0
+    # Served from the response cache, left out of the latency and throughput aggregates
+    cached: bool = False
+    # Only recorded for streamed requests
+    time_to_first_token: Optional[float] = None
+    time_to_first_valid_token: Optional[float] = None
+    aborted_early: bool = False
+    # Why the response failed validation, see `classify_failure`
+    failure_category: Optional[str] = None
+    # Whether a failed response validates after `repair_json_output`
+    repaired: bool = False
 
 class PromptingMethod(str, Enum):
     dspy = "dspy"
@@ -20,9 +35,29 @@ class Experiment(BaseModel):
     num_attempts: int
     success_rate: float
     average_task_performance: float
-    total_time: int
+    total_time: float
     all_responses: list[PromptWithResponse]
     failed_responses: list[PromptWithResponse]
+    # Aggregates over the `all_responses` not served from the response cache, see `summarize_request_metrics`
+    latency_p50: Optional[float] = None
+    latency_p95: Optional[float] = None
+    latency_p99: Optional[float] = None
+    total_input_tokens: Optional[int] = None
+    total_output_tokens: Optional[int] = None
+    output_tokens_per_second: Optional[float] = None
+    total_retries: int = 0
+    num_cached: int = 0
+    # Valid outputs without a task metric, e.g. GenerateAnswer answers without a cached verdict in replay mode
+    num_unjudged: int = 0
+    # Batch runs only: `total_time` is the generation time, scoring (validation, judging) is timed separately
+    scoring_time: Optional[float] = None
+    # Whether fewer results arrived than were requested, e.g. because the stream ended early
+    partial: bool = False
+    # Number of `failed_responses` per failure category, see `summarize_failure_categories`
+    failure_categories: Dict[str, int] = {}
+    # Failed responses salvaged by `repair_json_output`, the rate is `None` if the run did not try to repair them
+    num_repaired: int = 0
+    repaired_success_rate: Optional[float] = None
 
     class Config:
         protected_namespaces = ()
@@ -32,42 +67,68 @@ class SingleTestResult(BaseModel):
     is_valid: bool
     task_metric: int
 
+# Response field types used to validate task outputs (see `is_valid_json_output`)
+# Constraints are applied as validators rather than `Field(ge=..., le=...)`,
+# so they do not leak into the JSON schemas sent to structured output APIs.
+
+def _score_in_range(min_val: float = 0, max_val: float = 5) -> AfterValidator:
+    def check_range(score):
+        if not min_val <= score <= max_val:
+            raise ValueError(f"Score must be between {min_val} and {max_val}")
+        return score
+    return AfterValidator(check_range)
+
+def _parse_bool_string(value: Any) -> Any:
+    # Accept "true" / "false" in any casing, but not the other truthy strings pydantic allows
+    if isinstance(value, str) and value.lower() in ["true", "false"]:
+        return value.lower() == "true"
+    return value
+
+def _parse_int_string(value: Any) -> Any:
+    # Accept integer strings like "4", but not floats such as 3.0 or "3.0"
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            return value
+    return value
+
+Score = Annotated[int, Strict(), BeforeValidator(_parse_int_string), _score_in_range(0, 5)]
+FloatScore = Annotated[float, _score_in_range(0, 5)]
+JSONBool = Annotated[bool, Strict(), BeforeValidator(_parse_bool_string)]
+
 class GenerateAnswer(BaseModel):
     answer: str
 
 class RateContext(BaseModel):
-    context_score: int
+    context_score: Score
 
 class AssessAnswerability(BaseModel):
-    answerable_question: bool
+    answerable_question: JSONBool
 
 class ParaphraseQuestions(BaseModel):
     paraphrased_questions: List[str]
 
 class RAGAS(BaseModel):
-    faithfulness_score: float
-    answer_relevance_score: float
-    context_relevance_score: float
+    faithfulness_score: FloatScore
+    answer_relevance_score: FloatScore
+    context_relevance_score: FloatScore
 
+# The aliases match the keys requested by `response_format` in `test_params`
 class GenerateAnswerWithConfidence(BaseModel):
-    answer: str
-    confidence: int
+    answer: str = Field(alias="Answer")
+    confidence: Score = Field(alias="Confidence")
 
 class GenerateAnswersWithConfidence(BaseModel):
     answers: List[GenerateAnswerWithConfidence]
 
+# Use `_ClassifyDocument` / `_ClassifyDocumentWithRationale` to restrict `category` to a set of classes
 class ClassifyDocument(BaseModel):
-    category: Enum
-
-    class Config:
-        arbitrary_types_allowed = True
+    category: str
 
 class ClassifyDocumentWithRationale(BaseModel):
     rationale: str
-    category: Enum
-
-    class Config:
-        arbitrary_types_allowed = True
+    category: str
 
 def create_enum(enum_name: str, enum_values: List[str]) -> Type[Enum]:
     """Dynamically create an Enum class with given values."""
@@ -150,4 +211,13 @@ test_to_output_model = {
     "GenerateAnswersWithConfidence": GenerateAnswersWithConfidence,
     "ClassifyDocument": ClassifyDocument,
     "ClassifyDocumentWithRationale": ClassifyDocumentWithRationale
-}
\ No newline at end of file
+}
+
+# The shape `is_valid_json_output` validates against, i.e. what `response_format` asks for.
+# GenerateAnswersWithConfidence asks for a bare JSON list rather than the `answers` wrapper
+# that structured decoding needs (OpenAI and Outlines require an object at the top level),
+# so responses constrained to a `test_to_output_model` schema are validated against that model.
+test_to_response_model = {
+    **test_to_output_model,
+    "GenerateAnswersWithConfidence": List[GenerateAnswerWithConfidence]
+}
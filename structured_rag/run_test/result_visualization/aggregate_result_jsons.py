@@ -1,12 +1,24 @@
 import json
 import os
-from typing import Dict, List
-from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 import numpy as np
+import pandas as pd
 import argparse
 
+from structured_rag.run_test.result_visualization.render_pipeline import ChartJob, render_charts
+
+GROUP_COLUMNS = ["test_type", "model_name", "model_provider"]
+METHODS = ["dspy", "fstring"]
+
+# Two-sided 95% Student's t critical values by degrees of freedom, the normal value is used above 30
+T_CRITICAL_95 = {
+    1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262, 10: 2.228,
+    11: 2.201, 12: 2.179, 13: 2.160, 14: 2.145, 15: 2.131, 16: 2.120, 17: 2.110, 18: 2.101, 19: 2.093, 20: 2.086,
+    21: 2.080, 22: 2.074, 23: 2.069, 24: 2.064, 25: 2.060, 26: 2.056, 27: 2.052, 28: 2.048, 29: 2.045, 30: 2.042,
+}
+
 def read_json_files(base_dir: str) -> List[Dict]:
     results = []
     for trial_dir in os.listdir(base_dir):
@@ -20,71 +32,107 @@ def read_json_files(base_dir: str) -> List[Dict]:
                         results.append(data)
     return results
 
-def aggregate_results(results: List[Dict]) -> Dict:
-    summary = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: {
-        "dspy_total": 0,
-        "fstring_total": 0,
-        "total_questions": 0,
-        "runs": 0
-    }))))
-    
-    for result in results:
-        test_type = result["test_type"]
-        model_name = result["model_name"]
-        model_provider = result["model_provider"]
-        trial = os.path.basename(os.path.dirname(result["file_path"]))
-        
-        summary[test_type][model_name][model_provider][trial]["dspy_total"] += result["dspy_score"]
-        summary[test_type][model_name][model_provider][trial]["fstring_total"] += result["fstring_score"]
-        
-        # Handle both old and new JSON formats
-        if "total_questions" in result:
-            total_questions = result["total_questions"]
-        else:
-            total_questions = max(result.get("dspy_total_attempts", 0), result.get("fstring_total_attempts", 0))
-        
-        summary[test_type][model_name][model_provider][trial]["total_questions"] += total_questions
-        summary[test_type][model_name][model_provider][trial]["runs"] += 1
-    
-    for test_type, models in summary.items():
-        for model_name, providers in models.items():
-            for provider, trials in providers.items():
-                for trial, data in trials.items():
-                    data["dspy_average"] = data["dspy_total"] / data["runs"] if data["runs"] > 0 else 0
-                    data["fstring_average"] = data["fstring_total"] / data["runs"] if data["runs"] > 0 else 0
-                    data["average_questions"] = data["total_questions"] / data["runs"] if data["runs"] > 0 else 0
-    
-    return dict(summary)
-
-def print_summary(summary: Dict):
+def results_to_table(results: List[Dict]) -> pd.DataFrame:
+    """One row per result file, with the trial taken from its directory."""
+    table = pd.DataFrame(results)
+    table["trial"] = table["file_path"].map(lambda file_path: os.path.basename(os.path.dirname(file_path)))
+    # Handle both old and new JSON formats
+    if "total_questions" not in table.columns:
+        table["total_questions"] = np.nan
+    attempts = table.reindex(columns=["dspy_total_attempts", "fstring_total_attempts"]).max(axis=1)
+    table["total_questions"] = table["total_questions"].fillna(attempts).fillna(0).astype(int)
+    return table[GROUP_COLUMNS + ["trial", "dspy_score", "fstring_score", "total_questions"]]
+
+def t_critical_95(degrees_of_freedom: pd.Series) -> pd.Series:
+    return degrees_of_freedom.map(lambda df: T_CRITICAL_95.get(int(df), 1.96) if df >= 1 else np.nan)
+
+def aggregate_results(table: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Aggregate per trial and across trials in one grouped pass each.
+
+    Returns `(per_trial, across_trials)`. `per_trial` has the summed scores, averages per run
+    and success rates (`dspy_rate`, `fstring_rate`) of every test / model / provider / trial.
+    `across_trials` has the mean, standard deviation and 95% confidence interval half-width
+    (Student's t) of those rates over the trials.
+    """
+    per_trial = (
+        table.groupby(GROUP_COLUMNS + ["trial"], sort=False)
+        .agg(dspy_total=("dspy_score", "sum"), fstring_total=("fstring_score", "sum"),
+             total_questions=("total_questions", "sum"), runs=("dspy_score", "size"))
+        .reset_index()
+    )
+    per_trial["dspy_average"] = per_trial["dspy_total"] / per_trial["runs"]
+    per_trial["fstring_average"] = per_trial["fstring_total"] / per_trial["runs"]
+    per_trial["average_questions"] = per_trial["total_questions"] / per_trial["runs"]
+    questions = per_trial["average_questions"].where(per_trial["average_questions"] > 0)
+    for method in METHODS:
+        per_trial[f"{method}_rate"] = per_trial[f"{method}_average"] / questions
+
+    across_trials = per_trial.groupby(GROUP_COLUMNS, sort=False).agg(
+        num_trials=("trial", "nunique"),
+        **{f"{method}_{stat}": (f"{method}_rate", stat) for method in METHODS for stat in ["mean", "std"]}
+    ).reset_index()
+    t_values = t_critical_95(across_trials["num_trials"] - 1)
+    for method in METHODS:
+        across_trials[f"{method}_ci95"] = t_values * across_trials[f"{method}_std"] / np.sqrt(across_trials["num_trials"])
+    return per_trial, across_trials
+
+def to_nested_summary(per_trial: pd.DataFrame) -> Dict:
+    """The `aggregated_results.json` layout, test -> model -> provider -> trial -> totals and averages."""
+    summary = {}
+    value_columns = ["dspy_total", "fstring_total", "total_questions", "runs", "dspy_average", "fstring_average", "average_questions"]
+    for row in per_trial.to_dict("records"):
+        trials = summary.setdefault(row["test_type"], {}).setdefault(row["model_name"], {}).setdefault(row["model_provider"], {})
+        trials[row["trial"]] = {column: row[column].item() if hasattr(row[column], "item") else row[column] for column in value_columns}
+    return summary
+
+def _format_rate(rate: float) -> str:
+    return "N/A" if pd.isna(rate) else f"{rate:.2%}"
+
+def print_summary(per_trial: pd.DataFrame, across_trials: pd.DataFrame):
     print("Experiment Results Summary:")
     print("===========================")
-    for test_type, models in summary.items():
+    for (test_type, model_name, provider), rows in per_trial.groupby(GROUP_COLUMNS, sort=False):
         print(f"\nTest: {test_type}")
-        for model_name, providers in models.items():
-            for provider, trials in providers.items():
-                print(f"\nModel: {model_name} (Provider: {provider})")
-                for trial, data in trials.items():
-                    print(f"  Trial: {trial}")
-                    print(f"    Number of runs: {data['runs']}")
-                    print(f"    Average questions per run: {data['average_questions']:.2f}")
-                    if data['average_questions'] > 0:
-                        print(f"    DSPy average score: {data['dspy_average']:.2f} ({data['dspy_average']/data['average_questions']:.2%})")
-                        print(f"    f-string average score: {data['fstring_average']:.2f} ({data['fstring_average']/data['average_questions']:.2%})")
-                    else:
-                        print(f"    DSPy average score: {data['dspy_average']:.2f} (N/A)")
-                        print(f"    f-string average score: {data['fstring_average']:.2f} (N/A)")
-
-def create_bar_chart(summary: Dict, trial: str = None):
-    tests = list(summary.keys())
-    models = list(set(model for test in summary.values() for model in test.keys()))
-    
+        print(f"\nModel: {model_name} (Provider: {provider})")
+        for row in rows.itertuples():
+            print(f"  Trial: {row.trial}")
+            print(f"    Number of runs: {row.runs}")
+            print(f"    Average questions per run: {row.average_questions:.2f}")
+            print(f"    DSPy average score: {row.dspy_average:.2f} ({_format_rate(row.dspy_rate)})")
+            print(f"    f-string average score: {row.fstring_average:.2f} ({_format_rate(row.fstring_rate)})")
+
+    print("\nAcross trials (mean ± 95% CI):")
+    print("==============================")
+    for row in across_trials.itertuples():
+        print(f"{row.test_type} | {row.model_name} ({row.model_provider}) | {row.num_trials} trials")
+        for method, label in [("dspy", "DSPy"), ("fstring", "f-string")]:
+            mean, ci95 = getattr(row, f"{method}_mean"), getattr(row, f"{method}_ci95")
+            ci = "" if pd.isna(ci95) else f" ± {ci95:.2%}"
+            print(f"    {label}: {_format_rate(mean)}{ci}")
+
+def chart_table(per_trial: pd.DataFrame, across_trials: pd.DataFrame, trial: Optional[str] = None) -> pd.DataFrame:
+    """One row per test / model with the `dspy` / `fstring` rates to plot and their `_ci95` error bars (across trials only)."""
+    if trial:
+        rows = per_trial[per_trial["trial"] == trial]
+        table = rows[["test_type", "model_name"]].assign(dspy=rows["dspy_rate"], fstring=rows["fstring_rate"])
+        table = table.groupby(["test_type", "model_name"], sort=False).first().reset_index()
+        table[["dspy_ci95", "fstring_ci95"]] = 0.0
+    else:
+        table = across_trials.groupby(["test_type", "model_name"], sort=False)[
+            ["dspy_mean", "fstring_mean", "dspy_ci95", "fstring_ci95"]
+        ].first().reset_index().rename(columns={"dspy_mean": "dspy", "fstring_mean": "fstring"})
+    return table.fillna(0)
+
+def create_bar_chart(table: pd.DataFrame, tests: List[str], models: List[str], trial: Optional[str] = None,
+                     filename: Optional[str] = None):
+    """Plot a `chart_table`, `tests` and `models` fix the bar positions and colors across all charts."""
+
     fig, ax = plt.subplots(figsize=(20, 10))  # Increased figure size for better readability
-    
+
     num_models = len(models)
     group_width = 0.8
     bar_width = group_width / (2 * num_models)  # We have 2 bars per model (DSPy/FF and f-string)
-    
+
     # Define the color scheme
     color_scheme = {
         'gemini-1.5-pro f-String': 'forestgreen',
@@ -92,69 +140,52 @@ def create_bar_chart(summary: Dict, trial: str = None):
         'llama3:instruct f-String': 'red',
         'llama3:instruct FF': 'darkorange'
     }
-    
-    for i, test in enumerate(tests):
-        for j, model in enumerate(models):
-            if model in summary[test]:
-                providers = summary[test][model]
-                if trial:
-                    provider_data = next((provider[trial] for provider in providers.values() if trial in provider), None)
-                    if provider_data and provider_data["average_questions"] > 0:
-                        dspy_avg = provider_data["dspy_average"] / provider_data["average_questions"]
-                        fstring_avg = provider_data["fstring_average"] / provider_data["average_questions"]
-                    else:
-                        dspy_avg = fstring_avg = 0
-                else:
-                    # For overall average, we need to aggregate across all trials
-                    all_trials_data = [t for provider in providers.values() for t in provider.values()]
-                    if all_trials_data:
-                        total_questions = sum(t["average_questions"] for t in all_trials_data)
-                        if total_questions > 0:
-                            dspy_avg = sum(t["dspy_average"] for t in all_trials_data) / total_questions
-                            fstring_avg = sum(t["fstring_average"] for t in all_trials_data) / total_questions
-                        else:
-                            dspy_avg = fstring_avg = 0
-                    else:
-                        dspy_avg = fstring_avg = 0
-                
-                # Calculate positions for the bars
-                base_position = i + (j - num_models/2 + 0.5) * group_width / num_models
-                dspy_position = base_position - bar_width/2
-                fstring_position = base_position + bar_width/2
-                
-                # Plot the bars with specified coloring
-                ax.bar(dspy_position, dspy_avg, bar_width, color=color_scheme[f'{model} FF'], alpha=0.8)
-                ax.bar(fstring_position, fstring_avg, bar_width, color=color_scheme[f'{model} f-String'], alpha=0.8)
+    # Models outside the scheme get colors from the default cycle
+    fallback_colors = iter(mcolors.TABLEAU_COLORS.values())
+    for model in models:
+        for label in ("FF", "f-String"):
+            color_scheme.setdefault(f'{model} {label}', next(fallback_colors, 'gray'))
+
+    # Calculate positions for the bars, all bars of a model are drawn in one call
+    test_positions = {test: i for i, test in enumerate(tests)}
+    for j, model in enumerate(models):
+        rows = table[table["model_name"] == model]
+        base_positions = rows["test_type"].map(test_positions).to_numpy() + (j - num_models/2 + 0.5) * group_width / num_models
+        # Plot the bars with specified coloring
+        ax.bar(base_positions - bar_width/2, rows["dspy"], bar_width, yerr=rows["dspy_ci95"],
+               capsize=3, color=color_scheme[f'{model} FF'], alpha=0.8)
+        ax.bar(base_positions + bar_width/2, rows["fstring"], bar_width, yerr=rows["fstring_ci95"],
+               capsize=3, color=color_scheme[f'{model} f-String'], alpha=0.8)
 
     ax.set_ylabel('Average Score (as percentage)', fontsize=16)  # Increased font size
     title = 'Model Performance Comparison by Test Type'
     if trial:
         title += f' - {trial}'
     else:
-        title += ' - Average Across All Trials'
+        title += ' - Average Across All Trials (95% CI)'
     ax.set_title(title, fontsize=18)  # Increased font size
-    
+
     ax.set_xticks(range(len(tests)))
     ax.set_xticklabels(tests, rotation=45, ha='right', fontsize=12)  # Increased font size
-    
+
     # Adjust y-axis to start from 0 and end at 1 (100%)
     ax.set_ylim(0, 1)
     ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda y, _: '{:.0%}'.format(y)))
     ax.tick_params(axis='y', labelsize=14)  # Increased y-axis tick label font size
-    
+
     # Add gridlines for better readability
     ax.grid(True, axis='y', linestyle='--', alpha=0.7)
-    
+
     # Create custom legend
-    legend_elements = [plt.Rectangle((0,0),1,1, facecolor=color, edgecolor='none', alpha=0.8) 
+    legend_elements = [plt.Rectangle((0,0),1,1, facecolor=color, edgecolor='none', alpha=0.8)
                        for color in color_scheme.values()]
     legend_labels = list(color_scheme.keys())
-    
-    ax.legend(legend_elements, legend_labels, bbox_to_anchor=(1.05, 1), loc='upper left', 
+
+    ax.legend(legend_elements, legend_labels, bbox_to_anchor=(1.05, 1), loc='upper left',
               borderaxespad=0., fontsize=14)  # Increased legend font size
-    
+
     plt.tight_layout()
-    filename = 'model_comparison.png' if not trial else f'model_comparison_{trial}.png'
+    filename = filename or ('model_comparison.png' if not trial else f'model_comparison_{trial}.png')
     plt.savefig(filename, bbox_inches='tight', dpi=300)  # Increased DPI for better quality
     plt.close()
 
@@ -163,32 +194,33 @@ def create_bar_chart(summary: Dict, trial: str = None):
 def main():
     parser = argparse.ArgumentParser(description="Aggregate JSON results and create visualizations.")
     parser.add_argument("results_dir", help="Directory containing the experimental results")
+    parser.add_argument("--force", action="store_true", help="Re-render every chart, even if its data has not changed")
     args = parser.parse_args()
 
     results = read_json_files(args.results_dir)
-    summary = aggregate_results(results)
-    
-    print_summary(summary)
-    
-    # Create a plot for each trial
-    trials = set()
-    for test in summary.values():
-        for model in test.values():
-            for provider in model.values():
-                trials.update(provider.keys())
-    
-    for trial in sorted(trials):
-        create_bar_chart(summary, trial)
-    
-    # Create a plot for the average across all trials
-    create_bar_chart(summary)
-    
+    per_trial, across_trials = aggregate_results(results_to_table(results))
+
+    print_summary(per_trial, across_trials)
+
+    # A plot for each trial and one for the average across all trials, each job only gets its own
+    # chart table, so adding a trial re-renders the new trial's chart and the average only
+    tests = list(dict.fromkeys(across_trials["test_type"]))
+    models = list(dict.fromkeys(across_trials["model_name"]))
+    jobs = [
+        ChartJob(f'model_comparison_{trial}.png', create_bar_chart, chart_table(per_trial, across_trials, trial), tests, models, trial=trial)
+        for trial in sorted(per_trial["trial"].unique())
+    ]
+    jobs.append(ChartJob('model_comparison.png', create_bar_chart, chart_table(per_trial, across_trials), tests, models))
+    rendered, skipped = render_charts(jobs, force=args.force)
+    print(f"Rendered {len(rendered)} charts, {len(skipped)} unchanged")
+
     # Save aggregated results
     with open(f"./{args.results_dir}/aggregated_results.json", "w") as f:
-        json.dump(summary, f, indent=2)
-    
-    print("\nAggregated results saved to aggregated_results.json")
+        json.dump(to_nested_summary(per_trial), f, indent=2)
+    across_trials.to_json(f"./{args.results_dir}/aggregated_results_across_trials.json", orient="records", indent=2)
+
+    print("\nAggregated results saved to aggregated_results.json and aggregated_results_across_trials.json")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
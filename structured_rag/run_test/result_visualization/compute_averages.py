@@ -1,26 +1,7 @@
-import os
-import json
 import pandas as pd
-from models import PromptWithResponse, PromptingMethod, Experiment
-
-def load_experiments(directory: str) -> pd.DataFrame:
-    experiments = []
-    for filename in os.listdir(directory):
-        if filename.endswith(".json"):
-            with open(os.path.join(directory, filename), 'r') as f:
-                data = json.load(f)
-                experiment = Experiment(**data)
-                experiments.append({
-                    'test_name': experiment.test_name,
-                    'model_name': experiment.model_name,
-                    'prompting_method': experiment.prompting_method,
-                    'num_successes': experiment.num_successes,
-                    'num_attempts': experiment.num_attempts,
-                    'success_rate': experiment.success_rate,
-                    'total_time': experiment.total_time,
-                    'avg_response_time': experiment.total_time / experiment.num_attempts
-                })
-    return pd.DataFrame(experiments)
+
+# Reads a Parquet result store (see `result_store.py`) as well as a folder of Experiment JSON files
+from structured_rag.run_test.utils_and_metrics.helpers import load_experiments
 
 def calculate_avg_accuracy_per_prompting_method(experiments: pd.DataFrame) -> pd.DataFrame:
     return experiments.groupby(['prompting_method'])['success_rate'].mean().reset_index()
@@ -52,7 +33,7 @@ def list_all_results(experiments: pd.DataFrame) -> pd.DataFrame:
         print(f"\033[92mSuccess rate: {row['success_rate']}\033[0m")
 
 if __name__ == "__main__":
-    experiments = load_experiments("experimental-results-9-11-24")
+    experiments = load_experiments("experimental-results-9-11-24", with_failed_responses=False)
     print("\033[92m\nAverage accuracy per prompting method:\n\033[0m")
     print(calculate_avg_accuracy_per_prompting_method(experiments))
 
@@ -1,5 +1,7 @@
 import dspy
+from concurrent.futures import ThreadPoolExecutor
 
+from structured_rag.run_test.utils_and_metrics.failure_analysis import FailureCluster, cluster_failures
 from structured_rag.run_test.utils_and_metrics.helpers import load_experiments
 from structured_rag.run_test.utils_and_metrics.helpers import Colors
 
@@ -26,8 +28,12 @@ class SummarizeErrors(dspy.Signature):
     error_analysis_report = dspy.OutputField(description="The summary of the errors.")
 
 error_analyzer = dspy.Predict(ErrorAnalyzer)
+summarize_errors = dspy.Predict(SummarizeErrors)
 
-# loop through failed_responses
+MAX_CONCURRENCY = 8 # analyzer calls in flight
+
+def analyze_cluster(cluster: FailureCluster) -> str:
+    return error_analyzer(system_output=cluster.representative).why_it_failed
 
 # ToDo reorganize results to move gemini results
 experiments = load_experiments("../results/Gemini-1.5-Pro-9-11-24")
@@ -39,16 +45,30 @@ print(experiments.info())
 failed_responses_per_experiments = experiments["failed_responses"].tolist()
 test_names = experiments["test_name"].tolist()
 
-for idx, failed_responses in enumerate(failed_responses_per_experiments):
+# Failures of the same shape get the same analysis, so the analyzer only sees one representative per cluster
+clusters_per_experiment = [
+    cluster_failures([failed_response.response for failed_response in failed_responses])
+    for failed_responses in failed_responses_per_experiments
+]
+all_clusters = [cluster for clusters in clusters_per_experiment for cluster in clusters]
+num_failures = sum(len(failed_responses) for failed_responses in failed_responses_per_experiments)
+print(f"{Colors.BOLD}Analyzing {num_failures} failures as {len(all_clusters)} clusters{Colors.ENDC}")
+
+with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+    cluster_analyses = dict(zip(map(id, all_clusters), executor.map(analyze_cluster, all_clusters)))
+
+for idx, clusters in enumerate(clusters_per_experiment):
     print(f"{Colors.GREEN}Analyzing Failures for Experiment: {test_names[idx]}\n{Colors.ENDC}")
+    if not clusters:
+        continue
     error_analyses = []
-    for idx, failed_response in enumerate(failed_responses):
-        print(f"{Colors.BOLD}Analyzing Failure {idx}: {failed_response.response}\n{Colors.ENDC}")
-        error_analysis = error_analyzer(system_output=failed_response.response).why_it_failed
-        error_analyses.append(error_analysis)
+    for cluster_idx, cluster in enumerate(clusters):
+        error_analysis = cluster_analyses[id(cluster)]
+        print(f"{Colors.BOLD}Failure cluster {cluster_idx} ({cluster.count} failures, {cluster.fingerprint}): {cluster.representative}\n{Colors.ENDC}")
         print(f"{Colors.GREEN}Error analysis: {error_analysis}\n{Colors.ENDC}")
+        error_analyses.append(f"({cluster.count} of {len(failed_responses_per_experiments[idx])} failures) {error_analysis}")
 
     error_analyses = "\n".join([f"[{i+1}] {item}" for i, item in enumerate(error_analyses)])
-    summary = SummarizeErrors.predict(error_analyses=error_analyses).error_analysis_report
+    summary = summarize_errors(error_analyses=error_analyses).error_analysis_report
 
     print(f"{Colors.BOLD}Summary of Errors:{Colors.ENDC}\n{summary}")
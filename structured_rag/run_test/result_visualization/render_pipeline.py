@@ -0,0 +1,95 @@
+# Renders charts in a process pool with the non-interactive Agg backend, skipping every chart whose
+# inputs (data and plotting code) hash the same as at its last render.
+import hashlib
+import inspect
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import matplotlib
+import pandas as pd
+
+DEFAULT_MANIFEST_PATH = ".render-manifest.json"
+
+class ChartJob:
+    """Render `plot_fn(*args, filename=filename, **kwargs)`, `plot_fn` must be a module-level function so it can be pickled."""
+    def __init__(self, filename: str, plot_fn: Callable[..., None], *args: Any, **kwargs: Any) -> None:
+        self.filename = filename
+        self.plot_fn = plot_fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def input_hash(self) -> str:
+        digest = hashlib.sha256()
+        # Editing the plotting code re-renders the chart as well
+        digest.update(inspect.getsource(self.plot_fn).encode("utf-8"))
+        for value in self.args:
+            _update_digest(digest, value)
+        for key in sorted(self.kwargs):
+            digest.update(key.encode("utf-8"))
+            _update_digest(digest, self.kwargs[key])
+        return digest.hexdigest()
+
+def _update_digest(digest, value: Any) -> None:
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        columns = value.columns if isinstance(value, pd.DataFrame) else [value.name]
+        digest.update(json.dumps(list(map(str, columns))).encode("utf-8"))
+        digest.update(pd.util.hash_pandas_object(value, index=False).values.tobytes())
+    else:
+        digest.update(json.dumps(value, sort_keys=True, default=str).encode("utf-8"))
+
+def _init_worker(style: Optional[str]) -> None:
+    matplotlib.use("Agg")
+    if style:
+        import matplotlib.pyplot as plt
+        plt.style.use(style)
+
+def _render(job: ChartJob) -> str:
+    job.plot_fn(*job.args, filename=job.filename, **job.kwargs)
+    return job.filename
+
+def _collect(job: ChartJob, result: Callable[[], str], rendered: List[str]) -> None:
+    try:
+        rendered.append(result())
+    except Exception as e:
+        # A failed chart is rendered again next time, the others are still recorded
+        print(f"Failed to render {job.filename}: {type(e).__name__}: {e}")
+
+def _load_manifest(manifest_path: str) -> Dict[str, str]:
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def render_charts(jobs: List[ChartJob], manifest_path: str = DEFAULT_MANIFEST_PATH, style: Optional[str] = None,
+                  max_workers: Optional[int] = None, force: bool = False) -> Tuple[List[str], List[str]]:
+    """Render the charts whose inputs changed since their last render, returning `(rendered, skipped)` filenames."""
+    manifest = _load_manifest(manifest_path)
+    hashes = {job.filename: job.input_hash() for job in jobs}
+    pending = [job for job in jobs
+               if force or manifest.get(job.filename) != hashes[job.filename] or not os.path.exists(job.filename)]
+    skipped = [job.filename for job in jobs if job not in pending]
+
+    rendered = []
+    if len(pending) == 1:
+        # A single chart is rendered in this process, without starting a pool
+        _init_worker(style)
+        _collect(pending[0], lambda: _render(pending[0]), rendered)
+    elif pending:
+        max_workers = min(len(pending), max_workers or os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(style,)) as executor:
+            futures = [executor.submit(_render, job) for job in pending]
+            for job, future in zip(pending, futures):
+                _collect(job, future.result, rendered)
+
+    for filename in rendered:
+        manifest[filename] = hashes[filename]
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    return rendered, skipped
@@ -10,8 +10,12 @@ from typing import List
 
 from structured_rag.models import PromptWithResponse, PromptingMethod, Experiment
 from structured_rag.run_test.utils_and_metrics.helpers import load_experiments
+from structured_rag.run_test.result_visualization.render_pipeline import ChartJob, render_charts
 
-def barplot_success_rates(df: pd.DataFrame):
+# Only these columns go into the charts, so changes to any other column do not trigger a re-render
+CHART_COLUMNS = ['test_name', 'model_name', 'prompting_method', 'success_rate']
+
+def barplot_success_rates(df: pd.DataFrame, filename: str = 'success_rates.png'):
     """
     This function plots the success rates of the models, averaged over the two prompting methods.
     """
@@ -22,10 +26,10 @@ def barplot_success_rates(df: pd.DataFrame):
     plt.title('Success Rates by Model and Prompting Method')
     plt.xlabel('Model Name')
     plt.ylabel('Success Rate')
-    plt.savefig('success_rates.png')
+    plt.savefig(filename)
     plt.close()
 
-def barplot_success_rates_per_test(df: pd.DataFrame):
+def barplot_success_rates_per_test(df: pd.DataFrame, filename: str = 'success_rates_per_test.png'):
     """
     This function plots the success rates of the models for each test.
     """
@@ -38,10 +42,10 @@ def barplot_success_rates_per_test(df: pd.DataFrame):
     plt.xticks(rotation=45, ha='right')
     plt.legend(title='Model Name', bbox_to_anchor=(1.05, 1), loc='upper left')
     plt.tight_layout()
-    plt.savefig('success_rates_per_test.png')
+    plt.savefig(filename)
     plt.close()
 
-def plot_success_rate_heatmap(df: pd.DataFrame, models: List[str]):
+def plot_success_rate_heatmap(df: pd.DataFrame, models: List[str], filename: str = 'success_rate_heatmap.png'):
     # Filter the dataframe for the specified models
     df_filtered = df[df['model_name'].isin(models)]
     
@@ -71,10 +75,10 @@ def plot_success_rate_heatmap(df: pd.DataFrame, models: List[str]):
     plt.gca().set_xticklabels(x_labels)
     
     plt.tight_layout()
-    plt.savefig('success_rate_heatmap.png')
+    plt.savefig(filename)
     plt.close()
 
-def boxplot_success_rate_per_task(df: pd.DataFrame):
+def boxplot_success_rate_per_task(df: pd.DataFrame, filename: str = 'boxplot_success_rates_per_task.png'):
     """
     This function plots the success rates for each test, averaged across all models.
     """
@@ -92,10 +96,10 @@ def boxplot_success_rate_per_task(df: pd.DataFrame):
     
     # Improve readability
     plt.tight_layout()
-    plt.savefig('boxplot_success_rates_per_task.png')
+    plt.savefig(filename)
     plt.close()
 
-def boxplot_success_rate_per_model(df: pd.DataFrame):
+def boxplot_success_rate_per_model(df: pd.DataFrame, filename: str = 'boxplot_success_rates_per_model.png'):
     """
     This function plots the success rates for each model, averaged across all tests.
     """
@@ -116,22 +120,27 @@ def boxplot_success_rate_per_model(df: pd.DataFrame):
     
     # Improve readability
     plt.tight_layout()
-    plt.savefig('boxplot_success_rates_per_model.png')
+    plt.savefig(filename)
     plt.close()
 
-def visualize_experiments(df: pd.DataFrame):
+def visualize_experiments(df: pd.DataFrame, force: bool = False):
+    """Render every chart in a process pool, skipping the ones whose data has not changed since the last render."""
+    df = df[CHART_COLUMNS]
+    heatmap_models = ["claude-3-5-sonnet-20240620", "llama3:instruct"]
+    jobs = [
+        ChartJob('success_rates.png', barplot_success_rates, df),
+        ChartJob('success_rates_per_test.png', barplot_success_rates_per_test, df),
+        ChartJob('success_rate_heatmap.png', plot_success_rate_heatmap, df[df['model_name'].isin(heatmap_models)], models=heatmap_models),
+        ChartJob('boxplot_success_rates_per_task.png', boxplot_success_rate_per_task, df),
+        ChartJob('boxplot_success_rates_per_model.png', boxplot_success_rate_per_model, df),
+    ]
     # Set the style for all plots
-    plt.style.use('ggplot')
-
-    barplot_success_rates(df)
-    barplot_success_rates_per_test(df)
-    plot_success_rate_heatmap(df, models=["claude-3-5-sonnet-20240620", "llama3:instruct"])
-    boxplot_success_rate_per_task(df)
-    boxplot_success_rate_per_model(df)
+    rendered, skipped = render_charts(jobs, style='ggplot', force=force)
+    print(f"Rendered {len(rendered)} charts, {len(skipped)} unchanged")
     
 if __name__ == "__main__":
     # Load experiments from the 'experiments' directory
-    df = load_experiments('experimental-results-9-11-24')
+    df = load_experiments('experimental-results-9-11-24', with_failed_responses=False)
     
     # Generate visualizations
     visualize_experiments(df)
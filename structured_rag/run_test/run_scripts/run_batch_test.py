@@ -5,34 +5,58 @@ import requests
 import time
 from pydantic import BaseModel
 
-from structured_rag.run_test.utils_and_metrics.helpers import Colors, load_json_from_file
-from structured_rag.run_test.utils_and_metrics.metrics import is_valid_json_output, assess_answerability_metric, classification_metric
+from structured_rag.run_test.utils_and_metrics.datasets import data_path, load_dataset
+from structured_rag.run_test.utils_and_metrics.helpers import Colors, format_failure_categories, summarize_failure_categories, summarize_repairs
+from structured_rag.run_test.utils_and_metrics.metrics import is_valid_json_output, validate_json_outputs, classify_failure, repair_json_output, assess_answerability_metric, classification_metric
 from structured_rag.run_test.utils_and_metrics.metrics import GenerateAnswerTaskMetric
 
-from typing import List
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from pydantic import BaseModel
 
-from structured_rag.mock_gfl.fstring_prompts import get_prompt
-from structured_rag.models import GenerateAnswer, RateContext, AssessAnswerability, ParaphraseQuestions, RAGAS, GenerateAnswerWithConfidence, GenerateAnswersWithConfidence, ClassifyDocument
-from structured_rag.models import test_params
+from structured_rag.mock_gfl.clients import get_http_session
+from structured_rag.mock_gfl.fstring_prompts import PromptTemplate
+from structured_rag.mock_gfl.response_cache import ResponseCache, CacheMiss, DEFAULT_CACHE_PATH
+from structured_rag.models import test_params, test_to_output_model
 from structured_rag.models import create_enum, _ClassifyDocument, _ClassifyDocumentWithRationale
 
 from structured_rag.models import Experiment, PromptWithResponse, PromptingMethod
 
 # Configuration variables
-url = "YOUR_MODAL_URL"
+url = "YOUR_MODAL_URL" # or "http://127.0.0.1:8000" for `local_mock_server.py`
+stream_url = "YOUR_MODAL_STREAM_URL" # `generate_web_stream` endpoint, or "http://127.0.0.1:8000/stream"
+STREAM_RESULTS = False # score results as they arrive from the streaming endpoint
 openai_api_key = "sk-foobar"
 test_type = "AssessAnswerability"
 save_dir = "results"
-dataset_filepath = "SuperBEIR"
+dataset_name = "SuperBEIR" # a dataset registered in `datasets.DATASETS`
+SUPERBEIR_SAMPLES = 340
+USE_RESPONSE_CACHE = True
+RESPONSE_CACHE_PATH = DEFAULT_CACHE_PATH
+REPLAY = False # only read responses from the cache, never call Modal
+MIXED_BATCH = False # run every task in `MIXED_BATCH_TASKS` as one engine submission
+JUDGE_CONCURRENCY = 16 # GenerateAnswer judge calls in flight
+JUDGE_PACK_SIZE = 1 # answers judged per GenerateAnswer judge call
+REPAIR_OUTPUTS = True # also measure how many failed outputs `repair_json_output` salvages, the strict success rate is unchanged
+
+# Tasks for `run_mixed_batch_test`, each with the dataset it is run on
+MIXED_BATCH_TASKS = {
+    "GenerateAnswer": "WikiQuestions",
+    "RateContext": "WikiQuestions",
+    "AssessAnswerability": "WikiQuestions",
+    "ParaphraseQuestions": "WikiQuestions",
+    "RAGAS": "WikiQuestions",
+    "GenerateAnswerWithConfidence": "WikiQuestions",
+    "GenerateAnswersWithConfidence": "WikiQuestions",
+    "ClassifyDocument": "SuperBEIR",
+    "ClassifyDocumentWithRationale": "SuperBEIR",
+}
 
 headers = {
     "Content-Type": "application/json",
     "Authorization": "Bearer YOUR_MODAL_API_KEY", # replace with your Modal API Key
 }
 
-def prepare_prompts_for_llama3(prompts: List[str]) -> List[str]:
-    prompt_preface = """<|begin_of_text|>
+LLAMA3_PROMPT_PREFACE = """<|begin_of_text|>
 <|start_header_id|>system<|end_header_id|>
 
 Cutting Knowledge Date: December 2023
@@ -42,97 +66,231 @@ You are a helpful assistant<|eot_id|>
 <|start_header_id|>user<|end_header_id|>
 """
 
-    prompt_ending = """<|eot_id|>
+LLAMA3_PROMPT_ENDING = """<|eot_id|>
 <|start_header_id|>assistant<|end_header_id|>"""
 
+def prepare_prompts_for_llama3(prompts: List[str]) -> List[str]:
     # Preface each prompt and append the ending
-    return [prompt_preface + prompt + prompt_ending for prompt in prompts]
+    return [LLAMA3_PROMPT_PREFACE + prompt + LLAMA3_PROMPT_ENDING for prompt in prompts]
 
-# currently doing nearly everything in this single function
-def run_batch_test(dataset_filepath, test_type, save_dir, with_outlines):
-    # fix this with a CLI argument `dataset`
-    # Leaving the hardcoded filepath
-    if dataset_filepath == "../../../data/WikiQuestions.json":
-        dataset = load_json_from_file(dataset_filepath)
-    else:
-        #dataset = load_superbeir()
-        dataset = load_json_from_file("../../../data/SuperBEIR/SuperBEIR-small-balanced.json")[:340]
+def expand_prefixed_batch(payload) -> List:
+    """The batch of `payload` with every shared prefix joined back onto its prompts."""
+    prefixes = payload.get("prefixes", {})
+    if "requests" in payload:
+        return [
+            {**{key: value for key, value in request.items() if key != "prefix_id"},
+             "prompt": prefixes.get(request.get("prefix_id"), "") + request["prompt"]}
+            for request in payload["requests"]
+        ]
+    prefix = prefixes.get(payload.get("prefix_id"), "")
+    return [prefix + prompt for prompt in payload["prompts"]]
 
-        # Load SuperBEIR categories and their descriptions
-        with open('../../../data/SuperBEIR/SuperBEIR-categories-with-rationales.json', 'r') as file:
-            data = json.load(file)
+def batch_cache_key(payload) -> str:
+    # vLLM runs with temperature 0, the whole batch is cached as one entry
+    # Mixed-task batches carry their schemas inside `requests`
+    # Keyed on the full prompts, so the key does not depend on how prompts share prefixes
+    batch = expand_prefixed_batch(payload)
+    return ResponseCache.make_key("modal", url, json.dumps(batch), temperature=0, schema=payload.get("output_model"))
 
-        # Create a list of dictionaries with category name and description
-        categories = [{category: info['category_description']} for category, info in data.items()]
+def post_batch(payload, response_cache: Optional[ResponseCache] = None) -> str:
+    def call_modal() -> str:
+        response = get_http_session("modal").post(url, headers=headers, json=payload, timeout=3000)  # Increased timeout to 5 minutes
+        response.raise_for_status()
+        return response.text
 
-        formatted_categories = ""
-        for category_dict in categories:
-            for category_name, category_description in category_dict.items():
-                formatted_categories += f"{category_name}: {category_description}\n"
+    if response_cache is None:
+        return call_modal()
+    return response_cache.get_or_call(batch_cache_key(payload), call_modal)
 
-        # Remove the trailing newline
-        formatted_categories = formatted_categories.rstrip()
-        categories = list(data.keys())
+def stream_batch(payload, response_cache: Optional[ResponseCache] = None) -> Iterator[Tuple[str, str]]:
+    """Yield `(id, response)` for each prompt as soon as it finishes on the streaming endpoint."""
+    if response_cache is not None:
+        cached = response_cache.get(batch_cache_key(payload))
+        if cached is not None:
+            for result in ast.literal_eval(cached):
+                yield str(result["id"]), result["answer"]
+            return
+        if response_cache.replay:
+            raise CacheMiss(f"No cached response for key {batch_cache_key(payload)}")
 
+    results = []
+    # The read timeout applies between lines, not to the whole batch
+    with get_http_session("modal").post(stream_url, headers=headers, json=payload, stream=True, timeout=(30, 600)) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            result = json.loads(line)
+            results.append({"id": result["id"], "answer": result["response"]})
+            yield str(result["id"]), result["response"]
 
-    # ToD, update to ablate `with_outlines`
-    payload = {
-        "with_outlines": True
-    }
+    # Only complete batches are cached, in the same format as the non-streaming endpoint
+    if response_cache is not None:
+        response_cache.put(batch_cache_key(payload), json.dumps(results))
 
-    # Get Pydantic Model to send to vLLM / Outlines
-    if with_outlines:
+def new_generate_answer_task_metric(response_cache: Optional[ResponseCache] = None) -> GenerateAnswerTaskMetric:
+    # Verdicts share the response cache, so rerunning a batch only judges the answers that changed
+    return GenerateAnswerTaskMetric(api_key=openai_api_key, max_concurrency=JUDGE_CONCURRENCY,
+                                    pack_size=JUDGE_PACK_SIZE, response_cache=response_cache)
+
+def judge_item(item: Dict, parsed_output) -> Dict[str, Any]:
+    return {"context": item["context"], "question": item["question"],
+            "system_answer": parsed_output["answer"], "ground_truth": item["answer"],
+            "answerable": item.get("answerable")}
+
+def judge_batch_outputs(test_type: str, items: List[Dict], validated_outputs: List[Tuple],
+                        generate_answer_task_metric=None) -> List[Optional[Tuple[int, str]]]:
+    """Judge every valid GenerateAnswer output of a batch concurrently, `None` for the other outputs and tasks and for unjudged answers."""
+    verdicts = [None] * len(items)
+    if test_type != "GenerateAnswer":
+        return verdicts
+    indices = [index for index, (_, is_valid) in enumerate(validated_outputs) if is_valid]
+    judge_items = [judge_item(items[index], validated_outputs[index][0]) for index in indices]
+    for index, verdict in zip(indices, generate_answer_task_metric.assess_answer_metrics(judge_items)):
+        verdicts[index] = verdict
+    return verdicts
+
+def score_streamed_output(deferred: List, batch_experiment: Experiment, test_type: str, item: Dict, output: str,
+                          parsed_output, is_valid: bool, generate_answer_task_metric=None, response_model=None) -> None:
+    """`score_batch_output` for a streamed result, valid GenerateAnswer outputs are judged in the background.
+
+    Their scoring is appended to `deferred` and finished by `score_deferred_outputs` once the stream ends.
+    """
+    if test_type == "GenerateAnswer" and is_valid:
+        verdict = generate_answer_task_metric.submit(**judge_item(item, parsed_output))
+        deferred.append((batch_experiment, test_type, item, output, parsed_output, verdict))
+    else:
+        score_batch_output(batch_experiment, test_type, item, output, parsed_output, is_valid, response_model=response_model)
+
+def score_deferred_outputs(deferred: List) -> None:
+    for batch_experiment, test_type, item, output, parsed_output, verdict in deferred:
+        try:
+            judge_verdict = verdict.result()
+        except CacheMiss as e:
+            print(f"{Colors.YELLOW}Not judged: {e}{Colors.ENDC}")
+            judge_verdict = None
+        score_batch_output(batch_experiment, test_type, item, output, parsed_output, True, judge_verdict=judge_verdict)
+
+def score_batch_output(batch_experiment: Experiment, test_type: str, item: Dict, output: str,
+                       parsed_output, is_valid: bool, judge_verdict: Optional[Tuple[int, str]] = None,
+                       response_model=None) -> None:
+    """Score one batch output against its dataset `item` and record it on `batch_experiment`.
+
+    `judge_verdict` is the GenerateAnswer judge's `(score, rationale)`, `None` if the judge could not score the
+    output (e.g. no cached verdict in replay mode, or the judge's retries ran out), which leaves it unjudged.
+    `response_model` is the model the output was validated against, to classify invalid outputs.
+    """
+    prompt_with_response = PromptWithResponse(
+        prompt="placeholder",
+        response=output
+    )
+    if is_valid:
+        print(f"{Colors.GREEN}Valid output:\n{output}{Colors.ENDC}")
+        batch_experiment.num_successes += 1
+        if test_type == "AssessAnswerability":
+            assess_answerability_response = parsed_output["answerable_question"]
+            print(f"{Colors.BOLD}Assess Answerability Response: {assess_answerability_response}{Colors.ENDC}")
+            task_metric = assess_answerability_metric(assess_answerability_response, item["answerable"])
+            print(f"{Colors.BOLD}Task Metric: {task_metric}{Colors.ENDC}")
+            batch_experiment.total_task_performance += task_metric
         if test_type == "GenerateAnswer":
-            payload["output_model"] = GenerateAnswer.schema()
-            generate_answer_task_metric = GenerateAnswerTaskMetric(api_key=openai_api_key)
-        elif test_type == "RateContext":
-            payload["output_model"] = RateContext.schema()
-        elif test_type == "AssessAnswerability":
-            payload["output_model"] = AssessAnswerability.schema()
-        elif test_type == "ParaphraseQuestions":
-            payload["output_model"] = ParaphraseQuestions.schema()
-        elif test_type == "RAGAS":
-            payload["output_model"] = RAGAS.schema()
-        elif test_type == "GenerateAnswerWithConfidence":
-            payload["output_model"] = GenerateAnswerWithConfidence.schema()
-        elif test_type == "GenerateAnswersWithConfidence":
-            payload["output_model"] = GenerateAnswersWithConfidence.schema()
-        elif test_type == "ClassifyDocument":
-            ClassifyDocumentModel = _ClassifyDocument(categories)
-            payload["output_model"] = ClassifyDocumentModel.schema()
-        elif test_type == "ClassifyDocumentWithRationale":
-            ClassifyDocumentWithRationale = _ClassifyDocumentWithRationale(categories)
-            payload["output_model"] = ClassifyDocumentWithRationale.schema()
+            answer_response = parsed_output["answer"]
+            print(f"{Colors.BOLD}Answer Response: {answer_response}{Colors.ENDC}")
+            print(f"{Colors.RED}Ground Truth: {item['answer']}{Colors.ENDC}")
+            if judge_verdict is None:
+                # The output stays valid but has no task metric
+                print(f"{Colors.YELLOW}Not judged{Colors.ENDC}")
+                batch_experiment.num_unjudged += 1
+            else:
+                task_metric, rationale = judge_verdict
+                print(f"{Colors.BOLD}Task Metric: {task_metric}{Colors.ENDC}\n")
+                print(f"{Colors.CYAN}Rationale: {rationale}{Colors.ENDC}")
+                batch_experiment.total_task_performance += task_metric
+        if test_type == "ClassifyDocument":
+            classification_response = parsed_output["category"] # extend to return classification and rationale
+            print(f"{Colors.BOLD}Classification Response: {classification_response}{Colors.ENDC}")
+            ground_truth = item["label"]
+            print(f"{Colors.CYAN}Ground Truth: {ground_truth}{Colors.ENDC}")
+            task_metric = classification_metric(classification_response, ground_truth)
+            print(f"{Colors.BOLD}Task Metric: {task_metric}{Colors.ENDC}")
+            batch_experiment.total_task_performance += task_metric
+        if test_type == "ClassifyDocumentWithRationale":
+            # ToDo, extend to do something with the rationale as well
+            classification_response = parsed_output["category"] # extend to return classification and rationale
+            print(f"{Colors.BOLD}Classification Response: {classification_response}{Colors.ENDC}")
+            ground_truth = item["label"]
+            print(f"{Colors.CYAN}Ground Truth: {ground_truth}{Colors.ENDC}")
+            task_metric = classification_metric(classification_response, ground_truth)
+            print(f"{Colors.BOLD}Task Metric: {task_metric}{Colors.ENDC}")
+            batch_experiment.total_task_performance += task_metric
+    else:
+        print(f"{Colors.RED}Invalid output:\n{output}{Colors.ENDC}")
+        prompt_with_response.failure_category = classify_failure(output, test_type, response_model)
+        if REPAIR_OUTPUTS:
+            _, prompt_with_response.repaired = repair_json_output(output, test_type, response_model)
+        batch_experiment.failed_responses.append(prompt_with_response)
+    batch_experiment.num_attempts += 1
+    batch_experiment.all_responses.append(prompt_with_response)
 
-    # ToDo, ablate interfacing the response_format instructions with structured decoding?
+def load_batch_dataset(dataset_name):
+    """Return `(dataset, categories, formatted_categories)`, the categories are only set for SuperBEIR."""
+    if dataset_name != "SuperBEIR":
+        return load_dataset(dataset_name), None, None
 
-    prompts = []
-    for item in dataset:
-        # ToDo, fix this
-        if test_type == "ClassifyDocument" or test_type == "ClassifyDocumentWithRationale":
-            references = {"document": item["document"],
-                          "label": item["label"],
-                          "classes_with_descriptions": formatted_categories}
-        else:
-            references = {"context": item["context"], 
-                          "question": item["question"],
-                          "answer": item["answer"]}
-        formatted_prompt = get_prompt(test_type, references, test_params[test_type])
-        prompts.append(formatted_prompt)
+    # Only the first `SUPERBEIR_SAMPLES` rows are ever read
+    dataset = load_dataset(dataset_name).head(SUPERBEIR_SAMPLES)
 
-    prompts_for_llama3 = prepare_prompts_for_llama3(prompts)
+    # Load SuperBEIR categories and their descriptions
+    with open(data_path('SuperBEIR/SuperBEIR-categories-with-rationales.json'), 'r') as file:
+        data = json.load(file)
 
-    payload["prompts"] = prompts_for_llama3
+    # Create a list of dictionaries with category name and description
+    categories = [{category: info['category_description']} for category, info in data.items()]
 
-    start_time = time.time()
-    # Run all inferences
-    response = requests.post(url, headers=headers, json=payload, timeout=3000)  # Increased timeout to 5 minutes
-    total_time = time.time() - start_time
-    print(f"Total time taken: {total_time} seconds")
-    print(f"Average time per task: {(total_time) / len(prompts):.2f} seconds")
+    formatted_categories = ""
+    for category_dict in categories:
+        for category_name, category_description in category_dict.items():
+            formatted_categories += f"{category_name}: {category_description}\n"
+
+    # Remove the trailing newline
+    formatted_categories = formatted_categories.rstrip()
+    categories = list(data.keys())
+    return dataset, categories, formatted_categories
 
-    # check the `int` valued total_time, I don't think that's right
-    batch_experiment = Experiment(
+def get_batch_response_model(test_type, categories):
+    # Classify tasks restrict `category` to the dataset's classes, other tasks use `test_to_output_model`
+    if test_type == "ClassifyDocument":
+        return _ClassifyDocument(categories)
+    if test_type == "ClassifyDocumentWithRationale":
+        return _ClassifyDocumentWithRationale(categories)
+    return None
+
+def build_batch_prompts(test_type, dataset, formatted_categories=None) -> Tuple[PromptTemplate, List[str]]:
+    """Return the compiled template of `test_type` and the per-item suffix of every prompt.
+
+    The Llama 3 preface, the instructions and the SuperBEIR class descriptions are the same for
+    every item, so they are rendered once into `template.prefix` and sent once per batch, which
+    lets the server prefill them once and serve every request from vLLM's prefix cache.
+    """
+    # ToDo, ablate interfacing the response_format instructions with structured decoding?
+    shared_references = None
+    # ToDo, fix this
+    if test_type == "ClassifyDocument" or test_type == "ClassifyDocumentWithRationale":
+        # Ahead of the document, so the class descriptions are part of the shared prefix
+        shared_references = {"classes_with_descriptions": formatted_categories}
+    template = PromptTemplate(test_type, test_params[test_type], shared_references,
+                              chat_prefix=LLAMA3_PROMPT_PREFACE, chat_suffix=LLAMA3_PROMPT_ENDING)
+
+    if shared_references is not None:
+        references = ({"document": item["document"], "label": item["label"]} for item in dataset)
+    else:
+        references = ({"context": item["context"],
+                       "question": item["question"],
+                       "answer": item["answer"]} for item in dataset)
+    return template, template.render_all(references)
+
+def new_batch_experiment(test_type) -> Experiment:
+    return Experiment(
         test_name=test_type,
         model_name="llama3.2-3B-Instruct-Modal",
         prompting_method=PromptingMethod.fstring,
@@ -141,85 +299,226 @@ def run_batch_test(dataset_filepath, test_type, save_dir, with_outlines):
         num_attempts=0,
         success_rate=0,
         average_task_performance=0,
-        total_time=int(total_time),
+        total_time=0,
         all_responses=[],
         failed_responses=[]
     )
 
-    if response.status_code == 200:
-        response_list = ast.literal_eval(response.text)
-        results_dict = {int(result["id"]): result["answer"] for result in response_list}
-        sorted_results = dict(sorted(results_dict.items()))
-        for id, output in sorted_results.items():
-            if is_valid_json_output(output, test_type):
-                print(f"{Colors.GREEN}Valid output:\n{output}{Colors.ENDC}")
-                batch_experiment.num_successes += 1
-                if test_type == "AssessAnswerability":
-                    assess_answerability_response = json.loads(output)["answerable_question"]
-                    print(f"{Colors.BOLD}Assess Answerability Response: {assess_answerability_response}{Colors.ENDC}")
-                    task_metric = assess_answerability_metric(assess_answerability_response, dataset[id]["answerable"])
-                    print(f"{Colors.BOLD}Task Metric: {task_metric}{Colors.ENDC}")
-                    batch_experiment.total_task_performance += task_metric
-                if test_type == "GenerateAnswer":
-                    answer_response = json.loads(output)["answer"]
-                    print(f"{Colors.BOLD}Answer Response: {answer_response}{Colors.ENDC}")
-                    print(f"{Colors.RED}Ground Truth: {dataset[id]['answer']}{Colors.ENDC}")
-                    task_metric, rationale = generate_answer_task_metric.assess_answer_metric(context=dataset[id]["context"], 
-                                                                                   question=dataset[id]["question"], 
-                                                                                   system_answer=answer_response, 
-                                                                                   ground_truth=dataset[id]["answer"])
-                    print(f"{Colors.BOLD}Task Metric: {task_metric}{Colors.ENDC}\n")
-                    print(f"{Colors.CYAN}Rationale: {rationale}{Colors.ENDC}")
-                    batch_experiment.total_task_performance += task_metric
-                if test_type == "ClassifyDocument":
-                    classification_response = json.loads(output)["category"] # extend to return classification and rationale
-                    print(f"{Colors.BOLD}Classification Response: {classification_response}{Colors.ENDC}")
-                    ground_truth = dataset[id]["label"]
-                    print(f"{Colors.CYAN}Ground Truth: {ground_truth}{Colors.ENDC}")
-                    task_metric = classification_metric(classification_response, ground_truth)
-                    print(f"{Colors.BOLD}Task Metric: {task_metric}{Colors.ENDC}")
-                    batch_experiment.total_task_performance += task_metric
-                if test_type == "ClassifyDocumentWithRationale":
-                    # ToDo, extend to do something with the rationale as well
-                    classification_response = json.loads(output)["category"] # extend to return classification and rationale
-                    print(f"{Colors.BOLD}Classification Response: {classification_response}{Colors.ENDC}")
-                    ground_truth = dataset[id]["label"]
-                    print(f"{Colors.CYAN}Ground Truth: {ground_truth}{Colors.ENDC}")
-                    task_metric = classification_metric(classification_response, ground_truth)
-                    print(f"{Colors.BOLD}Task Metric: {task_metric}{Colors.ENDC}")
-                    batch_experiment.total_task_performance += task_metric
-            else:
-                print(f"{Colors.RED}Invalid output:\n{output}{Colors.ENDC}")
-                batch_experiment.failed_responses.append(PromptWithResponse(
-                    prompt="placeholder",
-                    response=output
-                ))
-            batch_experiment.num_attempts += 1
-            batch_experiment.all_responses.append(PromptWithResponse(
-                prompt="placeholder",
-                response=output
-            ))
-
-        batch_experiment.success_rate = batch_experiment.num_successes / batch_experiment.num_attempts
-        batch_experiment.average_task_performance = batch_experiment.total_task_performance / batch_experiment.num_attempts
-        print(f"{Colors.GREEN}JSON Success rate: {batch_experiment.success_rate:.2f}{Colors.ENDC}")
-        print(f"{Colors.GREEN}Average task performance: {batch_experiment.average_task_performance:.2f}{Colors.ENDC}")
-        print(f"{Colors.GREEN}Time to run experiment: {total_time} seconds{Colors.ENDC}")
-        
-        # serialize experiment to JSON
-        os.makedirs(save_dir, exist_ok=True)
-
-        # Fix this save path
-        batch_result_file = os.path.join(save_dir, f"{test_type}-Modal-vLLM.json")
-
-        with open(batch_result_file, "w") as f:
-            json.dump(batch_experiment.dict(), f, indent=2)
-        
-        print(f"\nResults saved in {batch_result_file}.")
+def save_batch_experiment(batch_experiment: Experiment, test_type, save_dir, total_time, scoring_time=None,
+                          num_requested=None) -> None:
+    """Save `batch_experiment`, `total_time` is the time until the last result arrived and `scoring_time` the time spent scoring after that."""
+    batch_experiment.total_time = total_time
+    batch_experiment.scoring_time = scoring_time
+    if batch_experiment.num_attempts == 0:
+        print(f"{Colors.RED}No results for {test_type}, nothing saved.{Colors.ENDC}")
+        return
+    if num_requested is not None and batch_experiment.num_attempts < num_requested:
+        batch_experiment.partial = True
+        print(f"{Colors.RED}Partial results for {test_type}: {batch_experiment.num_attempts}/{num_requested}{Colors.ENDC}")
+
+    batch_experiment.success_rate = batch_experiment.num_successes / batch_experiment.num_attempts
+    # Unjudged outputs have no task metric, so they are left out of the average
+    num_scored = batch_experiment.num_attempts - batch_experiment.num_unjudged
+    batch_experiment.average_task_performance = batch_experiment.total_task_performance / num_scored if num_scored else 0
+    if batch_experiment.num_unjudged:
+        print(f"{Colors.YELLOW}{batch_experiment.num_unjudged} valid outputs were not judged{Colors.ENDC}")
+    summarize_failure_categories(batch_experiment)
+    print(f"{Colors.GREEN}JSON Success rate: {batch_experiment.success_rate:.2f}{Colors.ENDC}")
+    if REPAIR_OUTPUTS:
+        summarize_repairs(batch_experiment)
+        print(f"{Colors.GREEN}JSON Success rate after repair: {batch_experiment.repaired_success_rate:.2f} ({batch_experiment.num_repaired} repaired){Colors.ENDC}")
+    print(f"{Colors.GREEN}Average task performance: {batch_experiment.average_task_performance:.2f}{Colors.ENDC}")
+    print(f"{Colors.GREEN}Time to run experiment: {total_time} seconds{Colors.ENDC}")
+    if scoring_time is not None:
+        print(f"{Colors.GREEN}Time to score results: {scoring_time} seconds{Colors.ENDC}")
+    if batch_experiment.failure_categories:
+        print(f"{Colors.RED}Failures by category: {format_failure_categories(batch_experiment)}{Colors.ENDC}")
+    
+    # serialize experiment to JSON
+    os.makedirs(save_dir, exist_ok=True)
+
+    # Fix this save path
+    batch_result_file = os.path.join(save_dir, f"{test_type}-Modal-vLLM.json")
 
+    with open(batch_result_file, "w") as f:
+        json.dump(batch_experiment.dict(), f, indent=2)
+    
+    print(f"\nResults saved in {batch_result_file}.")
+
+def fetch_batch_results(payload, response_cache: Optional[ResponseCache] = None) -> Optional[Dict[str, str]]:
+    """POST `payload` and return `{id: response}`, or None if the batch failed."""
+    try:
+        response_text = post_batch(payload, response_cache)
+    except requests.HTTPError as e:
+        print(f"Error: {e.response.status_code}")
+        print(e.response.text)
+        return None
+    except CacheMiss as e:
+        print(f"Error: {e}")
+        return None
+
+    response_list = ast.literal_eval(response_text)
+    return {str(result["id"]): result["answer"] for result in response_list}
+
+# currently doing nearly everything in this single function
+def run_batch_test(dataset_name, test_type, save_dir, with_outlines):
+    dataset, categories, formatted_categories = load_batch_dataset(dataset_name)
+
+    # ToD, update to ablate `with_outlines`
+    payload = {
+        "with_outlines": True
+    }
+
+    # Get Pydantic Model to send to vLLM / Outlines
+    response_model = get_batch_response_model(test_type, categories)
+    if with_outlines:
+        # Outputs are validated against the model they were constrained to, e.g. GenerateAnswersWithConfidence's `answers` wrapper
+        response_model = response_model or test_to_output_model[test_type]
+        payload["output_model"] = response_model.schema()
+
+    template, prompts = build_batch_prompts(test_type, dataset, formatted_categories)
+    payload["prefixes"] = {template.prefix_id: template.prefix}
+    payload["prefix_id"] = template.prefix_id
+    payload["prompts"] = prompts
+
+    response_cache = ResponseCache(RESPONSE_CACHE_PATH, replay=REPLAY) if USE_RESPONSE_CACHE or REPLAY else None
+
+    generate_answer_task_metric = None
+    if test_type == "GenerateAnswer":
+        generate_answer_task_metric = new_generate_answer_task_metric(response_cache)
+
+    batch_experiment = new_batch_experiment(test_type)
+
+    start_time = time.time()
+    # Run all inferences
+    if STREAM_RESULTS:
+        # Score each result while the rest of the batch is still generating
+        deferred = []
+        try:
+            for id, output in stream_batch(payload, response_cache):
+                parsed_output, is_valid = is_valid_json_output(output, test_type, response_model)
+                score_streamed_output(deferred, batch_experiment, test_type, dataset[int(id)], output, parsed_output, is_valid,
+                                      generate_answer_task_metric, response_model)
+        except (requests.RequestException, CacheMiss) as e:
+            print(f"{Colors.RED}Stream ended after {batch_experiment.num_attempts + len(deferred)}/{len(prompts)} results: {e}{Colors.ENDC}")
+        # Results are scored while they stream in, only the judging still in flight is scoring time
+        generation_time = time.time() - start_time
+        score_deferred_outputs(deferred)
     else:
-        print(f"Error: {response.status_code}")
-        print(response.text)
+        results_dict = fetch_batch_results(payload, response_cache)
+        generation_time = time.time() - start_time
+        if results_dict is not None:
+            sorted_results = dict(sorted((int(id), output) for id, output in results_dict.items()))
+            # Validate the whole batch up front with the compiled validator for this task
+            validated_outputs = validate_json_outputs(list(sorted_results.values()), test_type, response_model)
+            items = [dataset[id] for id in sorted_results]
+            # Judge the whole batch concurrently instead of one answer at a time in the loop below
+            verdicts = judge_batch_outputs(test_type, items, validated_outputs, generate_answer_task_metric)
+            for (id, output), item, (parsed_output, is_valid), verdict in zip(sorted_results.items(), items, validated_outputs, verdicts):
+                score_batch_output(batch_experiment, test_type, item, output, parsed_output, is_valid, verdict, response_model)
+
+    scoring_time = time.time() - start_time - generation_time
+    print(f"Total time taken: {generation_time} seconds")
+    print(f"Average time per task: {(generation_time) / len(prompts):.2f} seconds")
+    print(f"Scoring time: {scoring_time} seconds")
+    if generate_answer_task_metric is not None:
+        print(f"{Colors.BOLD}GenerateAnswer verdicts by tier: {generate_answer_task_metric.tier_summary()}{Colors.ENDC}")
+
+    save_batch_experiment(batch_experiment, test_type, save_dir, generation_time, scoring_time, len(prompts))
+
+def split_request_id(request_id: str) -> Tuple[str, int]:
+    # Mixed-task request ids are "{test_type}:{index into the task's dataset}"
+    test_type, index = request_id.rsplit(":", 1)
+    return test_type, int(index)
+
+def run_mixed_batch_test(tasks: Dict[str, str], save_dir, with_outlines):
+    """Run several tasks in one engine submission with per-request output schemas.
+
+    `tasks` maps each test type to its dataset. The results are demultiplexed by request id
+    and scored into one `Experiment` per task, so the engine stays full across the whole sweep
+    instead of draining between one-task batches.
+    """
+    batch_tasks = {}
+    batch_requests = []
+    # Tasks with the same prefix share one entry
+    prefixes = {}
+    for test_type, dataset_name in tasks.items():
+        dataset, categories, formatted_categories = load_batch_dataset(dataset_name)
+        response_model = get_batch_response_model(test_type, categories)
+        output_model = None
+        if with_outlines:
+            response_model = response_model or test_to_output_model[test_type]
+            output_model = response_model.schema()
+        template, prompts = build_batch_prompts(test_type, dataset, formatted_categories)
+        prefixes[template.prefix_id] = template.prefix
+        batch_tasks[test_type] = {
+            "dataset": dataset,
+            "response_model": response_model,
+            "experiment": new_batch_experiment(test_type)
+        }
+        # Requests of a task share a schema, so they stay grouped for the server
+        for index, prompt in enumerate(prompts):
+            batch_requests.append({"id": f"{test_type}:{index}", "prompt": prompt, "output_model": output_model,
+                                   "prefix_id": template.prefix_id})
+
+    payload = {
+        "with_outlines": with_outlines,
+        "prefixes": prefixes,
+        "requests": batch_requests
+    }
+
+    response_cache = ResponseCache(RESPONSE_CACHE_PATH, replay=REPLAY) if USE_RESPONSE_CACHE or REPLAY else None
+
+    generate_answer_task_metric = None
+    if "GenerateAnswer" in batch_tasks:
+        generate_answer_task_metric = new_generate_answer_task_metric(response_cache)
+
+    start_time = time.time()
+    if STREAM_RESULTS:
+        deferred = []
+        try:
+            for request_id, output in stream_batch(payload, response_cache):
+                test_type, index = split_request_id(request_id)
+                task = batch_tasks[test_type]
+                parsed_output, is_valid = is_valid_json_output(output, test_type, task["response_model"])
+                score_streamed_output(deferred, task["experiment"], test_type, task["dataset"][index], output, parsed_output, is_valid,
+                                      generate_answer_task_metric, task["response_model"])
+        except (requests.RequestException, CacheMiss) as e:
+            num_results = sum(task["experiment"].num_attempts for task in batch_tasks.values()) + len(deferred)
+            print(f"{Colors.RED}Stream ended after {num_results}/{len(batch_requests)} results: {e}{Colors.ENDC}")
+        generation_time = time.time() - start_time
+        score_deferred_outputs(deferred)
+    else:
+        results_dict = fetch_batch_results(payload, response_cache)
+        generation_time = time.time() - start_time
+        if results_dict is not None:
+            results_by_task = {test_type: {} for test_type in batch_tasks}
+            for request_id, output in results_dict.items():
+                test_type, index = split_request_id(request_id)
+                results_by_task[test_type][index] = output
+            for test_type, task_results in results_by_task.items():
+                task = batch_tasks[test_type]
+                sorted_results = dict(sorted(task_results.items()))
+                validated_outputs = validate_json_outputs(list(sorted_results.values()), test_type, task["response_model"])
+                items = [task["dataset"][index] for index in sorted_results]
+                verdicts = judge_batch_outputs(test_type, items, validated_outputs, generate_answer_task_metric)
+                for (index, output), item, (parsed_output, is_valid), verdict in zip(sorted_results.items(), items, validated_outputs, verdicts):
+                    score_batch_output(task["experiment"], test_type, item, output, parsed_output, is_valid, verdict,
+                                       task["response_model"])
+
+    # Every task shares the generation and scoring time of the mixed batch
+    scoring_time = time.time() - start_time - generation_time
+    print(f"Total time taken: {generation_time} seconds for {len(batch_requests)} requests across {len(batch_tasks)} tasks")
+    print(f"Scoring time: {scoring_time} seconds")
+    if generate_answer_task_metric is not None:
+        print(f"{Colors.BOLD}GenerateAnswer verdicts by tier: {generate_answer_task_metric.tier_summary()}{Colors.ENDC}")
+
+    for test_type, task in batch_tasks.items():
+        print(f"{Colors.BOLD}{test_type}{Colors.ENDC}")
+        save_batch_experiment(task["experiment"], test_type, save_dir, generation_time, scoring_time, len(task["dataset"]))
 
 if __name__ == "__main__":
-    run_batch_test(dataset_filepath, test_type, save_dir, with_outlines=True)
\ No newline at end of file
+    if MIXED_BATCH:
+        run_mixed_batch_test(MIXED_BATCH_TASKS, save_dir, with_outlines=True)
+    else:
+        run_batch_test(dataset_name, test_type, save_dir, with_outlines=True)
\ No newline at end of file
@@ -1,16 +1,25 @@
+import asyncio
 import json
 import os
 import datetime
 import time
 
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
 from pydantic import BaseModel
 
 from structured_rag.mock_gfl.dspy_program import dspy_Program
 from structured_rag.mock_gfl.fstring_program import fstring_Program
+from structured_rag.mock_gfl.health_check import HealthChecker
+from structured_rag.mock_gfl.rate_limiter import TransportError
+from structured_rag.mock_gfl.response_cache import ResponseCache, CacheMiss, DEFAULT_CACHE_PATH
+from structured_rag.mock_gfl.instrumentation import trace_request
 
-from structured_rag.run_test.utils_and_metrics.helpers import Colors, load_json_from_file
-from structured_rag.run_test.utils_and_metrics.metrics import is_valid_json_output, assess_answerability_metric
+from structured_rag.run_test.utils_and_metrics.datasets import Dataset, load_dataset
+from structured_rag.run_test.utils_and_metrics.helpers import Colors, format_failure_categories, summarize_failure_categories, summarize_repairs, summarize_request_metrics
+from structured_rag.run_test.utils_and_metrics.metrics import is_valid_json_output, classify_failure, repair_json_output, assess_answerability_metric
+from structured_rag.run_test.utils_and_metrics.result_journal import ResultJournal
+from structured_rag.run_test.utils_and_metrics.result_store import DEFAULT_RESULT_STORE, pyarrow_available, write_experiment
 
 from structured_rag.models import Experiment, PromptWithResponse, PromptingMethod, SingleTestResult
 from structured_rag.models import test_params, test_to_output_model
@@ -19,30 +28,52 @@ from structured_rag.models import test_params, test_to_output_model
 MODEL_NAME = "gpt-4o"
 MODEL_PROVIDER = "openai" # one of: "ollama", "google", "openai", "anthropic"
 API_KEY = ""
+DATASET = "WikiQuestions" # a dataset registered in `datasets.DATASETS`
 TEST_TYPE = "AssessAnswerability" # one of: "GenerateAnswer", "RateContext", "AssessAnswerability", "ParaphraseQuestions", "RAGAS", "RateMultipleAspects", "GenerateAnswerWithConfidence", "GenerateAnswersWithConfidence"
 SAVE_DIR = "results"
+USE_RESPONSE_CACHE = True
+RESPONSE_CACHE_PATH = DEFAULT_CACHE_PATH
+REPLAY = False # only read responses from the cache, never call the provider
+STREAM = False # stream f-string responses and stop as soon as they provably violate the format
+RESUME = False # continue the sweep from its journal, skipping (program, entry) pairs that already finished
+RESULT_STORE_PATH = DEFAULT_RESULT_STORE # Parquet result store, also written when pyarrow is installed
+HEALTH_CHECK = True # say hello to the provider once before the sweep, skipped in replay / offline runs
+REPAIR_OUTPUTS = True # also measure how many failed outputs `repair_json_output` salvages, the strict success rate is unchanged
+
+# Maximum number of in-flight requests per provider, raise these up to your account's rate limits
+MAX_CONCURRENCY = {
+    "ollama": 1,
+    "google": 8,
+    "openai": 16,
+    "anthropic": 8,
+}
 
 def run_single_test(output_model: Optional[BaseModel],
-                    program, test_type, title, context, question, answer, task_specific_ground_truth) -> SingleTestResult:
+                    program, test_type, title, context, question, answer, task_specific_ground_truth) -> Optional[SingleTestResult]:
     try:
-        if test_type == "ParaphraseQuestions":
-            output = program.forward(output_model, test_type, question=question)
-        elif test_type == "RAGAS":
-            output = program.forward(output_model, test_type, context, question, answer)
-        else:
-            output = program.forward(output_model, test_type, context, question)
+        with trace_request() as trace:
+            if test_type == "ParaphraseQuestions":
+                output = program.forward(output_model, test_type, question=question)
+            elif test_type == "RAGAS":
+                output = program.forward(output_model, test_type, context, question, answer)
+            else:
+                output = program.forward(output_model, test_type, context, question)
 
         print(f"{Colors.CYAN}{program.__class__.__name__} Output: {output}{Colors.ENDC}\n")
 
         task_metric = 0
+        failure_category = None
+        repaired = False
 
-        parsed_output, is_valid = is_valid_json_output(output, test_type)
+        # Constrained responses have the shape of `output_model`, e.g. GenerateAnswersWithConfidence's `answers` wrapper
+        response_model = output_model if program.constrained_outputs else None
+        parsed_output, is_valid = is_valid_json_output(output, test_type, response_model)
 
         if is_valid:
             print(f"{Colors.GREEN}Valid output for {test_type}{Colors.ENDC}")
             is_valid = True
             if test_type == "AssessAnswerability":
-                answerable_question_response = parsed_output # not necessary, but lazy
+                answerable_question_response = parsed_output["answerable_question"]
                 # print(f"{Colors.BOLD}Assess Answerability Response: {answerable_question_response}{Colors.ENDC}")
                 # print(f"{Colors.CYAN}Ground truth answerability: {task_specific_ground_truth}{Colors.ENDC}\n")
                 # print(f"Predicted type {type(answerable_question_response)}\n")
@@ -50,18 +81,90 @@ def run_single_test(output_model: Optional[BaseModel],
                 task_metric = assess_answerability_metric(answerable_question_response, task_specific_ground_truth)
                 print(f"{Colors.BOLD}Task Metric: {task_metric}{Colors.ENDC}")
         else:
-            print(f"{Colors.RED}Invalid output for {test_type}{Colors.ENDC}")
+            failure_category = classify_failure(output, test_type, response_model)
+            print(f"{Colors.RED}Invalid output for {test_type} ({failure_category}){Colors.ENDC}")
+            if REPAIR_OUTPUTS:
+                _, repaired = repair_json_output(output, test_type, response_model)
+
+        prompt_with_response = PromptWithResponse(
+            prompt=f"Title: {title}\nContext: {context}\nQuestion: {question}",
+            response=output,
+            latency=trace.latency,
+            input_tokens=trace.input_tokens,
+            output_tokens=trace.output_tokens,
+            num_retries=trace.num_retries,
+            cached=trace.cached,
+            time_to_first_token=trace.time_to_first_token,
+            time_to_first_valid_token=trace.time_to_first_valid_token,
+            aborted_early=trace.aborted_early,
+            failure_category=failure_category,
+            repaired=repaired
+        )
+        return SingleTestResult(prompt_with_response=prompt_with_response, is_valid=is_valid, task_metric=task_metric)
 
-        return SingleTestResult(prompt_with_response=PromptWithResponse(prompt=f"Title: {title}\nContext: {context}\nQuestion: {question}", response=output), is_valid=is_valid, task_metric=task_metric)
+    except (TransportError, CacheMiss) as e:
+        # Not a format failure, leave it out of the Experiment instead of scoring it
+        print(f"{Colors.YELLOW}No response: {str(e)}{Colors.ENDC}")
+        print(f"{Colors.RED}Not recording this test.{Colors.ENDC}")
+        return None
 
     except Exception as e:
         print(f"{Colors.YELLOW}Error occurred: {str(e)}{Colors.ENDC}")
         print(f"{Colors.RED}Skipping this test due to error.{Colors.ENDC}")
-        return SingleTestResult(prompt_with_response=PromptWithResponse(prompt=f"Title: {title}\nContext: {context}\nQuestion: {question}", response="Error"), is_valid=False, task_metric=0)
+        return SingleTestResult(prompt_with_response=PromptWithResponse(prompt=f"Title: {title}\nContext: {context}\nQuestion: {question}", response="Error", failure_category="error"), is_valid=False, task_metric=0)
+
+def run_entry(output_model: Optional[BaseModel], program, entry: Dict) -> Optional[SingleTestResult]:
+    title = entry.get('title', '')
+    context = entry.get('context', '')
+    question = entry.get('question', '')
+    answer = entry.get('answer', '')
+    answerable = entry.get('answerable', '')
+
+    print(f"{Colors.UNDERLINE}Title: {title}{Colors.ENDC}")
+    print(f"{Colors.UNDERLINE}Question: {question}{Colors.ENDC}\n")
+
+    return run_single_test(
+        output_model=output_model,
+        program=program,
+        test_type=TEST_TYPE,
+        title=title,
+        context=context,
+        question=question,
+        answer=answer,
+        task_specific_ground_truth=answerable
+    )
+
+async def run_program_async(program, output_model: Optional[BaseModel], json_data: Dataset, concurrency: int,
+                            completed: Optional[Dict[int, SingleTestResult]] = None,
+                            on_result: Optional[Callable[[int, SingleTestResult], None]] = None) -> List[Optional[SingleTestResult]]:
+    """Run `program` over every dataset entry with at most `concurrency` requests in flight.
+
+    The provider SDKs behind `fstring_Program` and `dspy_Program` are synchronous, so each
+    `forward` call runs in a worker thread. Results are returned in dataset order.
+    Entries in `completed` (by index) are not run again, and `on_result` is called with each
+    new result as soon as it finishes.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    completed = completed or {}
+
+    def run_and_record(index: int, entry: Dict) -> Optional[SingleTestResult]:
+        result = run_entry(output_model, program, entry)
+        if result is not None and on_result is not None:
+            on_result(index, result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        async def run_entry_async(index: int, entry: Dict) -> Optional[SingleTestResult]:
+            if index in completed:
+                return completed[index]
+            async with semaphore:
+                return await loop.run_in_executor(executor, run_and_record, index, entry)
+
+        return await asyncio.gather(*(run_entry_async(index, entry) for index, entry in enumerate(json_data)))
 
 def run_test():
-    filename = "../../../data/WikiQuestions.json"
-    json_data = load_json_from_file(filename)
+    json_data = load_dataset(DATASET)
 
     print(f"{Colors.BOLD}Number of samples in the dataset: {len(json_data)}{Colors.ENDC}")
 
@@ -71,6 +174,8 @@ def run_test():
     test_to_run = test_params[TEST_TYPE]
     output_model = test_to_output_model[TEST_TYPE]
 
+    response_cache = ResponseCache(RESPONSE_CACHE_PATH, replay=REPLAY) if USE_RESPONSE_CACHE or REPLAY else None
+
     # Define program configurations
     program_configs = [
         # DSPy Programs
@@ -82,7 +187,8 @@ def run_test():
                 'test_params': test_to_run,
                 'model_name': MODEL_NAME,
                 'model_provider': MODEL_PROVIDER,
-                'api_key': API_KEY
+                'api_key': API_KEY,
+                'response_cache': response_cache
             }
         },
         {
@@ -93,7 +199,8 @@ def run_test():
                 'test_params': test_to_run,
                 'model_name': MODEL_NAME,
                 'model_provider': MODEL_PROVIDER,
-                'api_key': API_KEY
+                'api_key': API_KEY,
+                'response_cache': response_cache
             }
         },
         # f-string Programs
@@ -102,10 +209,12 @@ def run_test():
             'type': 'fstring',
             'params': {
                 'structured_outputs': False,
+                'stream': STREAM,
                 'test_params': test_to_run,
                 'model_name': MODEL_NAME,
                 'model_provider': MODEL_PROVIDER,
-                'api_key': API_KEY
+                'api_key': API_KEY,
+                'response_cache': response_cache
             }
         },
         {
@@ -113,14 +222,25 @@ def run_test():
             'type': 'fstring',
             'params': {
                 'structured_outputs': True,
+                'stream': STREAM,
                 'test_params': test_to_run,
                 'model_name': MODEL_NAME,
                 'model_provider': MODEL_PROVIDER,
-                'api_key': API_KEY
+                'api_key': API_KEY,
+                'response_cache': response_cache
             }
         }
     ]
 
+    # One concurrent, cached check for every (provider, model) in the sweep instead of one per program
+    if HEALTH_CHECK and not REPLAY:
+        HealthChecker().check_all(
+            {(config['params']['model_provider'], config['params']['model_name'], config['params']['api_key']) for config in program_configs}
+        )
+
+    # Every finished test is journaled, so a crashed or preempted sweep can be resumed with `RESUME = True`
+    journal = ResultJournal(os.path.join("../results/journals", f"{TEST_TYPE}-{MODEL_NAME}.jsonl"), resume=RESUME)
+
     total_inference_count = 0  # Total inferences across all programs
 
     # For each program configuration
@@ -151,33 +271,27 @@ def run_test():
             failed_responses=[]
         )
 
+        completed, resumed_time = journal.begin(program_config['name'])
+        if completed:
+            print(f"{Colors.BOLD}Resuming {program_config['name']}: {len(completed)}/{len(json_data)} entries already journaled{Colors.ENDC}")
+
         total_start_time = time.time()
         inference_count = 0  # Inferences for this program
 
-        # Loop over dataset entries
-        for entry in json_data:
-            title = entry.get('title', '')
-            context = entry.get('context', '')
-            question = entry.get('question', '')
-            answer = entry.get('answer', '')
-            answerable = entry.get('answerable', '')
-
-            print(f"{Colors.UNDERLINE}Title: {title}{Colors.ENDC}")
-            print(f"{Colors.UNDERLINE}Question: {question}{Colors.ENDC}\n")
-
-            single_test_result = run_single_test(
-                output_model=output_model,
-                program=program,
-                test_type=TEST_TYPE,
-                title=title,
-                context=context,
-                question=question,
-                answer=answer,
-                task_specific_ground_truth=answerable
-            )
-            inference_count += 1
-
-            # Record the result
+        # Run all dataset entries concurrently, bounded by the provider's concurrency limit
+        single_test_results = asyncio.run(run_program_async(
+            program=program,
+            output_model=output_model,
+            json_data=json_data,
+            concurrency=MAX_CONCURRENCY.get(MODEL_PROVIDER, 1),
+            completed=completed,
+            on_result=lambda index, result: journal.append(program_config['name'], index, result)
+        ))
+
+        # Record the results in dataset order, journaled results included
+        for index, single_test_result in enumerate(single_test_results):
+            if index not in completed:
+                inference_count += 1
             if single_test_result:
                 experiment.all_responses.append(single_test_result.prompt_with_response)
                 experiment.num_attempts += 1
@@ -187,10 +301,15 @@ def run_test():
                 else:
                     experiment.failed_responses.append(single_test_result.prompt_with_response)
 
-            print(f"\n{Colors.BOLD}==============={Colors.ENDC}\n")
+        print(f"\n{Colors.BOLD}==============={Colors.ENDC}\n")
 
-        total_time = time.time() - total_start_time
-        experiment.total_time = int(total_time)
+        # Includes the time spent in earlier, interrupted runs of this program
+        total_time = time.time() - total_start_time + resumed_time
+        experiment.total_time = total_time
+        summarize_request_metrics(experiment)
+        summarize_failure_categories(experiment)
+        if REPAIR_OUTPUTS:
+            summarize_repairs(experiment)
 
         # Calculate success rate and average task performance
         if experiment.num_attempts > 0:
@@ -203,7 +322,17 @@ def run_test():
         # Print final scores
         print(f"{Colors.HEADER}Final Scores for {program_config['name']}:{Colors.ENDC}")
         print(f"{Colors.BOLD}JSON Success Rate: {Colors.GREEN}{experiment.num_successes}/{experiment.num_attempts} ({experiment.success_rate:.2%}){Colors.ENDC}")
+        if experiment.repaired_success_rate is not None:
+            print(f"{Colors.BOLD}JSON Success Rate after repair: {Colors.GREEN}{experiment.num_successes + experiment.num_repaired}/{experiment.num_attempts} ({experiment.repaired_success_rate:.2%}){Colors.ENDC}")
         print(f"{Colors.BOLD}Average Task Performance: {Colors.GREEN}{experiment.average_task_performance:.2f}{Colors.ENDC}")
+        if experiment.latency_p50 is not None:
+            print(f"{Colors.BOLD}Latency p50 / p95 / p99: {experiment.latency_p50:.2f}s / {experiment.latency_p95:.2f}s / {experiment.latency_p99:.2f}s{Colors.ENDC}")
+        if experiment.output_tokens_per_second is not None:
+            print(f"{Colors.BOLD}Tokens in / out: {experiment.total_input_tokens} / {experiment.total_output_tokens} ({experiment.output_tokens_per_second:.1f} output tokens/s){Colors.ENDC}")
+        if experiment.num_cached:
+            print(f"{Colors.BOLD}Served from the response cache: {experiment.num_cached}/{experiment.num_attempts}, left out of the latency and token aggregates{Colors.ENDC}")
+        if experiment.failure_categories:
+            print(f"{Colors.BOLD}Failures by category: {format_failure_categories(experiment)}{Colors.ENDC}")
 
         # Save results to JSON file
         os.makedirs("../results/" + SAVE_DIR, exist_ok=True)
@@ -215,6 +344,10 @@ def run_test():
 
         print(f"\nResults saved in {result_file}")
 
+        if pyarrow_available():
+            write_experiment(experiment, RESULT_STORE_PATH, trial=SAVE_DIR, program_name=program_config['name'], source_file=result_file)
+            print(f"Results added to the result store in {RESULT_STORE_PATH}")
+
         # Append results to experiment log
         with open("experiment-log.md", "a") as f:
             f.write(f"| {MODEL_NAME} | {experiment.success_rate:.2%} | {TEST_TYPE} | {program_config['type']} | {current_date} |\n")
@@ -223,6 +356,8 @@ def run_test():
 
     # Print total number of inferences run
     print(f"{Colors.BOLD}Total number of inferences run: {total_inference_count}{Colors.ENDC}")
+    if response_cache is not None:
+        print(f"{Colors.BOLD}Response cache hits: {response_cache.hits}, misses: {response_cache.misses}{Colors.ENDC}")
 
 if __name__ == "__main__":
     run_test()
\ No newline at end of file
@@ -0,0 +1,74 @@
+# Measure cold import time of the lightweight modules in a fresh interpreter each run,
+# exits non-zero if any module is over its budget (e.g. a provider SDK was imported eagerly again)
+import argparse
+import subprocess
+import sys
+
+# Seconds, the minimum over `--runs` cold imports is compared against the budget
+IMPORT_BUDGETS = {
+    "structured_rag.models": 1.0,
+    "structured_rag.mock_gfl.fstring_prompts": 0.25,
+}
+
+# Modules that must not be loaded as a side effect of importing the modules above
+FORBIDDEN_MODULES = ["dspy", "openai", "anthropic", "ollama", "google.generativeai", "torch", "transformers"]
+
+MEASURE_SNIPPET = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+forbidden = [name for name in {forbidden!r} if name in sys.modules]
+print(elapsed)
+print(",".join(forbidden))
+"""
+
+def measure_import(module: str) -> tuple:
+    result = subprocess.run(
+        [sys.executable, "-c", MEASURE_SNIPPET.format(module=module, forbidden=FORBIDDEN_MODULES)],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        # e.g. an eagerly imported SDK that is not installed
+        raise ImportError(result.stderr.strip().splitlines()[-1])
+    output = result.stdout.splitlines()
+    return float(output[0]), [name for name in output[1].split(",") if name]
+
+def slowest_imports(module: str, top_k: int = 10) -> list:
+    """Parse `python -X importtime` to find the modules with the largest cumulative import time."""
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True).stderr
+    timings = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        # "import time: self [us] | cumulative | imported package"
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        timings.append((int(cumulative_us), name.strip()))
+    return sorted(timings, reverse=True)[:top_k]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check cold import time against per-module budgets")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    over_budget = False
+    for module, budget in IMPORT_BUDGETS.items():
+        try:
+            results = [measure_import(module) for _ in range(args.runs)]
+        except ImportError as e:
+            print(f"FAIL {module}: {e}")
+            over_budget = True
+            continue
+        best_time = min(elapsed for elapsed, _ in results)
+        forbidden = results[0][1]
+        ok = best_time <= budget and not forbidden
+        print(f"{'OK  ' if ok else 'FAIL'} {module}: {best_time * 1000:.1f}ms (budget {budget * 1000:.0f}ms)")
+        if forbidden:
+            print(f"     imported eagerly: {', '.join(forbidden)}")
+        if not ok:
+            over_budget = True
+            for cumulative_us, name in slowest_imports(module):
+                print(f"     {cumulative_us / 1000:8.1f}ms  {name}")
+
+    sys.exit(1 if over_budget else 0)
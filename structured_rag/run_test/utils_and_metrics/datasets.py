@@ -0,0 +1,223 @@
+# Datasets addressed by name instead of `../../../data` paths. With `pyarrow` installed, the JSON (or JSONL)
+# source of a dataset is converted once into an Arrow IPC file under `data/.arrow`, which is then memory-mapped,
+# so opening a dataset, random access and sharding never parse or hold the whole dataset in memory.
+# Without `pyarrow` the source is loaded with `json` as before, behind the same `Dataset` interface.
+import argparse
+import bisect
+import json
+import os
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "..", "data"))
+ARROW_CACHE_DIR = os.path.join(DATA_DIR, ".arrow")
+BATCH_SIZE = 1024 # rows per Arrow record batch, the unit of reads and streaming
+
+# Dataset name -> source file relative to `DATA_DIR`, a list of JSON objects or JSONL (e.g. a BEIR `corpus.jsonl`)
+DATASETS = {
+    "WikiQuestions": "WikiQuestions.json",
+    "WikiQuestions-2.0": "WikiQuestions-2.0.json",
+    "SuperBEIR": "SuperBEIR/SuperBEIR-small-balanced.json",
+}
+
+def register_dataset(name: str, path: str) -> None:
+    """Make the JSON / JSONL file at `path` (absolute, or relative to `DATA_DIR`) loadable as `name`."""
+    DATASETS[name] = path
+
+def data_path(relative_path: str) -> str:
+    return os.path.join(DATA_DIR, relative_path)
+
+def dataset_source(name: str) -> str:
+    if name not in DATASETS:
+        raise ValueError(f"Unknown dataset: {name}, registered datasets are {sorted(DATASETS)}")
+    return data_path(DATASETS[name])
+
+def _iter_source_rows(source_path: str) -> Iterator[Dict[str, Any]]:
+    if source_path.endswith(".jsonl"):
+        # Streamed line by line, so corpora larger than memory can be converted
+        with open(source_path, "r") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(source_path, "r") as f:
+            yield from json.load(f)
+
+def _iter_source_batches(source_path: str, batch_size: int) -> Iterator[List[Dict[str, Any]]]:
+    rows: List[Dict[str, Any]] = []
+    for row in _iter_source_rows(source_path):
+        rows.append(row)
+        if len(rows) == batch_size:
+            yield rows
+            rows = []
+    if rows:
+        yield rows
+
+def infer_schema(source_path: str, batch_size: int = BATCH_SIZE):
+    """The Arrow schema of every row of `source_path`, e.g. with keys that first appear late in a corpus.
+
+    Keys that are always None are null-typed, conflicting types of one key raise `pyarrow.ArrowTypeError`.
+    """
+    import pyarrow as pa
+
+    # Only one batch of rows is held at a time, the schemas of the batches are merged
+    schemas = [pa.RecordBatch.from_pylist(rows).schema for rows in _iter_source_batches(source_path, batch_size)]
+    if not schemas:
+        return pa.schema([])
+    return pa.unify_schemas(schemas, promote_options="permissive")
+
+def convert_to_arrow(source_path: str, arrow_path: str, batch_size: int = BATCH_SIZE) -> None:
+    """Write the rows of `source_path` to the Arrow IPC file `arrow_path`, in record batches of `batch_size` rows.
+
+    The source is read twice, once for `infer_schema` and once to write the batches with that schema.
+    """
+    import pyarrow as pa
+
+    schema = infer_schema(source_path, batch_size)
+    os.makedirs(os.path.dirname(arrow_path), exist_ok=True)
+    tmp_path = f"{arrow_path}.tmp"
+    with pa.ipc.new_file(tmp_path, schema) as writer:
+        for rows in _iter_source_batches(source_path, batch_size):
+            unknown = set().union(*rows) - set(schema.names)
+            if unknown:
+                raise ValueError(f"Keys {sorted(unknown)} of {source_path} are not in its schema, was it modified during the conversion?")
+            writer.write_batch(pa.RecordBatch.from_pylist(rows, schema=schema))
+    os.replace(tmp_path, arrow_path)
+
+class Dataset(ABC):
+    """A sequence of dataset rows (dicts) supporting `len`, indexing, slicing, streaming iteration and sharding.
+
+    Slices, `head` and `shard` return views over the same underlying data, nothing is copied.
+    """
+    def __init__(self, name: str, start: int = 0, stop: Optional[int] = None) -> None:
+        self.name = name
+        self.start = start
+        self.stop = self._num_source_rows() if stop is None else stop
+
+    @abstractmethod
+    def _num_source_rows(self) -> int:
+        ...
+
+    @abstractmethod
+    def _get_source_row(self, index: int) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    def _iter_source_rows(self, start: int, stop: int) -> Iterator[Dict[str, Any]]:
+        ...
+
+    def _view(self, start: int, stop: int) -> "Dataset":
+        view = object.__new__(type(self))
+        view.__dict__.update(self.__dict__)
+        view.start, view.stop = start, stop
+        return view
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Dict[str, Any], "Dataset"]:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("Dataset slices do not support a step")
+            return self._view(self.start + start, self.start + max(start, stop))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Index {index} out of range for {self.name} with {len(self)} rows")
+        return self._get_source_row(self.start + index)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return self._iter_source_rows(self.start, self.stop)
+
+    def head(self, n: int) -> "Dataset":
+        return self[:n]
+
+    def shard(self, num_shards: int, index: int) -> "Dataset":
+        """The `index`-th of `num_shards` contiguous, near-equal shards, e.g. one per worker or Modal container."""
+        if not 0 <= index < num_shards:
+            raise ValueError(f"Shard index {index} out of range for {num_shards} shards")
+        shard_start = self.start + len(self) * index // num_shards
+        shard_stop = self.start + len(self) * (index + 1) // num_shards
+        return self._view(shard_start, shard_stop)
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        return list(self)
+
+class ArrowDataset(Dataset):
+    """A `Dataset` backed by a memory-mapped Arrow IPC file, rows are read from their record batch on access."""
+    def __init__(self, name: str, arrow_path: str) -> None:
+        import pyarrow as pa
+
+        self.arrow_path = arrow_path
+        self.reader = pa.ipc.open_file(pa.memory_map(arrow_path, "r"))
+        # Row offset of every record batch, to find the batch holding a row with a binary search
+        self.batch_offsets = [0]
+        for i in range(self.reader.num_record_batches):
+            self.batch_offsets.append(self.batch_offsets[-1] + self.reader.get_batch(i).num_rows)
+        super().__init__(name)
+
+    def _num_source_rows(self) -> int:
+        return self.batch_offsets[-1]
+
+    def _get_source_row(self, index: int) -> Dict[str, Any]:
+        batch_index = bisect.bisect_right(self.batch_offsets, index) - 1
+        batch = self.reader.get_batch(batch_index)
+        return batch.slice(index - self.batch_offsets[batch_index], 1).to_pylist()[0]
+
+    def _iter_source_rows(self, start: int, stop: int) -> Iterator[Dict[str, Any]]:
+        batch_index = bisect.bisect_right(self.batch_offsets, start) - 1
+        while start < stop:
+            batch = self.reader.get_batch(batch_index)
+            offset = self.batch_offsets[batch_index]
+            end = min(stop, self.batch_offsets[batch_index + 1])
+            yield from batch.slice(start - offset, end - start).to_pylist()
+            start = end
+            batch_index += 1
+
+class InMemoryDataset(Dataset):
+    """A `Dataset` over rows loaded with `json`, used when `pyarrow` is not installed."""
+    def __init__(self, name: str, rows: List[Dict[str, Any]]) -> None:
+        self.rows = rows
+        super().__init__(name)
+
+    def _num_source_rows(self) -> int:
+        return len(self.rows)
+
+    def _get_source_row(self, index: int) -> Dict[str, Any]:
+        return self.rows[index]
+
+    def _iter_source_rows(self, start: int, stop: int) -> Iterator[Dict[str, Any]]:
+        return iter(self.rows[start:stop])
+
+def arrow_cache_path(name: str) -> str:
+    return os.path.join(ARROW_CACHE_DIR, f"{name.replace('/', '_')}.arrow")
+
+def load_dataset(name: str, use_arrow: Optional[bool] = None) -> Dataset:
+    """Open the registered dataset `name`, converting it to Arrow first if its source changed since the last conversion.
+
+    `use_arrow` defaults to whether `pyarrow` is installed.
+    """
+    source_path = dataset_source(name)
+    if not os.path.exists(source_path):
+        raise FileNotFoundError(f"Source file of dataset {name} not found: {source_path}")
+    if use_arrow is None:
+        from structured_rag.run_test.utils_and_metrics.result_store import pyarrow_available
+        use_arrow = pyarrow_available()
+    if not use_arrow:
+        return InMemoryDataset(name, list(_iter_source_rows(source_path)))
+
+    arrow_path = arrow_cache_path(name)
+    if not os.path.exists(arrow_path) or os.path.getmtime(arrow_path) < os.path.getmtime(source_path):
+        print(f"Converting {name} to {arrow_path}...")
+        convert_to_arrow(source_path, arrow_path)
+    return ArrowDataset(name, arrow_path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert registered datasets to memory-mapped Arrow files")
+    parser.add_argument("names", nargs="*", help="Datasets to convert, all registered datasets with a source file by default")
+    args = parser.parse_args()
+
+    for name in args.names or [name for name in DATASETS if os.path.exists(dataset_source(name))]:
+        dataset = load_dataset(name, use_arrow=True)
+        print(f"{name}: {len(dataset)} rows")
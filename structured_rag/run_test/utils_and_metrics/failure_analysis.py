@@ -0,0 +1,115 @@
+# Local fingerprinting of failed responses, so failures of the same shape (```json fences, prose
+# around the JSON, wrong key casing, ...) are clustered and analyzed once instead of once each.
+import json
+import re
+from typing import Dict, List, Optional, Tuple
+
+FENCE_PATTERN = re.compile(r"^```([\w-]*)[ \t]*\n?|\n?```[ \t]*$")
+
+def strip_markdown_fence(text: str) -> Tuple[str, Optional[str]]:
+    """Remove a leading / trailing ``` fence, returning the text inside and the fence language ("" if unnamed, `None` without a fence)."""
+    text = text.strip()
+    match = re.match(r"^```([\w-]*)", text)
+    if match is None:
+        return text, None
+    return FENCE_PATTERN.sub("", text).strip(), match.group(1).lower()
+
+def find_json_span(text: str) -> Tuple[Optional[int], Optional[int]]:
+    """`(start, end)` of the first balanced JSON object or array in `text`.
+
+    `start` is `None` without any `{` / `[`, `end` is `None` if the value is never closed (e.g. truncated output).
+    Brackets inside JSON strings are ignored.
+    """
+    starts = [index for index in (text.find("{"), text.find("[")) if index != -1]
+    if not starts:
+        return None, None
+    start = min(starts)
+    depth = 0
+    in_string = False
+    escaped = False
+    for index in range(start, len(text)):
+        char = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            depth += 1
+        elif char in "}]":
+            depth -= 1
+            if depth == 0:
+                return start, index + 1
+    return start, None
+
+def _type_name(value) -> str:
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, str):
+        return "str"
+    if isinstance(value, list):
+        return "list"
+    if isinstance(value, dict):
+        return "object"
+    return "null"
+
+def fingerprint_response(response: str) -> str:
+    """The shape of `response`, independent of its content.
+
+    e.g. `fence=json | keys=Answer:str` for a fenced object with a capitalized `Answer` key,
+    or `preamble | trailing_text | keys=answer:str,confidence:str`.
+    """
+    if not response or not response.strip():
+        return "empty"
+    text, fence = strip_markdown_fence(response)
+    features = []
+    if fence is not None:
+        features.append(f"fence={fence or 'plain'}")
+    start, end = find_json_span(text)
+    if start is None:
+        return " | ".join(features + ["no_json"])
+    if text[:start].strip():
+        features.append("preamble")
+    if end is None:
+        return " | ".join(features + ["truncated"])
+    if text[end:].strip():
+        features.append("trailing_text")
+    try:
+        value = json.loads(text[start:end])
+    except ValueError:
+        return " | ".join(features + ["invalid_json"])
+    if isinstance(value, dict):
+        # Key casing is kept, `Answer` and `answer` are different failures
+        features.append("keys=" + ",".join(f"{key}:{_type_name(value[key])}" for key in sorted(value)))
+    else:
+        features.append(_type_name(value))
+    return " | ".join(features)
+
+class FailureCluster:
+    """Failed responses sharing one `fingerprint_response` fingerprint."""
+    def __init__(self, fingerprint: str) -> None:
+        self.fingerprint = fingerprint
+        self.responses: List[str] = []
+
+    @property
+    def count(self) -> int:
+        return len(self.responses)
+
+    @property
+    def representative(self) -> str:
+        # The shortest member shows the failure with the least unrelated content
+        return min(self.responses, key=len)
+
+def cluster_failures(responses: List[str]) -> List[FailureCluster]:
+    """Group `responses` by fingerprint, largest cluster first."""
+    clusters: Dict[str, FailureCluster] = {}
+    for response in responses:
+        fingerprint = fingerprint_response(response)
+        clusters.setdefault(fingerprint, FailureCluster(fingerprint)).responses.append(response)
+    return sorted(clusters.values(), key=lambda cluster: cluster.count, reverse=True)
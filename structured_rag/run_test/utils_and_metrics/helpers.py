@@ -2,9 +2,14 @@ import json
 import os
 import datetime
 
+from collections import Counter
+
 import pandas as pd
 
-from structured_rag.models import Experiment
+from typing import Any, Dict, List, Optional
+
+from structured_rag.models import Experiment, PromptWithResponse
+from structured_rag.run_test.utils_and_metrics.result_store import is_result_store, load_runs, load_responses
 
 class Colors:
     HEADER = '\033[95m'
@@ -29,14 +34,80 @@ def load_json_from_file(filename):
         print(f"{Colors.RED}Error: Invalid JSON format in '{filename}'.{Colors.ENDC}")
         return None
 
-def load_experiments(directory: str) -> pd.DataFrame:
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Linearly interpolated percentile, `q` in [0, 100]."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+def summarize_request_metrics(experiment: Experiment) -> None:
+    """Fill in the latency percentiles and token aggregates of `experiment` from its responses.
+
+    Responses served from the response cache take ~0 s and report no usage, so they are only counted in `num_cached`.
+    """
+    experiment.num_cached = sum(r.cached for r in experiment.all_responses)
+    generated = [r for r in experiment.all_responses if not r.cached]
+    latencies = [r.latency for r in generated if r.latency is not None]
+    experiment.latency_p50 = percentile(latencies, 50)
+    experiment.latency_p95 = percentile(latencies, 95)
+    experiment.latency_p99 = percentile(latencies, 99)
+
+    input_tokens = [r.input_tokens for r in generated if r.input_tokens is not None]
+    output_tokens = [r.output_tokens for r in generated if r.output_tokens is not None]
+    experiment.total_input_tokens = sum(input_tokens) if input_tokens else None
+    experiment.total_output_tokens = sum(output_tokens) if output_tokens else None
+    # Throughput of the whole run, so it reflects the concurrency the run was executed with
+    if experiment.total_output_tokens is not None and experiment.total_time > 0:
+        experiment.output_tokens_per_second = experiment.total_output_tokens / experiment.total_time
+    experiment.total_retries = sum(r.num_retries for r in experiment.all_responses)
+
+def summarize_failure_categories(experiment: Experiment) -> None:
+    """Count the `failed_responses` of `experiment` per failure category, most common first."""
+    counts = Counter(r.failure_category for r in experiment.failed_responses if r.failure_category is not None)
+    experiment.failure_categories = dict(counts.most_common())
+
+def summarize_repairs(experiment: Experiment) -> None:
+    """The success rate of `experiment` if its repaired failures counted as successes."""
+    experiment.num_repaired = sum(r.repaired for r in experiment.failed_responses)
+    if experiment.num_attempts > 0:
+        experiment.repaired_success_rate = (experiment.num_successes + experiment.num_repaired) / experiment.num_attempts
+
+def format_failure_categories(experiment: Experiment) -> str:
+    return ", ".join(f"{category}: {count}" for category, count in experiment.failure_categories.items())
+
+def _load_experiments_from_store(store_path: str, filters: Optional[Dict[str, Any]], with_failed_responses: bool) -> pd.DataFrame:
+    columns = ["run_id", "test_name", "model_name", "prompting_method", "num_successes", "num_attempts", "success_rate", "total_time"]
+    df = load_runs(store_path, columns=columns, filters=filters)
+    df["avg_response_time"] = df["total_time"] / df["num_attempts"]
+    if with_failed_responses:
+        failed = load_responses(store_path, columns=["run_id", "prompt", "response"], filters={**(filters or {}), "is_failed": True})
+        failed_by_run = {
+            run_id: [PromptWithResponse(prompt=row.prompt, response=row.response) for row in group.itertuples()]
+            for run_id, group in failed.groupby("run_id")
+        }
+        df["failed_responses"] = [failed_by_run.get(run_id, []) for run_id in df["run_id"]]
+    return df.drop(columns="run_id")
+
+def load_experiments(directory: str, filters: Optional[Dict[str, Any]] = None, with_failed_responses: bool = True) -> pd.DataFrame:
+    """One row per experiment, from a Parquet result store (see `result_store.py`) or a folder of `Experiment` JSON files.
+
+    `filters` maps a column to a value or list of values, e.g. `{"test_name": ["RAGAS"]}`. From a result store
+    they are pushed down to the Parquet scan and only the needed columns are read.
+    """
+    if is_result_store(directory):
+        return _load_experiments_from_store(directory, filters, with_failed_responses)
+
     experiments = []
     for filename in os.listdir(directory):
         if filename.endswith(".json"):
             with open(os.path.join(directory, filename), 'r') as f:
                 data = json.load(f)
                 experiment = Experiment(**data)
-                experiments.append({
+                row = {
                     'test_name': experiment.test_name,
                     'model_name': experiment.model_name,
                     'prompting_method': experiment.prompting_method,
@@ -44,10 +115,15 @@ def load_experiments(directory: str) -> pd.DataFrame:
                     'num_attempts': experiment.num_attempts,
                     'success_rate': experiment.success_rate,
                     'total_time': experiment.total_time,
-                    'avg_response_time': experiment.total_time / experiment.num_attempts,
-                    'failed_responses': experiment.failed_responses
-                })
-    return pd.DataFrame(experiments)
+                    'avg_response_time': experiment.total_time / experiment.num_attempts
+                }
+                if with_failed_responses:
+                    row['failed_responses'] = experiment.failed_responses
+                experiments.append(row)
+    df = pd.DataFrame(experiments)
+    for column, value in (filters or {}).items():
+        df = df[df[column].isin(value if isinstance(value, (list, tuple, set)) else [value])]
+    return df
 
 def count_objects_in_json_file(filename):
   """Loads JSON data from a file and returns the number of objects in the list."""
@@ -1,74 +1,160 @@
 import json
-from typing import Any, Tuple
+import re
+import string
+import threading
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
 
-# This needs a refactor to validate based on the models
+from pydantic import BaseModel, TypeAdapter, ValidationError
 
-def _validate_int_score(score, min_val=0, max_val=5):
-    if isinstance(score, str):
-        try:
-            score = int(score)
-        except ValueError:
-            return None, False
-    return score, isinstance(score, int) and min_val <= score <= max_val
+from structured_rag.mock_gfl.rate_limiter import TransportError, get_rate_limiter, estimate_tokens
+from structured_rag.mock_gfl.response_cache import ResponseCache, CacheMiss
+from structured_rag.models import test_to_response_model
+from structured_rag.run_test.utils_and_metrics.failure_analysis import find_json_span, strip_markdown_fence
 
-def _validate_float_score(score, min_val=0, max_val=5):
-    if isinstance(score, str):
-        try:
-            score = float(score)
-        except ValueError:
-            return None, False
-    return score, isinstance(score, float) and min_val <= score <= max_val
-
-def _validate_boolean(value):
-    if isinstance(value, bool):
-        return value, True
-    if isinstance(value, str):
-        lower_value = value.lower()
-        if lower_value in ['true', 'false']:
-            return lower_value == 'true', True
-    return None, False
-
-def is_valid_json_output(output: Any, test_type: str) -> Tuple[Any, bool]:
+@lru_cache(maxsize=256)
+def compile_validator(response_model: Any) -> TypeAdapter:
+    """Build the pydantic-core validator for a response model once and reuse it for every response."""
+    return TypeAdapter(response_model)
+
+def get_validator(test_type: str, response_model: Optional[Any] = None) -> Optional[TypeAdapter]:
+    # `response_model` overrides the default for `test_type`, e.g. the dynamic `_ClassifyDocument` models
+    if response_model is None:
+        response_model = test_to_response_model.get(test_type)
+        if response_model is None:
+            return None
+    return compile_validator(response_model)
+
+def _validate(validator: TypeAdapter, output: Any) -> Tuple[Any, bool]:
+    try:
+        validated = validator.validate_json(output)
+    except (ValidationError, TypeError, ValueError):
+        return None, False
+    return validator.dump_python(validated, mode="json", by_alias=True), True
+
+def is_valid_json_output(output: Any, test_type: str, response_model: Optional[Any] = None) -> Tuple[Any, bool]:
+    """Parse `output` and validate it against the response model for `test_type`.
+
+    Returns the parsed output (with coerced values, e.g. "true" -> True) and whether it is valid.
+    """
+    validator = get_validator(test_type, response_model)
+    if validator is None:
+        return None, False
+    return _validate(validator, output)
+
+def validate_json_outputs(outputs: List[Any], test_type: str, response_model: Optional[Any] = None) -> List[Tuple[Any, bool]]:
+    """`is_valid_json_output` for a whole batch of responses, resolving the validator once."""
+    validator = get_validator(test_type, response_model)
+    if validator is None:
+        return [(None, False)] * len(outputs)
+    return [_validate(validator, output) for output in outputs]
+
+# Why a response failed validation, see `classify_failure`
+FAILURE_CATEGORIES = [
+    "empty", "markdown_fence", "no_json", "truncated", "trailing_text", "invalid_json",
+    "wrong_key", "invalid_enum", "out_of_range", "wrong_type", "error"
+]
+
+# pydantic error types of a response that parses but does not match the schema.
+# `value_error` is raised by the `_score_in_range` validators, the only custom value checks.
+_SCHEMA_ERROR_CATEGORIES = {
+    "missing": "wrong_key",
+    "extra_forbidden": "wrong_key",
+    "enum": "invalid_enum",
+    "value_error": "out_of_range",
+}
+# If a response has several schema errors, the most specific one is its category
+_SCHEMA_CATEGORY_PRECEDENCE = ["wrong_key", "invalid_enum", "out_of_range", "wrong_type"]
+
+def _classify(validator: TypeAdapter, output: Any) -> Optional[str]:
+    if not isinstance(output, str) or not output.strip():
+        return "empty"
     try:
-        parsed = json.loads(output)
-        if test_type == "GenerateAnswer":
-            answer = parsed.get("answer")
-            return parsed, isinstance(answer, str)
-        elif test_type == "RateContext":
-            score, is_valid = _validate_int_score(parsed.get("context_score"))
-            return parsed if is_valid else None, is_valid
-        elif test_type == "AssessAnswerability":
-            answerable, is_valid = _validate_boolean(parsed.get("answerable_question"))
-            return answerable if is_valid else None, is_valid
-        elif test_type == "ParaphraseQuestions":
-            questions = parsed.get("paraphrased_questions")
-            is_valid = isinstance(questions, list) and all(isinstance(q, str) for q in questions)
-            return parsed if is_valid else None, is_valid
-        elif test_type == "RAGAS":
-            scores = ["faithfulness_score", "answer_relevance_score", "context_relevance_score"]
-            is_valid = all(_validate_float_score(parsed.get(score))[1] for score in scores)
-            return parsed if is_valid else None, is_valid
-        elif test_type == "GenerateAnswerWithConfidence":
-            answer_valid = isinstance(parsed.get("Answer"), str)
-            confidence, confidence_valid = _validate_int_score(parsed.get("Confidence"))
-            return parsed if answer_valid and confidence_valid else None, answer_valid and confidence_valid
-        elif test_type == "GenerateAnswersWithConfidence":
-            answers = parsed
-            is_valid = isinstance(answers, list) and all(
-                isinstance(a.get("Answer"), str) and _validate_int_score(a.get("Confidence"))[1]
-                for a in answers
-            )
-            return parsed if is_valid else None, is_valid
-        elif test_type == "ClassifyDocument":
-            is_valid = isinstance(parsed.get('category'), str)
-            return parsed if is_valid else None, is_valid
-        elif test_type == "ClassifyDocumentWithRationale":
-            is_valid = isinstance(parsed.get('category'), str) and isinstance(parsed.get('rationale'), str)
-            return parsed if is_valid else None, is_valid
-        else:
-            return None, False
-    except json.JSONDecodeError:
+        validator.validate_json(output)
+    except ValidationError as error:
+        errors = error.errors()
+    except (TypeError, ValueError):
+        return "invalid_json"
+    else:
+        return None
+
+    if any(error["type"] == "json_invalid" for error in errors):
+        # Not JSON as a whole, find out what is around or wrong with the JSON inside
+        text, fence = strip_markdown_fence(output)
+        if fence is not None:
+            return "markdown_fence"
+        start, end = find_json_span(text)
+        if start is None:
+            return "no_json"
+        if end is None:
+            return "truncated"
+        # Prose before the JSON counts as trailing text too
+        if text[:start].strip() or text[end:].strip():
+            return "trailing_text"
+        return "invalid_json"
+
+    categories = {_SCHEMA_ERROR_CATEGORIES.get(error["type"], "wrong_type") for error in errors}
+    return next(category for category in _SCHEMA_CATEGORY_PRECEDENCE if category in categories)
+
+def classify_failure(output: Any, test_type: str, response_model: Optional[Any] = None) -> Optional[str]:
+    """The `FAILURE_CATEGORIES` entry of an `output` that fails `is_valid_json_output`, `None` if it is valid.
+
+    A response with a ```json fence is `markdown_fence` even if the JSON inside is valid, and one with
+    several schema errors gets the first category of `_SCHEMA_CATEGORY_PRECEDENCE`, e.g. `wrong_key`
+    for `{"Answer": ...}` in place of `{"answer": ...}`.
+    """
+    validator = get_validator(test_type, response_model)
+    if validator is None:
+        return None
+    return _classify(validator, output)
+
+@lru_cache(maxsize=256)
+def _schema_keys(validator: TypeAdapter) -> Dict[str, str]:
+    """Lowercased key -> key of every object in the response model, aliases included."""
+    schema = validator.json_schema()
+    keys = {}
+    for object_schema in [schema, *schema.get("$defs", {}).values()]:
+        for key in object_schema.get("properties", {}):
+            keys[key.lower()] = key
+    return keys
+
+def _normalize_keys(value: Any, keys: Dict[str, str]) -> Any:
+    if isinstance(value, dict):
+        return {keys.get(key.lower(), key): _normalize_keys(item, keys) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_normalize_keys(item, keys) for item in value]
+    return value
+
+def _repair(validator: TypeAdapter, output: Any) -> Tuple[Any, bool]:
+    if not isinstance(output, str):
+        return None, False
+    text, _ = strip_markdown_fence(output)
+    start, end = find_json_span(text)
+    if start is None or end is None:
+        return None, False
+    try:
+        value = json.loads(text[start:end])
+    except ValueError:
+        return None, False
+    # Re-validated as JSON, so a repaired output is held to the same rules as a strict one
+    return _validate(validator, json.dumps(_normalize_keys(value, _schema_keys(validator))))
+
+def repair_json_output(output: Any, test_type: str, response_model: Optional[Any] = None) -> Tuple[Any, bool]:
+    """`is_valid_json_output` after salvaging the JSON in `output`, without regenerating it.
+
+    Strips a ```json fence, keeps only the first balanced JSON object / array (dropping any prose
+    around it) and matches keys to the response model's case-insensitively, e.g. `Answer` -> `answer`.
+    Truncated or malformed JSON is not repaired.
+    """
+    validator = get_validator(test_type, response_model)
+    if validator is None:
         return None, False
+    parsed_output, is_valid = _validate(validator, output)
+    if is_valid:
+        return parsed_output, True
+    return _repair(validator, output)
 
 # Although assess_answerability_metric and classification_metric currently do the same thing,
 # ==> we want to extend classification_metric in the future to put probabilties on more than one class.
@@ -100,12 +186,220 @@ class AssessAnswerAlignment(dspy.Signature):
 
 assess_answer_alignment = dspy.TypedPredictor(AssessAnswerAlignment)
 
+# Cheap-first scoring of GenerateAnswer outputs, only the cases these checks cannot settle go to the judge
+NOT_ENOUGH_CONTEXT = "NOT ENOUGH CONTEXT" # the answer GenerateAnswer's instructions ask for on unanswerable questions
+F1_MATCH_THRESHOLD = 0.9 # token F1 with the ground truth from which an answer counts as fully aligned
+MAX_ALIGNMENT_SCORE = 5
+# How a verdict was reached, cheapest first
+SCORING_TIERS = ["empty_answer", "not_enough_context", "exact_match", "token_f1", "cache", "judge"]
+
+def normalize_answer(text: str) -> str:
+    """Lowercase, drop punctuation and articles and collapse whitespace (the SQuAD answer normalization)."""
+    text = "".join(char for char in text.lower() if char not in string.punctuation)
+    text = re.sub(r"\b(a|an|the)\b", " ", text)
+    return " ".join(text.split())
+
+def token_f1(prediction: str, ground_truth: str) -> float:
+    prediction_tokens = normalize_answer(prediction).split()
+    ground_truth_tokens = normalize_answer(ground_truth).split()
+    num_same = sum((Counter(prediction_tokens) & Counter(ground_truth_tokens)).values())
+    if num_same == 0:
+        return 0.0
+    precision = num_same / len(prediction_tokens)
+    recall = num_same / len(ground_truth_tokens)
+    return 2 * precision * recall / (precision + recall)
+
+def deterministic_answer_metric(system_answer: str, ground_truth: str,
+                                answerable: Optional[bool] = None) -> Optional[Tuple[int, str, str]]:
+    """Score the answers a string comparison can settle, returning `(score, rationale, tier)`, or `None` to ask the judge.
+
+    The NOT ENOUGH CONTEXT rule needs the dataset's `answerable` flag and only applies to answers that are
+    exactly NOT ENOUGH CONTEXT. A substantive answer to an unanswerable question, or a hedged answer that
+    mentions it, is left to the later tiers or the judge, as the ground truths of those questions are hedged answers.
+
+    >>> deterministic_answer_metric("Not enough context.", "Paris", answerable=False)[::2]
+    (5, 'not_enough_context')
+    >>> deterministic_answer_metric("Paris. There is not enough context to say more about its history.", "Paris", answerable=False) is None
+    True
+    >>> deterministic_answer_metric("The capital is Paris, not enough context for the population though", "Paris", answerable=True) is None
+    True
+    """
+    normalized_answer = normalize_answer(system_answer)
+    if not normalized_answer:
+        return 0, "The system answer is empty.", "empty_answer"
+    if answerable is not None and normalized_answer == normalize_answer(NOT_ENOUGH_CONTEXT):
+        if answerable:
+            return 0, f"The system answered {NOT_ENOUGH_CONTEXT} although the question is answerable from the context.", "not_enough_context"
+        return MAX_ALIGNMENT_SCORE, f"The system correctly answered {NOT_ENOUGH_CONTEXT} for a question the context cannot answer.", "not_enough_context"
+    if normalized_answer == normalize_answer(ground_truth):
+        return MAX_ALIGNMENT_SCORE, "The system answer matches the ground truth answer.", "exact_match"
+    f1 = token_f1(system_answer, ground_truth)
+    if f1 >= F1_MATCH_THRESHOLD:
+        return MAX_ALIGNMENT_SCORE, f"The system answer has a token F1 of {f1:.2f} with the ground truth answer.", "token_f1"
+    return None
+
+class AlignmentVerdict(BaseModel):
+    index: int
+    score_rationale: str
+    alignment_score: int
+
+class AssessAnswerAlignmentBatch(dspy.Signature):
+    """Assess the alignment between the system answer and the ground truth answer of every item on a scale of 0 to 5, judging each item independently of the others."""
+
+    items: str = dspy.InputField(description="A JSON list of items, each with an `index`, the `context` to use for answering the `question`, the `system_answer` generated by the system and the `ground_truth` answer.")
+    verdicts: List[AlignmentVerdict] = dspy.OutputField(description="One verdict per item with the item's `index`, the `score_rationale` making it very clear why you chose this particular score and not the others, and the `alignment_score` on an integer scale of 0 to 5, 0 meaning the system answer is not aligned with the ground truth answer, 5 meaning it is fully aligned.")
+
+assess_answer_alignment_batch = dspy.TypedPredictor(AssessAnswerAlignmentBatch)
+
+JudgeItem = Dict[str, Any] # `context`, `question`, `system_answer`, `ground_truth` and optionally `answerable`
+JUDGE_INPUTS = ["context", "question", "system_answer", "ground_truth"]
+
 class GenerateAnswerTaskMetric:
-    def __init__(self, api_key: str):
-        self.gpt4 = dspy.OpenAI(model="gpt-4o", api_key=api_key)
+    """LLM judge of GenerateAnswer responses, scoring `max_concurrency` items (or packs of items) at a time.
+
+    Answers `deterministic_answer_metric` can settle never reach the judge, `tier_counts` counts
+    how many verdicts each of the `SCORING_TIERS` produced. With `pack_size > 1`, `assess_answer_metrics` judges up to `pack_size` items in one judge call,
+    falling back to one call per item for any item the packed verdicts miss. Verdicts are cached in
+    `response_cache` per item content, so rerunning a sweep only judges the answers that changed.
+    """
+    def __init__(self, api_key: str, max_concurrency: int = 16, pack_size: int = 1,
+                 response_cache: Optional[ResponseCache] = None):
+        self.model_name = "gpt-4o"
+        self.gpt4 = dspy.OpenAI(model=self.model_name, api_key=api_key)
         self.assess_answer_alignment = assess_answer_alignment
+        self.assess_answer_alignment_batch = assess_answer_alignment_batch
+        self.pack_size = pack_size
+        self.response_cache = response_cache
+        self.rate_limiter = get_rate_limiter("openai")
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.tier_counts = Counter({tier: 0 for tier in SCORING_TIERS})
+        self.tier_counts_lock = threading.Lock()
+
+    def _count_tier(self, tier: str, count: int = 1) -> None:
+        with self.tier_counts_lock:
+            self.tier_counts[tier] += count
+
+    def tier_summary(self) -> str:
+        return ", ".join(f"{tier}: {self.tier_counts[tier]}" for tier in SCORING_TIERS)
+
+    def make_cache_key(self, item: JudgeItem) -> str:
+        prompt = json.dumps([item[name] for name in JUDGE_INPUTS])
+        return ResponseCache.make_key("openai", self.model_name, prompt, variant="AssessAnswerAlignment")
+
+    def _get_cached(self, item: JudgeItem) -> Optional[Tuple[int, str]]:
+        if self.response_cache is None:
+            return None
+        cached = self.response_cache.get(self.make_cache_key(item))
+        if cached is None:
+            if self.response_cache.replay:
+                raise CacheMiss(f"No cached verdict for question {item['question']!r}")
+            return None
+        verdict = json.loads(cached)
+        return verdict["alignment_score"], verdict["score_rationale"]
+
+    def _put_cached(self, item: JudgeItem, verdict: Tuple[int, str]) -> None:
+        if self.response_cache is not None:
+            self.response_cache.put(self.make_cache_key(item), json.dumps({"alignment_score": verdict[0], "score_rationale": verdict[1]}))
+
+    def _judge(self, item: JudgeItem) -> Optional[Tuple[int, str]]:
+        def call_judge():
+            with dspy.context(lm=self.gpt4):
+                return self.assess_answer_alignment(**{name: item[name] for name in JUDGE_INPUTS})
+        try:
+            metric_output = self.rate_limiter.call(call_judge, estimated_tokens=estimate_tokens(json.dumps(item)))
+        except TransportError as e:
+            # Out of retries, the item is left unjudged rather than failing the other items
+            print(f"Judge call for question {item['question']!r} failed: {e}")
+            return None
+        verdict = (metric_output.alignment_score, metric_output.score_rationale)
+        self._put_cached(item, verdict)
+        return verdict
+
+    def _judge_pack(self, items: List[JudgeItem]) -> List[Optional[Tuple[int, str]]]:
+        if len(items) == 1:
+            return [self._judge(items[0])]
+        packed_items = json.dumps([{"index": index, **{name: item[name] for name in JUDGE_INPUTS}} for index, item in enumerate(items)])
+        def call_judge():
+            with dspy.context(lm=self.gpt4):
+                return self.assess_answer_alignment_batch(items=packed_items)
+        verdicts = {}
+        try:
+            metric_output = self.rate_limiter.call(call_judge, estimated_tokens=estimate_tokens(packed_items))
+            verdicts = {verdict.index: (verdict.alignment_score, verdict.score_rationale) for verdict in metric_output.verdicts}
+        except ValueError as e:
+            print(f"Packed judge call for {len(items)} items failed ({e}), judging them one by one")
+        except TransportError as e:
+            # The provider is unreachable for now, one call per item would only retry as long again
+            print(f"Packed judge call for {len(items)} items failed ({e}), leaving them unjudged")
+            return [None] * len(items)
+        results = []
+        for index, item in enumerate(items):
+            if index in verdicts:
+                self._put_cached(item, verdicts[index])
+                results.append(verdicts[index])
+            else:
+                results.append(self._judge(item))
+        return results
+
+    def assess_answer_metric(self, context: str, question: str, system_answer: str, ground_truth: str,
+                             answerable: Optional[bool] = None) -> Optional[Tuple[int, str]]:
+        """`(alignment_score, score_rationale)` of one answer, `None` if the judge's retries ran out."""
+        deterministic = deterministic_answer_metric(system_answer, ground_truth, answerable)
+        if deterministic is not None:
+            self._count_tier(deterministic[2])
+            return deterministic[:2]
+        item = {"context": context, "question": question, "system_answer": system_answer, "ground_truth": ground_truth}
+        cached = self._get_cached(item)
+        if cached is not None:
+            self._count_tier("cache")
+            return cached
+        self._count_tier("judge")
+        return self._judge(item)
+
+    def submit(self, context: str, question: str, system_answer: str, ground_truth: str,
+               answerable: Optional[bool] = None) -> "Future[Optional[Tuple[int, str]]]":
+        """`assess_answer_metric` on the judge's thread pool, e.g. to judge streamed results as they arrive."""
+        return self.executor.submit(self.assess_answer_metric, context, question, system_answer, ground_truth, answerable)
+
+    def assess_answer_metrics(self, items: List[JudgeItem]) -> List[Optional[Tuple[int, str]]]:
+        """`(alignment_score, score_rationale)` of every item, judging the unsettled, uncached ones concurrently in packs of `pack_size`.
+
+        Items without a cached verdict in replay mode, and items whose judge call ran out of retries, are left
+        unjudged (`None`) instead of failing the whole batch.
+        """
+        results: List[Optional[Tuple[int, str]]] = [None] * len(items)
+        verdicts: Dict[str, Tuple[int, str]] = {}
+        pending: Dict[str, JudgeItem] = {}
+        keys: Dict[int, str] = {}
+        for index, item in enumerate(items):
+            deterministic = deterministic_answer_metric(item["system_answer"], item["ground_truth"], item.get("answerable"))
+            if deterministic is not None:
+                self._count_tier(deterministic[2])
+                results[index] = deterministic[:2]
+                continue
+            key = self.make_cache_key(item)
+            if key in verdicts or key in pending:
+                keys[index] = key
+                self._count_tier("cache")
+                continue
+            try:
+                cached = self._get_cached(item)
+            except CacheMiss:
+                continue
+            keys[index] = key
+            if cached is not None:
+                self._count_tier("cache")
+                verdicts[key] = cached
+            else:
+                self._count_tier("judge")
+                pending[key] = item
 
-    def assess_answer_metric(self, context: str, question: str, system_answer: str, ground_truth: str) -> Tuple[int, str]:
-        with dspy.context(lm=self.gpt4):
-            metric_output = self.assess_answer_alignment(context=context, question=question, system_answer=system_answer, ground_truth=ground_truth)
-        return metric_output.alignment_score, metric_output.score_rationale
\ No newline at end of file
+        pending_keys = list(pending)
+        packs = [pending_keys[i:i + self.pack_size] for i in range(0, len(pending_keys), self.pack_size)]
+        if packs:
+            print(f"Judging {len(pending_keys)} of {len(items)} answers in {len(packs)} calls")
+        for pack, pack_verdicts in zip(packs, self.executor.map(lambda pack: self._judge_pack([pending[key] for key in pack]), packs)):
+            verdicts.update(zip(pack, pack_verdicts))
+        for index, key in keys.items():
+            results[index] = verdicts[key]
+        return results
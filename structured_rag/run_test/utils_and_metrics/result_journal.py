@@ -0,0 +1,61 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, Tuple
+
+from structured_rag.models import SingleTestResult
+
+class ResultJournal:
+    """Append-only JSONL log of every `SingleTestResult` of a sweep, written as each test completes.
+
+    Each line records the program name, the dataset entry index and the result, so a resumed
+    run can skip the (program, entry) pairs that already finished and rebuild the `Experiment`.
+    Results that should be retried (transport errors, cache misses) are never journaled.
+    """
+    def __init__(self, path: str, resume: bool = False) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        # Identifies this process's run, to add up the wall time of every resumed segment
+        self.segment = time.time()
+        self.program_start_times: Dict[str, float] = {}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "a+b" if resume else "wb") as f:
+            # Terminate a line cut short by a crash, so it does not swallow the next record
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+
+    def append(self, program_name: str, entry_index: int, result: SingleTestResult) -> None:
+        record = {
+            "program": program_name,
+            "entry_index": entry_index,
+            "segment": self.segment,
+            "elapsed": time.time() - self.program_start_times[program_name],
+            "result": result.dict()
+        }
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def begin(self, program_name: str) -> Tuple[Dict[int, SingleTestResult], float]:
+        """Start (or resume) `program_name`, returning its journaled results by entry index and the wall time already spent on them."""
+        self.program_start_times[program_name] = time.time()
+        results: Dict[int, SingleTestResult] = {}
+        segment_times: Dict[float, float] = {}
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by the crash this run is resuming from
+                    continue
+                if record["program"] != program_name:
+                    continue
+                results[record["entry_index"]] = SingleTestResult(**record["result"])
+                segment_times[record["segment"]] = max(segment_times.get(record["segment"], 0.0), record["elapsed"])
+        return results, sum(segment_times.values())
@@ -0,0 +1,226 @@
+# Partitioned Parquet store of experiment results, with a `runs` table (one row per `Experiment`)
+# and a `responses` table (one row per response), both partitioned by test / model / prompting method.
+# Requires `pyarrow` (`pip install pyarrow`).
+import argparse
+import hashlib
+import json
+import os
+from enum import Enum
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Type, Union, get_args, get_origin
+
+import pandas as pd
+from pydantic import BaseModel
+
+from structured_rag.models import Experiment, PromptWithResponse
+
+DEFAULT_RESULT_STORE = "../results/store"
+PARTITION_COLUMNS = ["test_name", "model_name", "prompting_method"]
+
+Filters = Dict[str, Union[Any, Sequence[Any]]]
+
+def pyarrow_available() -> bool:
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+def is_result_store(path: str) -> bool:
+    return os.path.isdir(os.path.join(path, "runs"))
+
+# `Experiment` fields that are stored elsewhere than in its `runs` row
+EXPERIMENT_EXCLUDE = {"test_name", "model_name", "prompting_method", "all_responses", "failed_responses"}
+
+def _arrow_type(annotation: Any):
+    import pyarrow as pa
+
+    if get_origin(annotation) is Union:
+        # Optional[X]
+        annotation = next(arg for arg in get_args(annotation) if arg is not type(None))
+    if annotation is bool:
+        return pa.bool_()
+    if annotation is int:
+        return pa.int64()
+    if annotation is float:
+        return pa.float64()
+    if annotation is str or (isinstance(annotation, type) and issubclass(annotation, Enum)):
+        return pa.string()
+    if get_origin(annotation) is dict:
+        # Stored as JSON, see `experiment_to_rows`
+        return pa.string()
+    raise TypeError(f"No Parquet column type for {annotation}")
+
+def _model_fields(model: Type[BaseModel], exclude: set) -> list:
+    import pyarrow as pa
+
+    return [pa.field(name, _arrow_type(field.annotation)) for name, field in model.model_fields.items() if name not in exclude]
+
+# Every file is written with, and the store read as, these schemas. Inferring them per file gives a
+# column that is None in every row of a file the null type, which the files of other runs cannot be read as.
+@lru_cache(maxsize=None)
+def runs_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        pa.field("run_id", pa.string()),
+        *[pa.field(column, pa.string()) for column in PARTITION_COLUMNS],
+        pa.field("trial", pa.string()),
+        pa.field("program_name", pa.string()),
+        pa.field("source_file", pa.string()),
+        *_model_fields(Experiment, EXPERIMENT_EXCLUDE),
+        pa.field("num_failed_responses", pa.int64()),
+    ])
+
+@lru_cache(maxsize=None)
+def responses_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        pa.field("run_id", pa.string()),
+        *[pa.field(column, pa.string()) for column in PARTITION_COLUMNS],
+        pa.field("trial", pa.string()),
+        pa.field("response_index", pa.int64()),
+        pa.field("is_failed", pa.bool_()),
+        *_model_fields(PromptWithResponse, set()),
+    ])
+
+def make_run_id(experiment: Experiment) -> str:
+    # Content-addressed, so importing the same result twice overwrites instead of duplicating it
+    return hashlib.sha256(experiment.json().encode("utf-8")).hexdigest()[:16]
+
+def experiment_to_rows(experiment: Experiment, trial: Optional[str] = None, program_name: Optional[str] = None,
+                       source_file: Optional[str] = None) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Flatten `experiment` into its `runs` row and its `responses` rows."""
+    run_id = make_run_id(experiment)
+    partition = {
+        "test_name": experiment.test_name,
+        "model_name": experiment.model_name,
+        "prompting_method": experiment.prompting_method.value,
+    }
+    run_row = {
+        "run_id": run_id,
+        **partition,
+        "trial": trial,
+        "program_name": program_name,
+        "source_file": source_file,
+        **experiment.dict(exclude=EXPERIMENT_EXCLUDE),
+        # JSON rather than a struct column, whose fields would differ from run to run
+        "failure_categories": json.dumps(experiment.failure_categories),
+        "num_failed_responses": len(experiment.failed_responses),
+    }
+    # `failed_responses` is a subset of `all_responses`, stored as a flag instead of a second copy
+    failed = {}
+    for response in experiment.failed_responses:
+        key = (response.prompt, response.response)
+        failed[key] = failed.get(key, 0) + 1
+    response_rows = []
+    for index, response in enumerate(experiment.all_responses):
+        key = (response.prompt, response.response)
+        is_failed = failed.get(key, 0) > 0
+        if is_failed:
+            failed[key] -= 1
+        response_rows.append({
+            "run_id": run_id,
+            **partition,
+            "trial": trial,
+            "response_index": index,
+            "is_failed": is_failed,
+            **response.dict(),
+        })
+    return run_row, response_rows
+
+def _write_table(rows: List[Dict[str, Any]], path: str, run_id: str, schema) -> None:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if not rows:
+        return
+    unknown = set(rows[0]) - set(schema.names)
+    if unknown:
+        raise ValueError(f"Columns missing from the result store schema: {sorted(unknown)}")
+    pq.write_to_dataset(
+        pa.Table.from_pylist(rows, schema=schema),
+        root_path=path,
+        partition_cols=PARTITION_COLUMNS,
+        basename_template=f"{run_id}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+
+def write_experiment(experiment: Experiment, store_path: str = DEFAULT_RESULT_STORE, trial: Optional[str] = None,
+                     program_name: Optional[str] = None, source_file: Optional[str] = None) -> str:
+    """Add `experiment` to the store at `store_path` and return its run id."""
+    run_row, response_rows = experiment_to_rows(experiment, trial, program_name, source_file)
+    _write_table([run_row], os.path.join(store_path, "runs"), run_row["run_id"], runs_schema())
+    _write_table(response_rows, os.path.join(store_path, "responses"), run_row["run_id"], responses_schema())
+    return run_row["run_id"]
+
+def _filter_expression(filters: Optional[Filters]):
+    import pyarrow.dataset as ds
+
+    expression = None
+    for column, value in (filters or {}).items():
+        if isinstance(value, (list, tuple, set)):
+            condition = ds.field(column).isin(list(value))
+        else:
+            condition = ds.field(column) == value
+        expression = condition if expression is None else expression & condition
+    return expression
+
+def _load_table(path: str, schema, columns: Optional[List[str]], filters: Optional[Filters]) -> pd.DataFrame:
+    import pyarrow.dataset as ds
+
+    # Partition columns are pruned by directory, other filters are pushed down to the Parquet row groups.
+    # Files written before a column was added (or with null-typed columns) are read as `schema` too.
+    dataset = ds.dataset(path, schema=schema, format="parquet", partitioning="hive")
+    df = dataset.to_table(columns=columns, filter=_filter_expression(filters)).to_pandas()
+    for column in PARTITION_COLUMNS:
+        # Hive partition values come back as categoricals
+        if column in df.columns:
+            df[column] = df[column].astype(str)
+    return df
+
+def load_runs(store_path: str = DEFAULT_RESULT_STORE, columns: Optional[List[str]] = None,
+              filters: Optional[Filters] = None) -> pd.DataFrame:
+    """Load the `runs` table, e.g. `load_runs(columns=["model_name", "success_rate"], filters={"test_name": "RAGAS"})`."""
+    return _load_table(os.path.join(store_path, "runs"), runs_schema(), columns, filters)
+
+def load_responses(store_path: str = DEFAULT_RESULT_STORE, columns: Optional[List[str]] = None,
+                   filters: Optional[Filters] = None) -> pd.DataFrame:
+    """Load the `responses` table, e.g. `filters={"is_failed": True}` for the failed responses only."""
+    return _load_table(os.path.join(store_path, "responses"), responses_schema(), columns, filters)
+
+def import_json_results(results_dir: str, store_path: str = DEFAULT_RESULT_STORE) -> int:
+    """Import every `Experiment` JSON under `results_dir` into the store, using its directory name as the trial."""
+    num_imported = 0
+    for root, _, filenames in os.walk(results_dir):
+        if os.path.commonpath([os.path.abspath(root), os.path.abspath(store_path)]) == os.path.abspath(store_path):
+            continue
+        for filename in sorted(filenames):
+            if not filename.endswith(".json"):
+                continue
+            file_path = os.path.join(root, filename)
+            try:
+                with open(file_path, "r") as f:
+                    data = json.load(f)
+                # Results recorded before task metrics were added to `Experiment`
+                if isinstance(data, dict) and "all_responses" in data:
+                    data.setdefault("total_task_performance", 0)
+                    data.setdefault("average_task_performance", 0.0)
+                experiment = Experiment(**data)
+            except (ValueError, TypeError) as e:
+                # Older result formats, e.g. the per-trial summaries read by `aggregate_result_jsons.py`
+                print(f"Skipping {file_path}: {type(e).__name__}")
+                continue
+            write_experiment(experiment, store_path, trial=os.path.basename(root), source_file=file_path)
+            num_imported += 1
+    return num_imported
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import Experiment JSON results into the Parquet result store")
+    parser.add_argument("results_dir", type=str, help="Directory searched recursively for Experiment JSON files")
+    parser.add_argument("--store", type=str, default=DEFAULT_RESULT_STORE)
+    args = parser.parse_args()
+
+    num_imported = import_json_results(args.results_dir, args.store)
+    print(f"Imported {num_imported} experiments into {args.store}")